@@ -0,0 +1,7 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#  __init__.py
+#
+#  Copyright (c) 2019 nameko-django. All rights reserved.
+#
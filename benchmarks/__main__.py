@@ -0,0 +1,44 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#  __main__.py
+#
+#  Usage: python -m benchmarks [--output results.json] [--compare previous.json] [--threshold 0.1] [payload ...]
+#  Exits with status 1 when a metric regressed by more than the threshold compared to the previous results.
+#
+from __future__ import print_function, unicode_literals
+
+import argparse
+import sys
+
+from benchmarks import suite
+from benchmarks.django_setup import setup_django
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='nameko-django serializer benchmarks')
+    parser.add_argument('payloads', nargs='*', help='the payloads to run, all of them by default')
+    parser.add_argument('--output', help='save the results to this JSON file')
+    parser.add_argument('--compare', help='the JSON results of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=suite.DEFAULT_THRESHOLD,
+                        help='the relative change flagged as a regression (default %(default)s)')
+    parser.add_argument('--min-time', type=float, default=0.2, help='the minimum time of a timing round')
+    args = parser.parse_args(argv)
+
+    setup_django(create_tables=True)
+    from benchmarks.corpus import build_corpus
+    results = suite.run(build_corpus(), args.payloads, min_time=args.min_time)
+    suite.report(results)
+    if args.output:
+        suite.save(results, args.output)
+    if args.compare:
+        regressions = suite.compare(suite.load(args.compare), results, args.threshold)
+        for name, metric, before, after in regressions:
+            print('REGRESSION {} {}: {:.6g} -> {:.6g}'.format(name, metric, before, after))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,62 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#  bench_compression.py
+#
+#  Find for each codec the payload size above which compressing pays off: the time spent compressing
+#  and inflating a payload is lower than the time saved sending fewer bytes over the broker.
+#  Usage: python -m benchmarks.bench_compression [bandwidth in MB/s, 100 by default]
+#
+from __future__ import print_function, unicode_literals
+
+import sys
+from timeit import repeat
+
+from nameko_django.serializer import dumps, loads, compress_payload, _codecs
+
+SIZES = [256 << i for i in range(15)]  # 256B to 4MB
+
+
+def rows(size):
+    """ :return: a list of records whose encoded size is about size bytes """
+    def row(i):
+        return {'id': i, 'name': 'customer {}'.format(i), 'email': 'customer_{}@example.com'.format(i),
+                'balance': i * 7.25, 'active': i % 3 != 0, 'tags': ['retail', 'emea'][:i % 3]}
+
+    count = max(1, size // len(dumps(row(10000))))
+    return [row(i) for i in range(count)]
+
+
+def best(fn, number):
+    return min(repeat(fn, number=number, repeat=3)) / number
+
+
+def run(bandwidth=100.0):
+    bytes_per_second = bandwidth * (1 << 20)
+    print('size, then for each codec: compressed size, added cpu time, bandwidth below which it pays off')
+    crossovers = {}
+    for size in SIZES:
+        payload = rows(size)
+        body = dumps(payload)
+        number = max(1, (1 << 16) // len(body))
+        line = ['{:>9} bytes'.format(len(body))]
+        for name in sorted(_codecs):
+            compressed = compress_payload(body, name)
+            if compressed is body:
+                line.append('{:>5}: not smaller'.format(name).ljust(40))
+                continue
+            cost = best(lambda: compress_payload(body, name), number) + \
+                best(lambda: loads(compressed, eval_strings=False), number) - \
+                best(lambda: loads(body, eval_strings=False), number)
+            saved = len(body) - len(compressed)
+            if saved / bytes_per_second > cost:
+                crossovers.setdefault(name, len(body))
+            line.append('{:>5}: {:5.1f}% {:8.3f} ms {:9.1f} MB/s'.format(
+                name, 100.0 * len(compressed) / len(body), cost * 1000, saved / cost / (1 << 20)))
+        print('  '.join(line))
+    for name in sorted(_codecs):
+        print('at {} MB/s {} pays off above {} bytes'.format(bandwidth, name, crossovers.get(name, 'never')))
+
+
+if __name__ == '__main__':
+    run(*[float(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,51 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#  bench_datetime.py
+#
+#  Compare the string wire format of datetime, date, time and timedelta against the native binary format.
+#  Usage: python -m benchmarks.bench_datetime
+#
+from __future__ import print_function, unicode_literals
+
+from datetime import datetime, date, time, timedelta
+from timeit import repeat
+
+try:
+    from datetime import timezone
+    utc = timezone.utc
+except ImportError:  # python 2
+    from django.utils.timezone import utc
+
+from benchmarks.django_setup import setup_django
+
+setup_django()
+
+
+from nameko_django.serializer import dumps, loads, enable_native_datetime  # noqa: E402
+
+PAYLOAD = [{'created': datetime(2019, 9, 26, 9, 16, 35, i, tzinfo=utc), 'local': datetime(2019, 9, 26, 9, 16, 35, i),
+            'day': date(2019, 9, 26), 'at': time(9, 16, 35, i), 'took': timedelta(seconds=i)}
+           for i in range(2000)]
+
+
+def measure(number, rounds):
+    body = dumps(PAYLOAD)
+    encode = min(repeat(lambda: dumps(PAYLOAD), number=number, repeat=rounds)) / number
+    decode = min(repeat(lambda: loads(body), number=number, repeat=rounds)) / number
+    return len(body), encode, decode
+
+
+def run(number=10, rounds=5):
+    results = [('string', measure(number, rounds))]
+    enable_native_datetime()
+    try:
+        results.append(('native', measure(number, rounds)))
+    finally:
+        enable_native_datetime(False)
+    for name, (size, encode, decode) in results:
+        print('{:<8} {:>8} bytes  dumps {:7.2f} ms  loads {:7.2f} ms'.format(name, size, encode * 1000, decode * 1000))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,43 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#  bench_decimal.py
+#
+#  Compare the string Decimal ext type against the binary (exponent, coefficient) one.
+#  Usage: python -m benchmarks.bench_decimal
+#
+from __future__ import print_function, unicode_literals
+
+from decimal import Decimal
+from timeit import repeat
+
+from nameko_django.serializer import dumps, loads, register_encoder, unregister_encoder, encode_decimal_binary
+
+PAYLOADS = {
+    'small prices': [Decimal(i) / 100 for i in range(10000)],
+    'high precision': [Decimal(1) / Decimal(i + 7) for i in range(10000)],
+}
+
+
+def measure(payload, number, rounds):
+    body = dumps(payload)
+    encode = min(repeat(lambda: dumps(payload), number=number, repeat=rounds)) / number
+    decode = min(repeat(lambda: loads(body, eval_strings=False), number=number, repeat=rounds)) / number
+    return len(body), encode, decode
+
+
+def run(number=10, rounds=5):
+    for name, payload in sorted(PAYLOADS.items()):
+        results = [('string', measure(payload, number, rounds))]
+        register_encoder(Decimal, encode_decimal_binary)
+        try:
+            results.append(('binary', measure(payload, number, rounds)))
+        finally:
+            unregister_encoder(Decimal)
+        for encoding, (size, encode, decode) in results:
+            print('{:<16} {:<8} {:>8} bytes  dumps {:7.2f} ms  loads {:7.2f} ms'.format(
+                name, encoding, size, encode * 1000, decode * 1000))
+
+
+if __name__ == '__main__':
+    run()
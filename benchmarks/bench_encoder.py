@@ -0,0 +1,83 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#  bench_encoder.py
+#
+#  Compare the type-dispatch encoder against the former hasattr/isinstance chain.
+#  Usage: python -m benchmarks.bench_encoder
+#
+from __future__ import print_function, unicode_literals
+
+from datetime import datetime, date, time, timedelta
+from decimal import Decimal
+from timeit import repeat
+
+from aenum import Enum, Constant
+from django.db.models import Model, QuerySet
+from msgpack import packb, ExtType
+from six import ensure_binary
+
+from nameko_django import serializer
+
+
+def chain_encode_nondefault_object(obj):
+    """ The hasattr/isinstance chain used before the dispatch table, kept as the baseline """
+    if obj is None:
+        return
+    if hasattr(obj, '_asdict') and callable(obj._asdict):
+        return dict(obj._asdict())
+    elif hasattr(obj, 'to_dict') and callable(obj.to_dict):
+        return dict(obj.to_dict())
+    elif hasattr(obj, 'to_list') and callable(obj.to_list):
+        return list(obj.to_list())
+    elif isinstance(obj, dict):
+        return dict(obj)
+    elif isinstance(obj, (tuple, set, list)):
+        return list(obj)
+    elif isinstance(obj, Enum) and hasattr(obj, 'value'):
+        return obj.value
+    elif isinstance(obj, Constant) and hasattr(obj, '_value_'):
+        return obj._value_
+    elif isinstance(obj, Decimal):
+        return ExtType(serializer.ExternalType.DECIMAL, ensure_binary(str(obj)))
+    elif isinstance(obj, datetime):
+        return obj.strftime(serializer.DEFAULT_DATETIME_TIMEZONE_STRING_FORMAT)
+    elif isinstance(obj, date):
+        return obj.strftime(serializer.DEFAULT_DATE_STRING_FORMAT)
+    elif isinstance(obj, time):
+        return obj.strftime(serializer.DEFAULT_TIME_STRING_FORMAT)
+    elif isinstance(obj, timedelta):
+        if 0 <= obj.total_seconds() < 86400:
+            return '+{}'.format(obj)
+        return str(obj)
+    else:
+        if isinstance(obj, Model):
+            return ExtType(serializer.ExternalType.ORM_INSTANCE, serializer.pickle.dumps(obj, -1))
+        elif isinstance(obj, QuerySet):
+            return ExtType(serializer.ExternalType.ORM_QUERYSET,
+                           serializer.pickle.dumps((obj.model, obj.query), -1))
+    return obj
+
+
+PAYLOADS = {
+    'decimal-heavy': [{'price': Decimal('1234.5678'), 'qty': Decimal(i), 'fee': Decimal('0.0025')}
+                      for i in range(2000)],
+    'datetime-heavy': [{'created': datetime(2019, 9, 26, 9, 16, 35, i), 'day': date(2019, 9, 26),
+                        'at': time(9, 16, 35), 'took': timedelta(seconds=i)}
+                       for i in range(2000)],
+}
+
+
+def run(number=20, rounds=5):
+    for name, payload in sorted(PAYLOADS.items()):
+        assert packb(payload, strict_types=True, default=chain_encode_nondefault_object, use_bin_type=True) == \
+            serializer.dumps(payload)
+        chain = min(repeat(lambda: packb(payload, strict_types=True, default=chain_encode_nondefault_object,
+                                         use_bin_type=True), number=number, repeat=rounds)) / number
+        dispatch = min(repeat(lambda: serializer.dumps(payload), number=number, repeat=rounds)) / number
+        print('{:<16} chain {:8.2f} ms  dispatch {:8.2f} ms  speedup x{:.2f}'.format(
+            name, chain * 1000, dispatch * 1000, chain / dispatch))
+
+
+if __name__ == '__main__':
+    run()
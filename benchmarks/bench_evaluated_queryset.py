@@ -0,0 +1,69 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#  bench_evaluated_queryset.py
+#
+#  Measure the payload size, the encoding time and the peak memory of the producer for a result set sent as
+#  a list of instances, a record batch and an EvaluatedQuerySet, sent whole by dumps or streamed by iter_dumps,
+#  and the decoding time of each.
+#  Usage: python -m benchmarks.bench_evaluated_queryset
+#
+from __future__ import print_function, unicode_literals
+
+import tracemalloc
+from timeit import default_timer
+
+from benchmarks.django_setup import setup_django
+
+setup_django(create_tables=True)
+
+from django.contrib.auth.models import User  # noqa: E402
+from django.utils import timezone  # noqa: E402
+
+from nameko_django.serializer import dumps, loads, iter_dumps, EvaluatedQuerySet, RecordBatch  # noqa: E402
+
+
+def measure(fn):
+    """ :return: the result of fn, its duration and its peak allocated bytes, measured by a second call """
+    start = default_timer()
+    result = fn()
+    elapsed = default_timer() - start
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def drain(evaluated):
+    """ Stream an EvaluatedQuerySet as a producer sending each chunk once packed """
+    for chunk in iter_dumps(evaluated):
+        pass
+
+
+def run():
+    now = timezone.now()
+    created = 0
+    for rows in (1000, 10000, 50000):
+        User.objects.bulk_create([User(username='user_{}'.format(i), email='user_{}@example.com'.format(i),
+                                       date_joined=now) for i in range(created, rows)])
+        created = rows
+        for name, build, send in (
+                ('instances', lambda: list(User.objects.order_by('id')), dumps),
+                ('record batch', lambda: RecordBatch(list(User.objects.order_by('id'))), dumps),
+                ('rows', lambda: EvaluatedQuerySet(User.objects.order_by('id')), dumps),
+                ('from_db', lambda: EvaluatedQuerySet(User.objects.order_by('id'), instances=True), dumps),
+                ('streamed rows', lambda: EvaluatedQuerySet(User.objects.order_by('id')), drain),
+                ('streamed from_db', lambda: EvaluatedQuerySet(User.objects.order_by('id'), instances=True), drain)):
+            body, encoding, peak = measure(lambda: send(build()))
+            if send is drain:
+                body = b''.join(iter_dumps(build()))
+            start = default_timer()
+            loads(body)
+            decoding = default_timer() - start
+            print('{:>6} users {:>16} {:>9} bytes  encode {:8.1f} ms  peak {:7.1f} MB  decode {:8.1f} ms'.format(
+                rows, name, len(body), encoding * 1000, peak / 1e6, decoding * 1000))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,47 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#  bench_instance_cache.py
+#
+#  Compare decoding reference-heavy messages with and without the instance cache.
+#  Usage: python -m benchmarks.bench_instance_cache
+#
+from __future__ import print_function, unicode_literals
+
+from timeit import repeat
+
+from benchmarks.django_setup import setup_django
+
+setup_django(create_tables=True)
+
+from django.contrib.auth.models import User  # noqa: E402
+
+from nameko_django.helper import DjangoORM  # noqa: E402
+from nameko_django.serializer import dumps, loads, instance_cache  # noqa: E402
+
+
+def run(users=200, references=20, number=200, rounds=5):
+    User.objects.bulk_create([User(username='user_{}'.format(i)) for i in range(users)])
+    pks = list(User.objects.values_list('pk', flat=True))
+    # each message references a few users among all of them, as the orders of a few accounts would
+    bodies = [dumps([DjangoORM(User, pks[(i * 7 + j * 13) % users]) for j in range(references)])
+              for i in range(number)]
+
+    def decode_all():
+        for body in bodies:
+            loads(body)
+
+    uncached = min(repeat(decode_all, number=1, repeat=rounds)) / number
+    instance_cache.configure(User, max_count=users, ttl=60)
+    try:
+        cached = min(repeat(decode_all, number=1, repeat=rounds)) / number
+        stats = instance_cache.stats()['auth.User']
+    finally:
+        instance_cache.remove(User)
+    print('{} references per message'.format(references))
+    print('no cache        loads {:8.3f} ms'.format(uncached * 1000))
+    print('instance cache  loads {:8.3f} ms  hit rate {:.1%}'.format(cached * 1000, stats['hit_rate']))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,51 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#  bench_lazy.py
+#
+#  Measure the latency of reading one field of replies of growing size, decoded as a whole and with loads(lazy=True).
+#  Usage: python -m benchmarks.bench_lazy
+#
+from __future__ import print_function, unicode_literals
+
+from datetime import datetime
+from decimal import Decimal
+from timeit import repeat
+
+try:
+    from datetime import timezone
+    utc = timezone.utc
+except ImportError:  # python 2
+    from django.utils.timezone import utc
+
+from benchmarks.django_setup import setup_django
+
+setup_django()
+
+
+from nameko_django.serializer import dumps, loads  # noqa: E402
+
+
+def reply(rows):
+    return {'status': 'ok', 'count': rows,
+            'rows': [{'id': i, 'name': 'customer {}'.format(i), 'balance': Decimal(i) / 4,
+                      'joined': datetime(2019, 9, 26, 9, 16, 35, i, tzinfo=utc)} for i in range(rows)]}
+
+
+def best(fn, number):
+    return min(repeat(fn, number=number, repeat=3)) / number
+
+
+def run():
+    for rows in (100, 1000, 10000, 100000):
+        body = dumps(reply(rows))
+        number = max(1, 100000 // rows)
+        eager = best(lambda: loads(body)['status'], number)
+        lazy = best(lambda: loads(body, lazy=True)['status'], number)
+        last = best(lambda: loads(body, lazy=True)['rows'][-1]['joined'], number)
+        print('{:>7} rows {:>9} bytes  eager {:9.3f} ms  lazy {:7.3f} ms  lazy last row {:7.3f} ms'.format(
+            rows, len(body), eager * 1000, lazy * 1000, last * 1000))
+
+
+if __name__ == '__main__':
+    run()
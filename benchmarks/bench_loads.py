@@ -0,0 +1,43 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#  bench_loads.py
+#
+#  Compare loads with every string evaluated against loads with string evaluation off or limited to key paths.
+#  Usage: python -m benchmarks.bench_loads
+#
+from __future__ import print_function, unicode_literals
+
+from datetime import datetime
+from timeit import repeat
+
+from nameko_django.serializer import dumps, loads, EvalPaths
+
+TEXT = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore.'
+
+PAYLOADS = {
+    'text-heavy': [{'title': 'Item {}'.format(i), 'description': TEXT, 'tags': ['alpha', 'beta', 'gamma'],
+                    'comment': TEXT[:40], 'created': datetime(2019, 9, 26, 9, 16, 35, i)}
+                   for i in range(2000)],
+}
+
+MODES = [
+    ('eval all', True),
+    ('eval off', False),
+    ('eval paths', EvalPaths('*.created')),
+]
+
+
+def run(number=20, rounds=5):
+    for name, payload in sorted(PAYLOADS.items()):
+        body = dumps(payload)
+        baseline = None
+        for mode, eval_strings in MODES:
+            timing = min(repeat(lambda: loads(body, eval_strings=eval_strings), number=number, repeat=rounds))
+            timing /= number
+            baseline = baseline or timing
+            print('{:<12} {:<12} {:8.2f} ms  speedup x{:.2f}'.format(name, mode, timing * 1000, baseline / timing))
+
+
+if __name__ == '__main__':
+    run()
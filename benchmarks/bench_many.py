@@ -0,0 +1,68 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#  bench_many.py
+#
+#  Measure the throughput per message of loads_many / dumps_many against loads / dumps called in a loop,
+#  for batches of messages each referencing an ORM instance, and the number of queries run per batch.
+#  Usage: python -m benchmarks.bench_many
+#
+from __future__ import print_function, unicode_literals
+
+from datetime import datetime
+from decimal import Decimal
+from timeit import repeat
+
+from benchmarks.django_setup import setup_django
+
+setup_django(create_tables=True)
+
+from django.contrib.auth.models import User  # noqa: E402
+from django.db import connection  # noqa: E402
+
+from nameko_django.helper import DjangoORM  # noqa: E402
+from nameko_django.serializer import dumps, loads, dumps_many, loads_many  # noqa: E402
+
+USERS = 1000
+
+
+def message(i):
+    return {'event': 'order_created', 'user': DjangoORM(User, i % USERS + 1), 'amount': Decimal(i) / 4,
+            'created_at': datetime(2019, 9, 26, 9, 16, 35, i % 1000000), 'lines': [{'sku': i, 'quantity': 2}]}
+
+
+def best(fn, number):
+    return min(repeat(fn, number=number, repeat=3)) / number
+
+
+def count_queries(fn):
+    count = [0]
+
+    def counter(execute, sql, params, many, context):
+        count[0] += 1
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(counter):
+        fn()
+    return count[0]
+
+
+def run():
+    User.objects.bulk_create([User(username='user_{}'.format(i)) for i in range(USERS)])
+    for size in (100, 1000, 10000):
+        objs = [message(i) for i in range(size)]
+        bodies = dumps_many(objs)
+        number = max(1, 1000 // size)
+        dumps_loop = best(lambda: [dumps(o) for o in objs], number) / size
+        dumps_batch = best(lambda: dumps_many(objs), number) / size
+        loads_loop = best(lambda: [loads(body) for body in bodies], number) / size
+        loads_batch = best(lambda: loads_many(bodies), number) / size
+        print('{:>6} messages  dumps {:6.1f} us  dumps_many {:6.1f} us  loads {:6.1f} us ({:>5} queries)  '
+              'loads_many {:6.1f} us ({} queries)'.format(
+                  size, dumps_loop * 1e6, dumps_batch * 1e6,
+                  loads_loop * 1e6, count_queries(lambda: [loads(body) for body in bodies]),
+                  loads_batch * 1e6, count_queries(lambda: loads_many(bodies))))
+
+
+if __name__ == '__main__':
+    run()
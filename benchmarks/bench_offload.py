@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#  bench_offload.py
+#
+#  Measure the latency of small concurrent RPCs while big payloads are encoded and decoded in the same process,
+#  inline in the eventlet hub and offloaded to tpool threads.
+#  Usage: python -m benchmarks.bench_offload [seconds per mode, 3 by default]
+#
+from __future__ import print_function, unicode_literals
+
+import eventlet
+
+eventlet.monkey_patch()  # as nameko run does
+
+import multiprocessing  # noqa: E402
+import sys  # noqa: E402
+from concurrent.futures import ProcessPoolExecutor  # noqa: E402
+from decimal import Decimal  # noqa: E402
+from timeit import default_timer  # noqa: E402
+
+from nameko_django.serializer import dumps, loads, enable_offload, enable_compression  # noqa: E402
+
+SMALL = {'id': 1, 'name': 'customer', 'balance': Decimal('12.50')}
+INTERVAL = 0.002
+
+
+def small_rpcs(latencies, deadline):
+    while default_timer() < deadline:
+        start = default_timer()
+        eventlet.sleep(INTERVAL)
+        loads(dumps(SMALL))
+        latencies.append(default_timer() - start - INTERVAL)
+
+
+def big_payload(count=50000):
+    return [{'id': i, 'name': 'customer {}'.format(i), 'balance': Decimal(i) / 4, 'tags': ['retail', 'emea'],
+             'joined': '2019-09-26 09:16:35.{:06d}+00:00'.format(i % 1000000)} for i in range(count)]
+
+
+def big_rpcs(big, counts, deadline):
+    while default_timer() < deadline:
+        loads(dumps(big))
+        counts.append(1)
+        eventlet.sleep(0)
+
+
+def percentile(values, fraction):
+    return sorted(values)[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def measure(big, seconds, concurrency=20):
+    latencies, counts = [], []
+    deadline = default_timer() + seconds
+    pool = eventlet.GreenPool()
+    pool.spawn(big_rpcs, big, counts, deadline)
+    for _ in range(concurrency):
+        pool.spawn(small_rpcs, latencies, deadline)
+    pool.waitall()
+    return latencies, len(counts) / float(seconds)
+
+
+def run(seconds=3.0):
+    big = big_payload()
+    print('big payload: {} bytes'.format(len(dumps(big))))
+    # spawned rather than forked: forking once tpool threads are running may deadlock
+    executor = ProcessPoolExecutor(2, mp_context=multiprocessing.get_context('spawn'))
+    list(executor.map(abs, range(2)))  # start the workers before measuring
+    modes = [
+        ('inline', lambda: None),
+        ('tpool', lambda: enable_offload()),
+        ('tpool + zlib in processes', lambda: (enable_compression(), enable_offload(executor=executor))),
+    ]
+    try:
+        for name, setup in modes:
+            setup()
+            latencies, big_per_second = measure(big, seconds)
+            enable_offload(threshold=None, min_items=None)
+            enable_compression(threshold=None)
+            print('{:<28} small rpc latency p50 {:6.2f} ms  p99 {:6.2f} ms  max {:7.2f} ms  big {:5.2f}/s'.format(
+                name, percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000,
+                max(latencies) * 1000, big_per_second))
+    finally:
+        executor.shutdown()
+
+
+if __name__ == '__main__':
+    run(*[float(arg) for arg in sys.argv[1:]])
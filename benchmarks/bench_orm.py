@@ -0,0 +1,63 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#  bench_orm.py
+#
+#  Compare the pickled ORM instance encoding against the compact field-tuple encoding.
+#  Usage: python -m benchmarks.bench_orm
+#
+from __future__ import print_function, unicode_literals
+
+from datetime import datetime, timedelta
+from timeit import repeat
+
+try:
+    from datetime import timezone
+    utc = timezone.utc
+except ImportError:  # python 2
+    from django.utils.timezone import utc
+
+from benchmarks.django_setup import setup_django
+
+setup_django()
+
+from django.contrib.auth.models import User  # noqa: E402
+from django.db.models import Model  # noqa: E402
+
+from nameko_django.serializer import dumps, loads, register_encoder, unregister_encoder, \
+    encode_orm_fields  # noqa: E402
+
+
+def make_users(count):
+    joined = datetime(2019, 9, 26, 9, 16, 35, tzinfo=utc)
+    users = []
+    for i in range(count):
+        user = User.from_db('default', [f.attname for f in User._meta.concrete_fields], [
+            i + 1, 'pbkdf2_sha256$150000$salt$hash', joined + timedelta(days=i), False,
+            'user_{}'.format(i), 'First', 'Last', 'user_{}@example.com'.format(i), False, True, joined])
+        users.append(user)
+    return users
+
+
+def measure(payload, number, rounds):
+    body = dumps(payload)
+    encode = min(repeat(lambda: dumps(payload), number=number, repeat=rounds)) / number
+    decode = min(repeat(lambda: loads(body), number=number, repeat=rounds)) / number
+    return len(body), encode, decode
+
+
+def run(count=1000, number=10, rounds=5):
+    payload = make_users(count)
+    results = [('pickle', measure(payload, number, rounds))]
+    register_encoder(Model, encode_orm_fields)
+    try:
+        results.append(('fields', measure(payload, number, rounds)))
+    finally:
+        unregister_encoder(Model)
+    for name, (size, encode, decode) in results:
+        print('{:<8} {:>9} bytes  dumps {:8.2f} ms  loads {:8.2f} ms'.format(
+            name, size, encode * 1000, decode * 1000))
+
+
+if __name__ == '__main__':
+    run()
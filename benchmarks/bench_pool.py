@@ -0,0 +1,36 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#  bench_pool.py
+#
+#  Compare dumps with a pooled Packer against a packb call per message, and loads of bytes against memoryview.
+#  Usage: python -m benchmarks.bench_pool
+#
+from __future__ import print_function, unicode_literals
+
+from decimal import Decimal
+from timeit import repeat
+
+from msgpack import packb
+
+from nameko_django.serializer import dumps, loads, encode_nondefault_object
+
+SMALL = {'id': 42, 'status': 'ok', 'price': Decimal('1.25'), 'tags': ['a', 'b']}
+LARGE = [b'x' * 1024] * (8 << 10)
+
+
+def run(number=20000, rounds=5):
+    packb_time = min(repeat(lambda: packb(SMALL, strict_types=True, default=encode_nondefault_object,
+                                          use_bin_type=True), number=number, repeat=rounds)) / number
+    pool_time = min(repeat(lambda: dumps(SMALL), number=number, repeat=rounds)) / number
+    print('small dumps   packb {:6.2f} us  pooled packer {:6.2f} us'.format(packb_time * 1e6, pool_time * 1e6))
+    body = dumps(LARGE)
+    view = memoryview(bytearray(body))
+    copy_time = min(repeat(lambda: loads(bytes(view), eval_strings=False), number=10, repeat=rounds)) / 10
+    view_time = min(repeat(lambda: loads(view, eval_strings=False), number=10, repeat=rounds)) / 10
+    print('{:.1f} MB loads  copied {:6.2f} ms  memoryview {:6.2f} ms'.format(
+        len(body) / 1e6, copy_time * 1000, view_time * 1000))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,41 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#  bench_queryset.py
+#
+#  Measure the decoding of pickled querysets with and without the decoded query cache,
+#  and the cost of pickling a query against compiling its SQL.
+#  Usage: python -m benchmarks.bench_queryset
+#
+from __future__ import print_function, unicode_literals
+
+from timeit import repeat
+
+from benchmarks.django_setup import setup_django
+
+setup_django()
+
+from django.contrib.auth.models import User  # noqa: E402
+
+from nameko_django import serializer  # noqa: E402
+
+
+def run(number=2000, rounds=5):
+    qs = User.objects.filter(is_active=True, id__gt=1000, groups__name='staff').order_by('-id')[:10]
+    body = serializer.dumps(qs)
+    pickling = min(repeat(lambda: serializer.dumps(qs), number=number, repeat=rounds)) / number
+    compiling = min(repeat(lambda: qs.query.sql_with_params(), number=number, repeat=rounds)) / number
+    print('encode   pickle {:7.1f} us  compile sql {:7.1f} us'.format(pickling * 1e6, compiling * 1e6))
+    cache = serializer.decoded_query_cache
+    max_count = cache.max_count
+    cache.configure(max_count=0)
+    uncached = min(repeat(lambda: serializer.loads(body), number=number, repeat=rounds)) / number
+    cache.configure(max_count=max_count)
+    cache.reset_stats()
+    cached = min(repeat(lambda: serializer.loads(body), number=number, repeat=rounds)) / number
+    print('decode   unpickle {:7.1f} us  cached {:7.1f} us  hit rate {:.3f}'.format(
+        uncached * 1e6, cached * 1e6, cache.hit_rate))
+
+
+if __name__ == '__main__':
+    run()
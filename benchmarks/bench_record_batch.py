@@ -0,0 +1,37 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#  bench_record_batch.py
+#
+#  Compare plain lists of dictionaries against columnar record batches: payload size and dumps/loads throughput.
+#  Usage: python -m benchmarks.bench_record_batch
+#
+from __future__ import print_function, unicode_literals
+
+from timeit import repeat
+
+from nameko_django.serializer import dumps, loads, RecordBatch
+
+ROWS = [{'id': i, 'symbol': 'SYM{}'.format(i % 50), 'quantity': i * 10, 'price': 100.0 + i / 8.0,
+         'side': 'buy' if i % 2 else 'sell', 'filled': bool(i % 3)}
+        for i in range(10000)]
+
+
+def measure(payload, number, rounds, **options):
+    body = dumps(payload, **options)
+    encode = min(repeat(lambda: dumps(payload, **options), number=number, repeat=rounds)) / number
+    decode = min(repeat(lambda: loads(body), number=number, repeat=rounds)) / number
+    return len(body), encode, decode
+
+
+def run(number=10, rounds=5):
+    for name, payload, options in [('list', ROWS, {}),
+                                   ('detected batch', ROWS, {'record_batch_min_rows': 100}),
+                                   ('RecordBatch', RecordBatch(ROWS), {})]:
+        size, encode, decode = measure(payload, number, rounds, **options)
+        print('{:<16} {:>9} bytes  dumps {:7.2f} ms ({:9.0f} rows/s)  loads {:7.2f} ms ({:9.0f} rows/s)'.format(
+            name, size, encode * 1000, len(ROWS) / encode, decode * 1000, len(ROWS) / decode))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,84 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#  corpus.py
+#
+#  The representative payloads measured by the benchmark suite.
+#  Django must be set up (benchmarks.django_setup.setup_django(create_tables=True)) before building them.
+#
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+from datetime import datetime, date, time, timedelta
+from decimal import Decimal
+
+try:
+    from datetime import timezone
+    utc = timezone.utc
+except ImportError:  # python 2
+    from django.utils.timezone import utc
+
+TEXT = ('Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore '
+        'et dolore magna aliqua.')
+
+
+def decimal_heavy(rows=1000):
+    return [{'price': Decimal('1234.5678') + i, 'quantity': Decimal(i) / 4, 'fee': Decimal('0.0025'),
+             'total': Decimal(1) / Decimal(i + 3)} for i in range(rows)]
+
+
+def datetime_heavy(rows=1000):
+    return [{'created': datetime(2019, 9, 26, 9, 16, 35, i, tzinfo=utc), 'day': date(2019, 9, 26),
+             'at': time(9, 16, 35, i), 'took': timedelta(seconds=i)} for i in range(rows)]
+
+
+def text_heavy(rows=1000):
+    return [{'title': 'Item {}'.format(i), 'description': TEXT, 'tags': ['alpha', 'beta', 'gamma'],
+             'comment': TEXT[:40]} for i in range(rows)]
+
+
+def nested_dicts(depth=6, width=4):
+    def node(level):
+        if level == depth:
+            return {'id': level, 'name': 'leaf', 'values': [1, 2.5, None, True]}
+        return dict(('child_{}'.format(i), node(level + 1)) for i in range(width))
+    return node(0)
+
+
+def _users(count):
+    from django.contrib.auth.models import User
+    users = list(User.objects.order_by('pk')[:count])
+    if len(users) < count:
+        User.objects.bulk_create([User(username='bench_user_{}'.format(i), email='user_{}@example.com'.format(i))
+                                  for i in range(len(users), count)])
+        users = list(User.objects.order_by('pk')[:count])
+    return users
+
+
+def model_instances(rows=200):
+    return _users(rows)
+
+
+def querysets(count=20):
+    from django.contrib.auth.models import User
+    return [User.objects.filter(is_active=True, id__gt=i, groups__name='staff').order_by('-id')[:10]
+            for i in range(count)]
+
+
+def references(rows=200):
+    from nameko_django.helper import DjangoORM
+    from django.contrib.auth.models import User
+    return [DjangoORM(User, user.pk) for user in _users(rows)]
+
+
+def build_corpus():
+    """ :return: an OrderedDict of payload name -> payload """
+    return OrderedDict([
+        ('decimal-heavy', decimal_heavy()),
+        ('datetime-heavy', datetime_heavy()),
+        ('text-heavy', text_heavy()),
+        ('nested-dicts', nested_dicts()),
+        ('model-instances', model_instances()),
+        ('querysets', querysets()),
+        ('references', references()),
+    ])
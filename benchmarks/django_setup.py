@@ -0,0 +1,33 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#  django_setup.py
+#
+#  An in-memory SQLite Django setup shared by the benchmarks.
+#
+from __future__ import unicode_literals
+
+import django
+from django.conf import settings
+
+BENCHMARK_SETTINGS = dict(
+    INSTALLED_APPS=('django.contrib.auth', 'django.contrib.contenttypes',),
+    DATABASES=dict(default={'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}),
+    USE_TZ=True,
+    TIME_ZONE='UTC',
+)
+
+
+def setup_django(create_tables=False, database_name=':memory:'):
+    """ Configure Django with an in-memory SQLite database, once per process
+
+    :param create_tables: also create the tables of the installed apps
+    :param database_name: the path of a SQLite file to use instead
+    """
+    if not settings.configured:
+        settings.configure(**dict(BENCHMARK_SETTINGS, DATABASES=dict(default=dict(
+            BENCHMARK_SETTINGS['DATABASES']['default'], NAME=database_name))))
+        django.setup()
+    if create_tables:
+        from django.core.management import call_command
+        call_command('migrate', run_syncdb=True, verbosity=0)
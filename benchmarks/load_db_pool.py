@@ -0,0 +1,118 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#  load_db_pool.py
+#
+#  Run many concurrent workers querying a SQLite file through a nameko container and report the number of
+#  database connections opened and simultaneously open, without DjangoDB, with it and with a pool.
+#  Usage: python -m benchmarks.load_db_pool [max_workers, 200 by default]
+#
+from __future__ import print_function, unicode_literals
+
+import eventlet
+
+eventlet.monkey_patch()  # as nameko run does
+
+import os  # noqa: E402
+import shutil  # noqa: E402
+import sys  # noqa: E402
+import tempfile  # noqa: E402
+from timeit import default_timer  # noqa: E402
+
+from benchmarks.django_setup import setup_django  # noqa: E402
+
+DIRECTORY = tempfile.mkdtemp()
+setup_django(create_tables=True, database_name=os.path.join(DIRECTORY, 'load.sqlite3'))
+
+from django.contrib.auth.models import User  # noqa: E402
+from django.db.backends.signals import connection_created  # noqa: E402
+from django.db.backends.sqlite3.base import DatabaseWrapper  # noqa: E402
+from nameko.containers import ServiceContainer  # noqa: E402
+from nameko.extensions import Entrypoint  # noqa: E402
+from nameko.testing.services import dummy  # noqa: E402
+from nameko.testing.utils import get_extension  # noqa: E402
+
+from nameko_django.dependencies import DjangoDB  # noqa: E402
+
+
+class ConnectionCounter(object):
+
+    def __init__(self):
+        self.opened = self.open = self.peak = 0
+
+    def created(self, sender, connection, **kwargs):
+        self.opened += 1
+        self.open += 1
+        self.peak = max(self.peak, self.open)
+
+    def closed(self):
+        self.open -= 1
+
+
+counter = ConnectionCounter()
+connection_created.connect(counter.created)
+_close = DatabaseWrapper._close
+
+
+def _counting_close(self):
+    if self.connection is not None:
+        counter.closed()
+    _close(self)
+
+
+DatabaseWrapper._close = _counting_close
+
+
+def make_service(provider):
+    class Service(object):
+        name = 'service'
+
+        @dummy
+        def count(self):
+            count = User.objects.count()
+            eventlet.sleep(0.001)  # let the other workers run meanwhile
+            return count
+
+    if provider is not None:
+        Service.db = provider
+    return Service
+
+
+def call(container, entrypoint):
+    done = eventlet.event.Event()
+
+    def handle_result(worker_ctx, result, exc_info):
+        done.send(exc_info)
+        return result, exc_info
+
+    container.spawn_worker(entrypoint, (), {}, handle_result=handle_result)
+    exc_info = done.wait()
+    if exc_info is not None:
+        raise exc_info[1]
+
+
+def run(max_workers=200, calls=2000, pool_size=10):
+    User.objects.bulk_create([User(username='user_{}'.format(i)) for i in range(100)])
+    print('{} calls, max_workers={}'.format(calls, max_workers))
+    for name, provider in [('no DjangoDB', None), ('DjangoDB()', DjangoDB()),
+                           ('DjangoDB(pool_size={})'.format(pool_size), DjangoDB(pool_size=pool_size))]:
+        container = ServiceContainer(make_service(provider), {'max_workers': max_workers})
+        container.start()
+        counter.__init__()
+        start = default_timer()
+        entrypoint = get_extension(container, Entrypoint, method_name='count')
+        pool = eventlet.GreenPool(max_workers)
+        for _ in range(calls):
+            pool.spawn(call, container, entrypoint)
+        pool.waitall()
+        container.stop()
+        elapsed = default_timer() - start
+        print('{:<22} opened {:>5}  peak open {:>4}  left open {:>5}  {:7.0f} calls/s'.format(
+            name, counter.opened, counter.peak, counter.open, calls / elapsed))
+
+
+if __name__ == '__main__':
+    try:
+        run(*[int(arg) for arg in sys.argv[1:]])
+    finally:
+        shutil.rmtree(DIRECTORY)
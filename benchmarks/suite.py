@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#  suite.py
+#
+#  Run dumps/loads over the corpus and report ops/sec, bytes per payload and allocations,
+#  next to plain msgpack packing/unpacking the same bytes without any hook as a baseline.
+#  Results are saved as JSON and compared against a previous run to flag regressions.
+#
+from __future__ import print_function, unicode_literals
+
+import json
+import platform
+import sys
+from timeit import repeat
+
+from msgpack import packb, unpackb
+
+try:
+    import tracemalloc
+except ImportError:  # python 2
+    tracemalloc = None
+
+DEFAULT_THRESHOLD = 0.1
+
+
+def ops_per_sec(fn, min_time=0.2, rounds=5):
+    number = 1
+    while True:
+        elapsed = min(repeat(fn, number=number, repeat=1))
+        if elapsed >= min_time / rounds:
+            break
+        number *= 2
+    return number / min(repeat(fn, number=number, repeat=rounds))
+
+
+def allocations(fn):
+    """ :return: (number of memory blocks still held by the result, peak traced bytes) of one call of fn """
+    if tracemalloc is None:
+        return None, None
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        result = fn()
+        after = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    del result
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename') if stat.count_diff > 0)
+    return blocks, peak
+
+
+def measure(payload, min_time=0.2, rounds=5):
+    from nameko_django.serializer import dumps, loads
+    body = dumps(payload)
+    plain = unpackb(body, raw=False, strict_map_key=False)  # the same bytes with the ext types left opaque
+    dumps_allocs, dumps_peak = allocations(lambda: dumps(payload))
+    loads_allocs, loads_peak = allocations(lambda: loads(body))
+    return dict(
+        bytes=len(body),
+        dumps_ops=ops_per_sec(lambda: dumps(payload), min_time, rounds),
+        loads_ops=ops_per_sec(lambda: loads(body), min_time, rounds),
+        msgpack_dumps_ops=ops_per_sec(lambda: packb(plain, use_bin_type=True), min_time, rounds),
+        msgpack_loads_ops=ops_per_sec(lambda: unpackb(body, raw=False, strict_map_key=False), min_time, rounds),
+        dumps_allocations=dumps_allocs,
+        dumps_peak_bytes=dumps_peak,
+        loads_allocations=loads_allocs,
+        loads_peak_bytes=loads_peak,
+    )
+
+
+def run(corpus, names=None, min_time=0.2, rounds=5):
+    results = {}
+    for name, payload in corpus.items():
+        if names and name not in names:
+            continue
+        results[name] = measure(payload, min_time, rounds)
+    return dict(python=platform.python_version(), implementation=platform.python_implementation(),
+                results=results)
+
+
+# metric -> True when a higher value is better
+METRICS = dict(dumps_ops=True, loads_ops=True, bytes=False, dumps_peak_bytes=False, loads_peak_bytes=False)
+
+
+def compare(previous, current, threshold=DEFAULT_THRESHOLD):
+    """ :return: a list of (payload name, metric, previous value, current value) worse by more than threshold """
+    regressions = []
+    for name, result in sorted(current['results'].items()):
+        old = previous['results'].get(name)
+        if not old:
+            continue
+        for metric, higher_is_better in sorted(METRICS.items()):
+            before, after = old.get(metric), result.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / float(before)
+            if (-change if higher_is_better else change) > threshold:
+                regressions.append((name, metric, before, after))
+    return regressions
+
+
+def report(results, out=sys.stdout):
+    print('{:<16} {:>9} {:>11} {:>11} {:>11} {:>11} {:>11} {:>11}'.format(
+        'payload', 'bytes', 'dumps/s', 'msgpack/s', 'loads/s', 'msgpack/s', 'dumps peak', 'loads peak'), file=out)
+    for name, r in sorted(results['results'].items()):
+        print('{:<16} {:>9} {:>11.0f} {:>11.0f} {:>11.0f} {:>11.0f} {:>11} {:>11}'.format(
+            name, r['bytes'], r['dumps_ops'], r['msgpack_dumps_ops'], r['loads_ops'], r['msgpack_loads_ops'],
+            r['dumps_peak_bytes'], r['loads_peak_bytes']), file=out)
+
+
+def save(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,198 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#  cache.py
+#
+#  Copyright (c) 2021 nameko-django. All rights reserved.
+#
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+from threading import Lock
+from six import PY3
+import sys
+import time
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+
+def allocate_lock():
+    """ A lock which works between real threads even once eventlet monkey patched threading,
+    the caches are also used from eventlet.tpool threads when decoding is offloaded (see enable_offload)
+    """
+    patcher = sys.modules.get('eventlet.patcher')
+    if patcher is not None:
+        return patcher.original('_thread' if PY3 else 'thread').allocate_lock()
+    return Lock()
+
+
+class LRUCache(object):
+    """ A least recently used cache bounded by a number of entries and by the total size of the entries
+
+    Every entry is stored with its size (1 by default), the least recently used entries are evicted
+    once there are more than max_count entries or their sizes add up to more than max_size.
+    With a ttl, an entry older than ttl seconds is dropped when it is looked up.
+    """
+
+    def __init__(self, max_count=1024, max_size=None, ttl=None, clock=_monotonic):
+        self.max_count = max_count
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = allocate_lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        entry = self._entries.get(key)
+        return entry is not None and (entry[2] is None or entry[2] > self.clock())
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                entry = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if entry[2] is not None and entry[2] <= self.clock():
+                self.size -= entry[1]
+                self.evictions += 1
+                self.misses += 1
+                return default
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, size=1):
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+            if (self.max_size is not None and size > self.max_size) or not self.max_count:
+                return
+            self._entries[key] = (value, size, None if self.ttl is None else self.clock() + self.ttl)
+            self.size += size
+            self._evict()
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            self.size -= entry[1]
+            return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def configure(self, max_count=None, max_size=None):
+        """ Change the bounds of the cache, evicting entries if needed """
+        with self._lock:
+            if max_count is not None:
+                self.max_count = max_count
+            if max_size is not None:
+                self.max_size = max_size
+            self._evict()
+
+    def _evict(self):
+        entries = self._entries
+        while entries and (len(entries) > self.max_count or
+                           (self.max_size is not None and self.size > self.max_size)):
+            self.size -= entries.popitem(last=False)[1][1]
+            self.evictions += 1
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def stats(self):
+        return dict(count=len(self._entries), size=self.size, hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, hit_rate=self.hit_rate)
+
+    def reset_stats(self):
+        self.hits = self.misses = self.evictions = 0
+
+
+class InstanceCache(object):
+    """ A process-local cache of the model instances decoded from "<app_label.Model.pk>" references
+
+    Only the models added with configure() are cached, each one in its own LRUCache. An instance is dropped when it
+    is saved or deleted in this process (post_save/post_delete signals), and after ttl seconds at the latest
+    for the changes made by other processes. Each lookup builds a new instance from the cached row,
+    so the consumers never share an instance.
+    """
+
+    def __init__(self):
+        self.caches = {}
+        self._connected = False
+
+    def configure(self, model, max_count=1024, ttl=60):
+        """ Cache the instances of a model, replacing its previous cache
+
+        :param model: the ORM model class
+        :param max_count: the maximum number of cached instances
+        :param ttl: the number of seconds an instance is served from the cache
+        """
+        if not self._connected:
+            from django.db.models.signals import post_save, post_delete
+            post_save.connect(self._invalidate, dispatch_uid=self._dispatch_uid)
+            post_delete.connect(self._invalidate, dispatch_uid=self._dispatch_uid)
+            self._connected = True
+        self.caches[model] = (LRUCache(max_count=max_count, ttl=ttl),
+                              [field.attname for field in model._meta.concrete_fields])
+
+    def remove(self, model):
+        """ Stop caching the instances of a model """
+        self.caches.pop(model, None)
+
+    def clear(self):
+        for cache, attnames in self.caches.values():
+            cache.clear()
+
+    @property
+    def _dispatch_uid(self):
+        return 'nameko_django.cache.InstanceCache.{}'.format(id(self))
+
+    def get_many(self, model, pks):
+        """ :return: {pk: instance} of the cached pks """
+        entry = self.caches.get(model)
+        if entry is None:
+            return {}
+        cache, attnames = entry
+        instances = {}
+        for pk in pks:
+            row = cache.get(pk)
+            if row is not None:
+                instances[pk] = model.from_db(row[0], attnames, row[1])
+        return instances
+
+    def set_many(self, model, instances):
+        """ :param instances: {pk: instance} fetched from the database """
+        entry = self.caches.get(model)
+        if entry is None:
+            return
+        cache, attnames = entry
+        for pk, instance in instances.items():
+            cache.set(pk, (instance._state.db, [getattr(instance, attname) for attname in attnames]))
+
+    def _invalidate(self, sender, instance, **kwargs):
+        saved = instance.__class__._meta.concrete_model
+        for model, (cache, attnames) in list(self.caches.items()):
+            concrete = model._meta.concrete_model
+            # the proxies share the row of their concrete model, a multi-table child saves the rows of its parents
+            # and the row of a parent is part of its children
+            if issubclass(saved, concrete) or saved in concrete._meta.get_parent_list():
+                cache.pop(instance.pk)
+
+    def stats(self):
+        """ :return: {model label: LRUCache.stats()} """
+        return dict((model._meta.label, cache.stats()) for model, (cache, attnames) in self.caches.items())
@@ -0,0 +1,240 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#  dependencies.py
+#
+#  Copyright (c) 2021 nameko-django. All rights reserved.
+#
+from __future__ import unicode_literals
+
+from threading import Lock
+from timeit import default_timer
+
+from django.db import DEFAULT_DB_ALIAS, close_old_connections, connections
+from django.db.utils import OperationalError, load_backend
+from nameko.extensions import DependencyProvider
+from six.moves.queue import LifoQueue, Empty
+
+from . import metrics
+from .serializer import enable_metrics
+
+
+class SerializerMetrics(DependencyProvider):
+    """ Give the workers the registry of the serialization metrics, e.g. to expose it on an http entrypoint::
+
+        class Service(object):
+            name = 'service'
+            serializer_metrics = SerializerMetrics()
+
+            @http('GET', '/metrics')
+            def metrics(self, request):
+                return self.serializer_metrics.render()
+
+    :param registry: a MetricsRegistry, nameko_django.metrics.registry by default
+    :param enable: start recording the metrics into the registry when the service is set up
+    """
+
+    def __init__(self, registry=None, enable=True):
+        self.registry = registry
+        self.enable = enable
+
+    def setup(self):
+        if self.registry is None:
+            self.registry = metrics.registry
+        if self.enable:
+            enable_metrics(self.registry)
+
+    def get_dependency(self, worker_ctx):
+        return self.registry
+
+
+class ConnectionPoolTimeout(OperationalError):
+    pass
+
+
+def _new_connection(alias):
+    create_connection = getattr(connections, 'create_connection', None)
+    if create_connection is not None:
+        return create_connection(alias)
+    # django < 3.2
+    connections.ensure_defaults(alias)
+    connections.prepare_test_settings(alias)
+    settings_dict = connections.databases[alias]
+    return load_backend(settings_dict['ENGINE']).DatabaseWrapper(settings_dict, alias)
+
+
+def _allow_thread_sharing(connection):
+    if hasattr(connection, 'inc_thread_sharing'):
+        connection.inc_thread_sharing()
+    else:  # django < 2.2
+        connection.allow_thread_sharing = True
+
+
+def _unavailable_connection(alias, error):
+    """ A connection raising error as soon as it is used """
+    connection = _new_connection(alias)
+
+    def connect():
+        raise error
+
+    connection.connect = connect
+    return connection
+
+
+class ConnectionPool(object):
+    """ A bounded pool of connections to a database, shared by the worker greenthreads
+
+    At most max_size connections are opened, the most recently released one is handed out first.
+
+    :param alias: the database alias
+    :param max_size: the maximum number of connections
+    :param timeout: the number of seconds to wait for a connection to be released, None to wait forever
+    """
+
+    def __init__(self, alias=DEFAULT_DB_ALIAS, max_size=10, timeout=30):
+        self.alias = alias
+        self.max_size = max_size
+        self.timeout = timeout
+        self.created = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.waits = 0
+        self.timeouts = 0
+        self._idle = LifoQueue()
+        for _ in range(max_size):
+            self._idle.put(None)  # a connection yet to be opened
+        self._lock = Lock()
+
+    def acquire(self):
+        """ :return: a connection, raise ConnectionPoolTimeout when none was released in time """
+        if self._idle.empty():
+            with self._lock:
+                self.waits += 1
+        try:
+            connection = self._idle.get(timeout=self.timeout)
+        except Empty:
+            with self._lock:
+                self.timeouts += 1
+            raise ConnectionPoolTimeout('no connection to the database {!r} was released within {} seconds'.format(
+                self.alias, self.timeout))
+        if connection is None:
+            try:
+                connection = _new_connection(self.alias)
+            except Exception:
+                self._idle.put(None)
+                raise
+            _allow_thread_sharing(connection)  # used by one greenthread at a time
+            if not connection.settings_dict.get('CONN_MAX_AGE'):
+                # the pool keeps the connection open, only a positive CONN_MAX_AGE bounds its age
+                connection.settings_dict = dict(connection.settings_dict, CONN_MAX_AGE=None)
+            with self._lock:
+                self.created += 1
+        with self._lock:
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+        return connection
+
+    def release(self, connection):
+        """ Give back a connection, it is closed when it is unusable, obsolete or left in a transaction """
+        try:
+            if connection.in_atomic_block:
+                connection.close()
+                connection = None  # its state can not be trusted any more
+            else:
+                connection.close_if_unusable_or_obsolete()
+        finally:
+            with self._lock:
+                self.in_use -= 1
+            self._idle.put(connection)
+
+    def close(self):
+        """ Close the idle connections """
+        idle = []
+        while True:
+            try:
+                idle.append(self._idle.get_nowait())
+            except Empty:
+                break
+        for connection in idle:
+            if connection is not None:
+                connection.close()
+            self._idle.put(None)
+
+    def stats(self):
+        return dict(max_size=self.max_size, in_use=self.in_use, peak_in_use=self.peak_in_use, created=self.created,
+                    waits=self.waits, timeouts=self.timeouts)
+
+
+class DjangoDB(DependencyProvider):
+    """ Manage the Django database connections of the workers
+
+    Django keeps a connection per thread, and each nameko worker runs in its own greenthread: old connections are
+    closed (close_old_connections) when a worker starts and ends, and the connections opened by a worker are closed
+    once it is done instead of being leaked. With a pool_size, the workers borrow connections from a ConnectionPool
+    instead, so at most pool_size connections are opened whatever the max_workers::
+
+        class Service(object):
+            name = 'service'
+            db = DjangoDB(pool_size=10)
+
+            @rpc
+            def count_users(self):
+                return User.objects.count()
+
+    A worker which waited more than pool_timeout for a connection raises ConnectionPoolTimeout at its first query.
+    The workers get django.db.connections, e.g. ``self.db['default'].cursor()``.
+
+    :param using: the database alias
+    :param pool_size: the maximum number of connections of the pool, None to not pool the connections
+    :param pool_timeout: the number of seconds a worker waits for a pooled connection, None to wait forever
+    :param sink: a metrics sink (see nameko_django.metrics) recording the wait for a pooled connection
+    """
+
+    def __init__(self, using=DEFAULT_DB_ALIAS, pool_size=None, pool_timeout=30, sink=None):
+        self.using = using
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        self.sink = sink
+        self.pool = None
+        self.worker_connections = {}
+
+    def setup(self):
+        if self.pool_size:
+            self.pool = ConnectionPool(self.using, self.pool_size, self.pool_timeout)
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.close()
+
+    def kill(self):
+        self.stop()
+
+    def worker_setup(self, worker_ctx):
+        if self.pool is not None:
+            start = default_timer()
+            try:
+                connection = self.pool.acquire()
+                pooled = True
+            except ConnectionPoolTimeout as exc:
+                connection = _unavailable_connection(self.using, exc)
+                pooled = False
+                if self.sink is not None:
+                    self.sink.inc(metrics.DB_POOL_TIMEOUTS)
+            if self.sink is not None:
+                self.sink.observe(metrics.DB_POOL_WAIT_SECONDS, default_timer() - start)
+            self.worker_connections[worker_ctx] = (connection, pooled)
+            connections[self.using] = connection
+        close_old_connections()
+
+    def get_dependency(self, worker_ctx):
+        return connections
+
+    def worker_teardown(self, worker_ctx):
+        if self.pool is None:
+            connections.close_all()  # the connections of this worker greenthread
+            return
+        close_old_connections()
+        connection, pooled = self.worker_connections.pop(worker_ctx)
+        del connections[self.using]
+        if pooled:
+            self.pool.release(connection)
@@ -14,6 +14,8 @@ from django.db.models.base import ModelBase
 from six import string_types
 import re
 
+from .serializer import RawWhereQuerySet
+
 
 def DjangoORM(ORM_Model, pk):
     if not isinstance(ORM_Model, ModelBase):
@@ -21,7 +23,14 @@ def DjangoORM(ORM_Model, pk):
     return "<{}.{}.{}>".format(ORM_Model._meta.app_label, ORM_Model._meta.model.__name__, pk)
 
 
-def DjangoQS(ORM_Model, raw_query):
+def DjangoQS(ORM_Model, raw_query, params=None):
+    """ Reference a queryset of ORM_Model by a raw WHERE clause, to be evaluated by the consumer
+
+    :param ORM_Model: the ORM model class
+    :param raw_query: the raw WHERE clause, with %s placeholders when params are given
+    :param params: the values of the placeholders, sent apart from the clause, see RawWhereQuerySet
+    :return: a "(app_label.Model: WHERE)" string, or a RawWhereQuerySet when params is not None
+    """
     if not isinstance(ORM_Model, ModelBase):
         raise TypeError('%s must be a Django ORM Class of type django.db.models.base.ModelBase')
     if isinstance(raw_query, string_types):
@@ -29,4 +38,6 @@ def DjangoQS(ORM_Model, raw_query):
             raise ValueError('raw_query must not be empty nor start with SELECT')
     else:
         raise TypeError('raw_query must be a string type')
+    if params is not None:
+        return RawWhereQuerySet(ORM_Model, raw_query, params)
     return "({}.{}: {})".format(ORM_Model._meta.app_label, ORM_Model._meta.model.__name__, raw_query)
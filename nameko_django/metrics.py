@@ -0,0 +1,130 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#  metrics.py
+#
+#  Copyright (c) 2021 nameko-django. All rights reserved.
+#
+from __future__ import unicode_literals
+
+from bisect import bisect_left
+
+from .cache import allocate_lock
+
+DUMPS_SECONDS = 'nameko_django_dumps_seconds'
+LOADS_SECONDS = 'nameko_django_loads_seconds'
+PAYLOAD_BYTES = 'nameko_django_payload_bytes'
+EXT_TYPES = 'nameko_django_ext_types_total'
+STRING_EVALUATIONS = 'nameko_django_string_evaluations_total'
+DB_POOL_WAIT_SECONDS = 'nameko_django_db_pool_wait_seconds'
+DB_POOL_TIMEOUTS = 'nameko_django_db_pool_timeouts_total'
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+SIZE_BUCKETS = tuple(64 << (2 * i) for i in range(10))  # 64B to 16MB
+
+DEFAULT_BUCKETS = {
+    DUMPS_SECONDS: LATENCY_BUCKETS,
+    LOADS_SECONDS: LATENCY_BUCKETS,
+    PAYLOAD_BYTES: SIZE_BUCKETS,
+}
+
+
+class Histogram(object):
+    """ The number of observed values lower or equal to each bucket upper bound, their sum and their count """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one counts the values above every bound
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        total = 0
+        for count in self.counts:
+            total += count
+            yield total
+
+    def __repr__(self):
+        return 'Histogram(count={}, sum={})'.format(self.count, self.sum)
+
+
+class MetricsRegistry(object):
+    """ An in-process sink keeping counters and histograms in memory
+
+    A sink is any object with the ``inc(name, labels=(), amount=1)`` and ``observe(name, value, labels=())`` methods,
+    labels being a tuple of (label name, label value) pairs. Use a custom sink to forward the metrics elsewhere,
+    e.g. to a statsd client or a prometheus_client registry.
+
+    :param buckets: a dict of histogram name -> bucket upper bounds, overriding DEFAULT_BUCKETS
+    """
+
+    def __init__(self, buckets=None):
+        self.buckets = dict(DEFAULT_BUCKETS)
+        self.buckets.update(buckets or {})
+        self.counters = {}
+        self.histograms = {}
+        self._lock = allocate_lock()
+
+    def inc(self, name, labels=(), amount=1):
+        key = (name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, labels=()):
+        key = (name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets.get(name, LATENCY_BUCKETS))
+            histogram.observe(value)
+
+    def counter(self, name, **labels):
+        """ :return: the value of a counter, 0 when it was never incremented """
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def histogram(self, name, **labels):
+        """ :return: the Histogram of a metric, None when nothing was observed """
+        return self.histograms.get((name, tuple(sorted(labels.items()))))
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def render(self):
+        """ :return: the metrics in the Prometheus text exposition format """
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+            histograms = [(key, histogram.buckets, list(histogram.cumulative_counts()), histogram.sum)
+                          for key, histogram in histograms]
+        name = None
+        for (metric, labels), value in counters:
+            if metric != name:
+                name = metric
+                lines.append('# TYPE {} counter'.format(name))
+            lines.append('{}{} {}'.format(metric, _format_labels(labels), value))
+        for (metric, labels), buckets, counts, total in histograms:
+            if metric != name:
+                name = metric
+                lines.append('# TYPE {} histogram'.format(name))
+            for bound, count in zip(buckets + ('+Inf',), counts):
+                lines.append('{}_bucket{} {}'.format(metric, _format_labels(labels + (('le', bound),)), count))
+            lines.append('{}_sum{} {}'.format(metric, _format_labels(labels), total))
+            lines.append('{}_count{} {}'.format(metric, _format_labels(labels), counts[-1]))
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, value) for name, value in labels) + '}'
+
+
+registry = MetricsRegistry()
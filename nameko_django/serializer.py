@@ -11,20 +11,52 @@ from __future__ import unicode_literals
 
 from datetime import datetime, date, time, timedelta
 from decimal import Decimal, ROUND_HALF_EVEN, Context, Overflow, DivisionByZero, InvalidOperation
-from aenum import Enum, IntEnum, Constant
-from django.db.models import Model, QuerySet
-from django.db.models.base import ModelBase
-from django.db.models.sql.query import Query
-from django.utils import dateparse
-from msgpack import packb, unpackb, ExtType
-from six import string_types, ensure_str, ensure_binary
+import decimal
+from msgpack import packb, unpackb, Packer, Unpacker, ExtType, Timestamp, OutOfData, ExtraData
+from six import string_types, text_type, binary_type, integer_types, ensure_binary
+from inspect import getmro
+from itertools import islice, repeat
+from collections import namedtuple
+from timeit import default_timer
+from binascii import hexlify, unhexlify
 import re
+import struct
+import sys
+import zlib
 
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
 
+try:
+    from collections.abc import Mapping, Sequence
+except ImportError:
+    from collections import Mapping, Sequence
+
+try:
+    from enum import IntEnum
+except ImportError:
+    from aenum import IntEnum
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from . import metrics
+from .cache import LRUCache, InstanceCache
+
 import logging
 
 logger = logging.getLogger(__name__)
@@ -35,6 +67,10 @@ DEFAULT_DATETIME_TIMEZONE_STRING_FORMAT = "%Y-%m-%d %H:%M:%S.%f%z"
 DEFAULT_DECIMAL_CONTEXT = Context(prec=28, rounding=ROUND_HALF_EVEN, Emin=-999999, Emax=999999,
                                   capitals=1, flags=[], traps=[Overflow, DivisionByZero,
                                                                InvalidOperation])
+# a context which never rounds, used to scale the coefficient of binary decimals
+EXACT_DECIMAL_CONTEXT = Context(prec=getattr(decimal, 'MAX_PREC', 999999999999999999),
+                                Emin=getattr(decimal, 'MIN_EMIN', -999999999999999999),
+                                Emax=getattr(decimal, 'MAX_EMAX', 999999999999999999), traps=[])
 
 
 def pack(s):
@@ -45,67 +81,1047 @@ def unpack(s):
     return unpackb(s, raw=False)
 
 
+# idle packers configured with encode_nondefault_object, a packer is popped for the duration of a single pack call
+# so that concurrent (or nested) calls from other threads or greenlets never share one
+_packers = []
+# the same, counting the ext types they encode, used while the metrics are enabled
+_counting_packers = []
+
+
+def _pack_default(obj, counting=False):
+    packers = _counting_packers if counting else _packers
+    try:
+        packer = packers.pop()
+    except IndexError:
+        packer = Packer(strict_types=True, default=_encode_counted if counting else encode_nondefault_object,
+                        use_bin_type=True)
+    try:
+        data = packer.pack(obj)
+    except Exception:
+        packer.reset()  # drop whatever was packed before the failure
+        raise
+    finally:
+        packers.append(packer)
+    return data
+
+
+def _as_buffer(s):
+    """ Return s as an object msgpack can unpack without copying it when possible """
+    if isinstance(s, memoryview):
+        return s if s.contiguous else s.tobytes()
+    elif isinstance(s, (bytes, bytearray, string_types)):
+        return s
+    try:
+        memoryview(s)
+    except TypeError:
+        return bytes(s)
+    return s
+
+
 class ExternalType(IntEnum):
     DECIMAL = 42
     ORM_INSTANCE = 43
     ORM_QUERYSET = 44
+    ORM_FIELDS = 45
+    RECORD_BATCH = 46
+    NAIVE_DATETIME = 47
+    DATE = 48
+    TIME = 49
+    TIMEDELTA = 50
+    DECIMAL_BINARY = 51
+    COMPRESSED = 52
+    DEFINE = 53
+    BACK_REFERENCE = 54
+    EVALUATED_QUERYSET = 55
+    RAW_WHERE_QUERYSET = 56
+    EVALUATED_QUERYSET_STREAM = 57
+    EVALUATED_QUERYSET_CHUNK = 58
+
+
+def _encode_asdict(obj):
+    return dict(obj._asdict())
+
+
+def _encode_to_dict(obj):
+    return dict(obj.to_dict())
+
+
+def _encode_to_list(obj):
+    return list(obj.to_list())
+
+
+def _encode_enum(obj):
+    return obj.value
+
+
+def _encode_constant(obj):
+    return obj._value_
+
+
+def _encode_decimal(obj):
+    return ExtType(ExternalType.DECIMAL, str(obj).encode('ascii'))
+
+
+# compact binary decimals: an int8 exponent then the coefficient on 1, 2, 4 or 8 bytes, chosen by the payload size
+_decimal_structs = dict((struct_.size, struct_) for struct_ in (
+    struct.Struct('>bb'), struct.Struct('>bh'), struct.Struct('>bi'), struct.Struct('>bq')))
+# other decimals: an int32 exponent, the sign then the magnitude of the coefficient on at least 8 bytes
+_big_decimal_struct = struct.Struct('>iB')
+
+
+def encode_decimal_binary(obj):
+    """ Encode a Decimal as its exponent and integer coefficient instead of its string representation
+
+    NaN and Infinity are sent in the string format. Enable it with ``register_encoder(Decimal, encode_decimal_binary)``.
+
+    :param obj: a Decimal
+    :return: ExtType
+    """
+    sign, digits, exponent = obj.as_tuple()
+    if not isinstance(exponent, int):  # NaN, sNaN and Infinity
+        return _encode_decimal(obj)
+    coefficient = int(obj.scaleb(-exponent, EXACT_DECIMAL_CONTEXT))
+    if -128 <= exponent <= 127 and (coefficient or not sign):
+        if -128 <= coefficient <= 127:
+            return ExtType(ExternalType.DECIMAL_BINARY, _decimal_structs[2].pack(exponent, coefficient))
+        elif -32768 <= coefficient <= 32767:
+            return ExtType(ExternalType.DECIMAL_BINARY, _decimal_structs[3].pack(exponent, coefficient))
+        elif -2147483648 <= coefficient <= 2147483647:
+            return ExtType(ExternalType.DECIMAL_BINARY, _decimal_structs[5].pack(exponent, coefficient))
+        elif -9223372036854775808 <= coefficient <= 9223372036854775807:
+            return ExtType(ExternalType.DECIMAL_BINARY, _decimal_structs[9].pack(exponent, coefficient))
+    return ExtType(ExternalType.DECIMAL_BINARY,
+                   _big_decimal_struct.pack(exponent, sign) + _int_to_bytes(abs(coefficient)))
+
+
+def _decode_decimal_binary(data):
+    compact = _decimal_structs.get(len(data))
+    if compact is not None:
+        exponent, coefficient = compact.unpack(data)
+        return Decimal(coefficient).scaleb(exponent, EXACT_DECIMAL_CONTEXT)
+    exponent, sign = _big_decimal_struct.unpack_from(data)
+    value = Decimal(_int_from_bytes(data[_big_decimal_struct.size:])).scaleb(exponent, EXACT_DECIMAL_CONTEXT)
+    return value.copy_negate() if sign else value
+
+
+if hasattr(int, 'from_bytes'):
+    def _int_to_bytes(value):
+        return value.to_bytes(max(8, (value.bit_length() + 7) // 8), 'big')
+
+    def _int_from_bytes(data):
+        return int.from_bytes(data, 'big')
+else:
+    def _int_to_bytes(value):
+        magnitude = '{:016x}'.format(value)
+        return unhexlify('0' + magnitude if len(magnitude) % 2 else magnitude)
+
+    def _int_from_bytes(data):
+        return int(hexlify(data), 16)
+
+
+def _encode_datetime(obj):
+    return obj.strftime(DEFAULT_DATETIME_TIMEZONE_STRING_FORMAT)
+
+
+def _encode_date(obj):
+    return obj.strftime(DEFAULT_DATE_STRING_FORMAT)
+
+
+def _encode_time(obj):
+    return obj.strftime(DEFAULT_TIME_STRING_FORMAT)
+
+
+def _encode_timedelta(obj):
+    if 0 <= obj.total_seconds() < 86400:
+        return '+{}'.format(obj)
+    return str(obj)
+
+
+_naive_datetime_struct = struct.Struct('>HBBBBBI')
+_date_struct = struct.Struct('>I')
+_time_struct = struct.Struct('>BBBI')
+_aware_time_struct = struct.Struct('>BBBIh')
+_timedelta_struct = struct.Struct('>iiI')
+
+
+def encode_datetime_native(obj):
+    """ Encode an aware datetime as a msgpack Timestamp (converted to UTC), a naive one as a compact ext type """
+    if obj.utcoffset() is not None:
+        return Timestamp.from_datetime(obj)
+    return ExtType(ExternalType.NAIVE_DATETIME, _naive_datetime_struct.pack(
+        obj.year, obj.month, obj.day, obj.hour, obj.minute, obj.second, obj.microsecond))
+
+
+def encode_date_native(obj):
+    return ExtType(ExternalType.DATE, _date_struct.pack(obj.toordinal()))
+
+
+def encode_time_native(obj):
+    offset = obj.utcoffset()
+    if offset is None:
+        return ExtType(ExternalType.TIME, _time_struct.pack(obj.hour, obj.minute, obj.second, obj.microsecond))
+    return ExtType(ExternalType.TIME, _aware_time_struct.pack(
+        obj.hour, obj.minute, obj.second, obj.microsecond, (offset.days * 86400 + offset.seconds) // 60))
+
+
+def encode_timedelta_native(obj):
+    return ExtType(ExternalType.TIMEDELTA, _timedelta_struct.pack(obj.days, obj.seconds, obj.microseconds))
+
+
+def _decode_time_native(data):
+    if len(data) == _time_struct.size:
+        return time(*_time_struct.unpack(data))
+    from django.utils.timezone import get_fixed_timezone
+    hour, minute, second, microsecond, offset = _aware_time_struct.unpack(data)
+    return time(hour, minute, second, microsecond, tzinfo=get_fixed_timezone(offset))
+
+
+_native_datetime_encoders = {
+    datetime: encode_datetime_native,
+    date: encode_date_native,
+    time: encode_time_native,
+    timedelta: encode_timedelta_native,
+}
+
+
+def enable_native_datetime(enabled=True):
+    """ Switch the wire format of datetime, date, time and timedelta objects
+
+    When enabled, aware datetimes are sent as msgpack Timestamp and the others as compact ext types,
+    so they are decoded without any string parsing. loads accepts both formats, so services can migrate one by one:
+    enable it once all the consumers run a version which decodes it.
+
+    :param enabled: True for the binary format, False for the string format
+    """
+    for cls, encoder in _native_datetime_encoders.items():
+        if enabled:
+            register_encoder(cls, encoder)
+        elif _encoders.get(cls) is encoder:
+            unregister_encoder(cls)
+
+
+def _encode_orm_instance(obj):
+    return ExtType(ExternalType.ORM_INSTANCE, pickle.dumps(obj, -1))
+
+
+def _encode_orm_queryset(obj):
+    return ExtType(ExternalType.ORM_QUERYSET, pickle.dumps((obj.model, obj.query), -1))
+
+
+class RawWhereQuerySet(object):
+    """ The instances of a model matching a raw WHERE template, sent as the model label, the template and its params
+    and decoded with raw_where_queryset, rather than as the literal clause of a "(app_label.Model: WHERE)" string.
+
+    The SQL sent to the database is the same whatever the values, so it reuses the prepared statement
+    or the cached plan of the query shape, and the values are never pasted into the SQL.
+
+    :param model: the ORM model class or its "app_label.Model" label
+    :param where: the raw WHERE clause, using %s placeholders for params (and %% for a literal %)
+    :param params: the values of the placeholders
+    """
+    __slots__ = ('model', 'where', 'params')
+
+    def __init__(self, model, where, params=()):
+        self.model = model
+        self.where = where
+        self.params = params
+
+
+def _encode_query_param(obj):
+    # the params are passed to the database as they are, never as strings to be evaluated
+    encoder = _native_datetime_encoders.get(obj.__class__)
+    return encode_nondefault_object(obj) if encoder is None else encoder(obj)
+
+
+def _encode_raw_where_queryset(obj):
+    label = obj.model if isinstance(obj.model, string_types) else obj.model._meta.label
+    return ExtType(ExternalType.RAW_WHERE_QUERYSET, packb([label, obj.where, list(obj.params)], strict_types=True,
+                                                          default=_encode_query_param, use_bin_type=True))
+
+
+def _duration_to_microseconds(value):
+    return (value.days * 86400 + value.seconds) * 1000000 + value.microseconds
+
+
+def _microseconds_to_duration(value):
+    return timedelta(microseconds=value)
+
+
+_EPOCH = datetime(1970, 1, 1)
+_UTC_EPOCH = None
+
+
+def _datetime_to_microseconds(value):
+    # naive datetimes are left to the string representation of encode_nondefault_object
+    offset = value.utcoffset()
+    if offset is None:
+        return value
+    return _duration_to_microseconds(value.replace(tzinfo=None) - offset - _EPOCH)
+
+
+def _date_to_ordinal(value):
+    return value.toordinal()
+
+
+def _make_datetime_decoder(field):
+    def decode_datetime(value):
+        if isinstance(value, (string_types, datetime)):
+            return field.to_python(value)
+        global _UTC_EPOCH
+        if _UTC_EPOCH is None:
+            try:
+                from datetime import timezone
+                utc = timezone.utc
+            except ImportError:  # python 2, django.utils.timezone.utc was removed in Django 5.0
+                from django.utils.timezone import utc
+            _UTC_EPOCH = _EPOCH.replace(tzinfo=utc)
+        return _UTC_EPOCH + timedelta(microseconds=value)
+
+    return decode_datetime
+
+
+class _ModelSchema(object):
+    """ The concrete fields of a model as sent by encode_orm_fields, identified by a fingerprint """
+    positions = None  # the values are in the order of attnames
+
+    def __init__(self, model):
+        fields = model._meta.concrete_fields
+        self.model = model
+        self.label = model._meta.label
+        self.attnames = [field.attname for field in fields]
+        self.fields = [[field.attname, field.get_internal_type()] for field in fields]
+        self.fingerprint = zlib.crc32(ensure_binary('{}|{}'.format(self.label, ','.join(
+            '{}:{}'.format(field.attname, field.get_internal_type()) for field in fields)))) & 0xffffffff
+        self.encoders = []
+        self.decoders = []
+        for field in fields:
+            internal_type = field.get_internal_type()
+            if internal_type == 'DurationField':
+                self.encoders.append(_duration_to_microseconds)
+                self.decoders.append(_microseconds_to_duration)
+            elif internal_type == 'UUIDField':
+                self.encoders.append(str)
+                self.decoders.append(field.to_python)
+            elif internal_type == 'DateTimeField':
+                self.encoders.append(_datetime_to_microseconds)
+                self.decoders.append(_make_datetime_decoder(field))
+            elif internal_type == 'DateField':
+                self.encoders.append(_date_to_ordinal)
+                self.decoders.append(date.fromordinal)
+            elif internal_type == 'TimeField':
+                # sent as the string representation of encode_nondefault_object
+                self.encoders.append(None)
+                self.decoders.append(field.to_python)
+            else:
+                self.encoders.append(None)
+                self.decoders.append(None)
+
+
+# model class or model label -> _ModelSchema
+_model_schemas = {}
+
+
+def _model_schema(model):
+    try:
+        return _model_schemas[model]
+    except KeyError:
+        schema = _model_schemas[model] = _ModelSchema(model)
+        return schema
+
+
+def encode_orm_fields(obj):
+    """ Encode an ORM instance as its model label, a schema fingerprint and the values of its concrete fields
+
+    This is much more compact than pickling the instance, cached relations are not sent.
+    The instance is pickled instead when some of its fields are deferred or can not be packed.
+    loads raises ModelSchemaMismatch when the fields of the model differ on the consumer side.
+    Enable it for all models with ``register_encoder(Model, encode_orm_fields)``.
+
+    :param obj: an ORM instance
+    :return: ExtType
+    """
+    if obj.get_deferred_fields():
+        return _encode_orm_instance(obj)
+    schema = _model_schema(obj.__class__)
+    values = [getattr(obj, attname) for attname in schema.attnames]
+    try:
+        for index, encoder in enumerate(schema.encoders):
+            if encoder is not None and values[index] is not None:
+                values[index] = encoder(values[index])
+        data = _pack_default([schema.label, schema.fingerprint, obj._state.db, values])
+    except _PACK_ERRORS:
+        return _encode_orm_instance(obj)
+    return ExtType(ExternalType.ORM_FIELDS, data)
+
+
+_PACK_ERRORS = (TypeError, ValueError, AttributeError, OverflowError)
+
+
+class ModelSchemaMismatch(ValueError):
+    """ The concrete fields of a model sent by encode_orm_fields do not match the fields of the model of the consumer """
+
+
+class _SharedSchema(object):
+    """ The fields of a model which have the same attname and type on both sides,
+    when the sender's version of the model has other fields
+
+    :param schema: the _ModelSchema of the model
+    :param fields: the [attname, internal type] of each field sent, in the order of their values
+    """
+
+    def __init__(self, schema, fields):
+        own = dict((attname, (index, internal_type)) for index, (attname, internal_type) in enumerate(schema.fields))
+        self.model = schema.model
+        self.label = schema.label
+        self.positions = []  # the position of each shared field in the values sent
+        self.attnames = []
+        self.decoders = []
+        for position, (attname, internal_type) in enumerate(fields):
+            index, own_type = own.get(attname, (None, None))
+            if own_type == internal_type:
+                self.positions.append(position)
+                self.attnames.append(attname)
+                self.decoders.append(schema.decoders[index])
+
+
+# (model label, fingerprint of the sender, fields sent) -> _SharedSchema
+_shared_schemas = {}
+
+
+def _decoded_model_schema(label, fingerprint, fields=None):
+    """ :return: the schema of the values sent with a fingerprint, a _SharedSchema when the sender's fields differ
+    :raise ModelSchemaMismatch: when they differ and the fields of the sender are not known
+    """
+    try:
+        schema = _model_schemas[label]
+    except KeyError:
+        schema = _model_schemas[label] = _model_schema(_get_model(label))
+    if schema.fingerprint == fingerprint:
+        return schema
+    if fields is None:
+        raise ModelSchemaMismatch('the fields of model {} do not match the fields of the sender, '
+                                  'the instance can not be decoded'.format(label))
+    key = (label, fingerprint, tuple(tuple(field) for field in fields))
+    shared = _shared_schemas.get(key)
+    if shared is None:
+        logger.warning("fields of model %s do not match the sender's, only the fields both sides share are decoded",
+                       label)
+        shared = _shared_schemas[key] = _SharedSchema(schema, fields)
+    return shared
+
+
+def _decode_orm_fields(data):
+    label, fingerprint, db, values = unpackb(data, ext_hook=django_ext_hook, raw=False, timestamp=3)
+    schema = _decoded_model_schema(label, fingerprint)
+    for index, decoder in enumerate(schema.decoders):
+        if decoder is not None and values[index] is not None:
+            values[index] = decoder(values[index])
+    instance = schema.model.from_db(db, schema.attnames, values)
+    instance._state.adding = db is None
+    return instance
+
+
+RECORD_BATCH_DICTS = 0
+RECORD_BATCH_MODELS = 1
+
+
+class RecordBatch(object):
+    """ Wrap a list of dictionaries sharing the same keys, or of instances of the same model,
+    to be sent as one header plus one column per key or field instead of repeating the keys in every row.
+
+    A list that turns out not to be homogeneous, or whose keys are tuples, is sent as a plain list.
+    """
+    __slots__ = ('rows',)
+
+    def __init__(self, rows):
+        self.rows = rows
+
+
+class _DetectedRecordBatch(RecordBatch):
+    """ A list found by dumps(obj, record_batch_min_rows=...), sent as a plain list when it can not be a batch """
+    __slots__ = ()
+
+
+class RecordRows(Sequence):
+    """ The rows of a decoded record batch of dictionaries, each row is built when it is accessed """
+
+    def __init__(self, keys, columns):
+        self.keys = keys
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [dict(zip(self.keys, row)) for row in zip(*[column[index] for column in self.columns])]
+        return dict((key, column[index]) for key, column in zip(self.keys, self.columns))
+
+    def __eq__(self, other):
+        return list(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'RecordRows({!r})'.format(list(self))
+
+
+def _is_model_instance(obj):
+    models = sys.modules.get('django.db.models')  # nothing is an ORM instance before django.db.models is imported
+    return models is not None and isinstance(obj, models.Model)
+
+
+def _record_batch_kind(rows):
+    first = rows[0]
+    cls = type(first)
+    if cls is dict:
+        keys = first.keys()
+        if all(type(row) is dict and row.keys() == keys for row in rows):
+            return RECORD_BATCH_DICTS
+    elif _is_model_instance(first):
+        db = first._state.db
+        if all(type(row) is cls and row._state.db == db and not row.get_deferred_fields() for row in rows):
+            return RECORD_BATCH_MODELS
+
+
+def _encode_record_batch(batch):
+    rows = batch.rows
+    kind = _record_batch_kind(rows) if rows else None
+    if kind == RECORD_BATCH_DICTS:
+        keys = list(rows[0])
+        if any(isinstance(key, tuple) for key in keys):  # they would be decoded as lists, which are not hashable
+            return list(rows)
+        header = keys
+        columns = [[row[key] for row in rows] for key in keys]
+    elif kind == RECORD_BATCH_MODELS:
+        schema = _model_schema(type(rows[0]))
+        header = [schema.label, schema.fingerprint, rows[0]._state.db, schema.fields]
+        columns = []
+        for attname, encoder in zip(schema.attnames, schema.encoders):
+            column = [getattr(row, attname) for row in rows]
+            if encoder is not None:
+                try:
+                    column = [value if value is None else encoder(value) for value in column]
+                except _PACK_ERRORS:
+                    return list(rows)
+            columns.append(column)
+    else:
+        return list(rows)
+    try:
+        return ExtType(ExternalType.RECORD_BATCH, _pack_default([kind, header, _pack_default(columns)]))
+    except _PACK_ERRORS:
+        if kind == RECORD_BATCH_MODELS or isinstance(batch, _DetectedRecordBatch):
+            return list(rows)
+        raise
+
+
+def _decode_model_record_batch(header, packed_columns):
+    label, fingerprint, db = header[:3]
+    schema = _decoded_model_schema(label, fingerprint, header[3] if len(header) > 3 else None)
+    columns = unpackb(packed_columns, ext_hook=django_ext_hook, raw=False, timestamp=3)
+    if schema.positions is not None:
+        columns = [columns[position] for position in schema.positions]
+    for index, decoder in enumerate(schema.decoders):
+        if decoder is not None:
+            columns[index] = [value if value is None else decoder(value) for value in columns[index]]
+    from_db = schema.model.from_db
+    attnames = schema.attnames
+    instances = [from_db(db, attnames, list(values)) for values in zip(*columns)]
+    if db is None:
+        for instance in instances:
+            instance._state.adding = True
+    return instances
+
+
+def _wrap_record_batches(obj, min_rows, memo=None):
+    """ Wrap the lists of records of a payload into RecordBatch, the containers holding none of them
+    are returned as they are and a container found several times is wrapped once, for dedup_objects
+    """
+    cls = type(obj)
+    if cls is not dict and cls is not list and cls is not tuple:
+        return obj
+    if memo is None:
+        memo = {}
+    key = id(obj)
+    if key in memo:
+        return memo[key]
+    if cls is dict:
+        wrapped = dict((name, _wrap_record_batches(value, min_rows, memo)) for name, value in obj.items())
+        result = obj if all(wrapped[name] is value for name, value in obj.items()) else wrapped
+    elif len(obj) >= min_rows and _record_batch_kind(obj) is not None:
+        result = _DetectedRecordBatch(obj)
+    else:
+        wrapped = [_wrap_record_batches(value, min_rows, memo) for value in obj]
+        result = obj if all(new is old for new, old in zip(wrapped, obj)) else wrapped
+    memo[key] = result
+    return result
+
+
+class EvaluatedQuerySet(object):
+    """ Wrap a queryset to be evaluated once by the producer and sent as its rows,
+    instead of the pickled query ORM_QUERYSET sends for every consumer to run against its own database.
+
+    The rows are read with ``values_list(*fields).iterator(chunk_size)`` and packed one chunk of columns at a time,
+    no model instance is built. dumps holds the whole encoded result set, about 2 to 3 times until it returns,
+    iter_dumps yields each chunk once packed so that only one chunk of rows is held in memory while encoding.
+    They are decoded as QuerySetRows, or as model instances built with ``Model.from_db`` when instances is True,
+    from the fields both sides share when the sender's model has other fields.
+
+    :param queryset: the queryset to be evaluated
+    :param fields: the field names (or lookups) of each row, the concrete fields of the model by default
+    :param chunk_size: the number of rows fetched from the database cursor and packed at once
+    :param instances: decode the rows as model instances, the fields must then be concrete fields attnames
+    """
+    __slots__ = ('queryset', 'fields', 'chunk_size', 'instances')
+
+    def __init__(self, queryset, fields=None, chunk_size=2000, instances=False):
+        self.queryset = queryset
+        self.fields = fields
+        self.chunk_size = chunk_size
+        self.instances = instances
+
+
+# tuple of field names -> namedtuple class of the rows
+_row_classes = {}
+
+
+def _row_class(fields):
+    cls = _row_classes.get(fields)
+    if cls is None:
+        cls = _row_classes[fields] = namedtuple('Row', fields, rename=True)
+    return cls
+
+
+class QuerySetRows(RecordRows):
+    """ The rows of a decoded EvaluatedQuerySet, each row is built as a namedtuple when it is accessed """
+
+    def __init__(self, fields, columns):
+        super(QuerySetRows, self).__init__(fields, columns)
+        self.row_class = _row_class(tuple(fields))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.row_class(*row) for row in zip(*[column[index] for column in self.columns])]
+        return self.row_class(*[column[index] for column in self.columns])
+
+    def __repr__(self):
+        return 'QuerySetRows({} rows)'.format(len(self))
+
+
+def _evaluated_queryset_parts(evaluated):
+    """ :return: a generator of the packed header of an EvaluatedQuerySet, then of the packed columns of each chunk """
+    queryset = evaluated.queryset
+    model = queryset.model
+    fields = list(evaluated.fields or [field.attname for field in model._meta.concrete_fields])
+    encoders = [None] * len(fields)
+    if evaluated.instances:
+        schema = _model_schema(model)
+        positions = dict((attname, index) for index, attname in enumerate(schema.attnames))
+        for index, name in enumerate(fields):
+            if name not in positions:
+                raise ValueError('{} is not a concrete field of {}'.format(name, schema.label))
+            encoders[index] = schema.encoders[positions[name]]
+        types = dict(schema.fields)
+        header = [schema.label, schema.fingerprint, queryset.db, fields, [types[name] for name in fields]]
+    else:
+        header = [model._meta.label, None, queryset.db, fields, None]
+    chunk_size = evaluated.chunk_size
+    values = queryset.values_list(*fields)
+    try:
+        rows = values.iterator(chunk_size=chunk_size)
+    except TypeError:  # Django < 2.0
+        rows = values.iterator()
+    yield packb(header, use_bin_type=True)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        columns = [list(column) for column in zip(*chunk)]
+        del chunk
+        for index, encoder in enumerate(encoders):
+            if encoder is not None:
+                columns[index] = [value if value is None else encoder(value) for value in columns[index]]
+        yield _pack_default(columns)
+
+
+def _encode_evaluated_queryset(evaluated):
+    return ExtType(ExternalType.EVALUATED_QUERYSET, b''.join(_evaluated_queryset_parts(evaluated)))
+
+
+def _iter_dumps_evaluated_queryset(evaluated):
+    """ Stream an EvaluatedQuerySet as its header, an ext type per chunk of rows and a nil, the number of chunks
+    being unknown until the rows are read """
+    parts = _evaluated_queryset_parts(evaluated)
+    yield packb(ExtType(ExternalType.EVALUATED_QUERYSET_STREAM, next(parts)))
+    for columns in parts:
+        yield packb(ExtType(ExternalType.EVALUATED_QUERYSET_CHUNK, columns))
+    yield packb(None)
+
+
+class _QuerySetStream(object):
+    """ The header of an EvaluatedQuerySet streamed by iter_dumps, followed by its chunks """
+    __slots__ = ('header',)
+
+    def __init__(self, header):
+        self.header = header
+
+
+class _QuerySetChunk(object):
+    """ The columns of a chunk of rows of an EvaluatedQuerySet streamed by iter_dumps """
+    __slots__ = ('columns',)
+
+    def __init__(self, columns):
+        self.columns = columns
+
+
+def _decode_evaluated_queryset(data, ext_hook):
+    """ :return: the header and the columns of all the chunks of an EvaluatedQuerySet, the strings left as they are """
+    unpacker = Unpacker(ext_hook=ext_hook, raw=False, strict_map_key=False, timestamp=3,
+                        max_buffer_size=max(len(data), 1))
+    unpacker.feed(data)
+    label, fingerprint, db, fields, types = header = unpacker.unpack()
+    columns = [[] for _ in fields]
+    for chunk in unpacker:
+        for column, values in zip(columns, chunk):
+            column.extend(values)
+    return header, columns
+
+
+def _evaluated_queryset_instances(header, columns):
+    label, fingerprint, db, fields, types = header
+    schema = _decoded_model_schema(label, fingerprint, [list(field) for field in zip(fields, types)])
+    if schema.positions is not None:
+        columns = [columns[position] for position in schema.positions]
+        fields = schema.attnames
+    decoders = dict(zip(schema.attnames, schema.decoders))
+    for index, name in enumerate(fields):
+        decoder = decoders.get(name)
+        if decoder is not None:
+            columns[index] = [value if value is None else decoder(value) for value in columns[index]]
+    from_db = schema.model.from_db
+    instances = [from_db(db, fields, list(values)) for values in zip(*columns)]
+    if db is None:
+        for instance in instances:
+            instance._state.adding = True
+    return instances
+
+
+class _Define(object):
+    """ The first occurrence of an object repeated in a payload, sent along with its index """
+    __slots__ = ('index', 'obj')
+
+    def __init__(self, index, obj):
+        self.index = index
+        self.obj = obj
+
+
+class _BackReference(object):
+    """ Any other occurrence of a repeated object, sent as the index of its definition """
+    __slots__ = ('index',)
+
+    def __init__(self, index):
+        self.index = index
+
+
+_index_struct = struct.Struct('>I')
+# the types packed by msgpack itself, never worth a back reference
+_scalar_types = frozenset(integer_types + (text_type, binary_type, float, bool, type(None)))
+
+
+def _encode_define(definition):
+    return ExtType(ExternalType.DEFINE, _index_struct.pack(definition.index) + _pack_default(definition.obj))
+
+
+def _encode_back_reference(reference):
+    return ExtType(ExternalType.BACK_REFERENCE, _index_struct.pack(reference.index))
+
+
+def _find_shared(obj, seen, shared):
+    """ Collect the ids of the objects found more than once while walking the dicts, lists, tuples and sets """
+    cls = type(obj)
+    if cls in _scalar_types:
+        return
+    key = id(obj)
+    if key in seen:
+        shared.add(key)
+        return  # its content is sent once
+    seen.add(key)
+    if cls is dict:
+        for value in obj.values():
+            _find_shared(value, seen, shared)
+    elif cls is list or cls is tuple or cls is set:
+        if not obj:
+            seen.discard(key)  # an empty container is smaller than a back reference
+        for value in obj:
+            _find_shared(value, seen, shared)
+
+
+def _dedup(obj, shared, indexes):
+    cls = type(obj)
+    if cls in _scalar_types:
+        return obj
+    key = id(obj)
+    if key in shared:
+        index = indexes.get(key)
+        if index is not None:
+            return _BackReference(index)
+        index = indexes[key] = len(indexes)
+        return _Define(index, _dedup_content(obj, cls, shared, indexes))
+    return _dedup_content(obj, cls, shared, indexes)
+
+
+def _dedup_content(obj, cls, shared, indexes):
+    if cls is dict:
+        return dict((key, _dedup(value, shared, indexes)) for key, value in obj.items())
+    elif cls is list or cls is tuple or cls is set:
+        return [_dedup(value, shared, indexes) for value in obj]
+    return obj
+
+
+def dedup_objects(obj):
+    """ Replace the objects found more than once in a payload (model instances, Decimals, dicts, lists...)
+    by a definition at their first occurrence and back references at the others
+
+    The objects are compared by identity, only the dicts, lists, tuples and sets are walked into.
+
+    :param obj: the payload
+    :return: the payload to be packed, obj itself when nothing is repeated
+    """
+    shared = set()
+    _find_shared(obj, set(), shared)
+    if not shared:
+        return obj
+    return _dedup(obj, shared, {})
+
+
+def _encode_unknown(obj):
+    # logger.debug("unknown type obj=%s", obj)
+    return obj
+
+
+# encoders registered through register_encoder, keyed by type
+_encoders = {}
+# encoders of the built-in types, consulted after the duck-typed protocols (_asdict, to_dict, to_list)
+_builtin_encoders = {
+    dict: dict,  # handle Box, defaultdict and all variant of dictionary
+    tuple: list,  # tuple,set,list will be treated as list
+    set: list,
+    list: list,
+    Decimal: _encode_decimal,
+    datetime: _encode_datetime,
+    date: _encode_date,
+    time: _encode_time,
+    timedelta: _encode_timedelta,
+    RecordBatch: _encode_record_batch,
+    EvaluatedQuerySet: _encode_evaluated_queryset,
+    RawWhereQuerySet: _encode_raw_where_queryset,
+    _Define: _encode_define,
+    _BackReference: _encode_back_reference,
+}
+# built-in encoders of the types whose module is only imported once needed, keyed by (module, type name).
+# Nothing is an instance of such a type before its module is imported, they join _builtin_encoders then.
+_lazy_builtin_encoders = {
+    ('aenum', 'Enum'): _encode_enum,
+    ('aenum', 'Constant'): _encode_constant,
+    ('django.db.models', 'Model'): _encode_orm_instance,
+    ('django.db.models', 'QuerySet'): _encode_orm_queryset,
+}
+# concrete type -> resolved encoder, filled on first sight of each type
+_encoder_cache = {}
+
+
+def register_encoder(cls, encoder):
+    """ Register an encoder for a type (and its subclasses), replacing any previous encoder of that type
+
+    :param cls: the type to be encoded
+    :param encoder: a callable taking an instance of cls and returning a msgpack compatible object or an ExtType
+    """
+    _encoders[cls] = encoder
+    _encoder_cache.clear()
+
+
+def unregister_encoder(cls):
+    """ Remove an encoder previously added by register_encoder, the built-in behaviour of cls is restored
+
+    :param cls: the registered type
+    """
+    _encoders.pop(cls, None)
+    _encoder_cache.clear()
+
+
+def _lookup_mro(table, cls):
+    for base in getmro(cls):
+        encoder = table.get(base)
+        if encoder is not None:
+            return encoder
+
+
+def _load_lazy_encoders():
+    for module_name, name in list(_lazy_builtin_encoders):
+        cls = getattr(sys.modules.get(module_name), name, None)
+        if cls is not None:
+            _builtin_encoders[cls] = _lazy_builtin_encoders.pop((module_name, name))
+
+
+def _resolve_encoder(cls):
+    encoder = _encoders.get(cls)
+    if encoder is not None:
+        return encoder
+    if callable(getattr(cls, '_asdict', None)):
+        return _encode_asdict
+    elif callable(getattr(cls, 'to_dict', None)):
+        return _encode_to_dict
+    elif callable(getattr(cls, 'to_list', None)):
+        return _encode_to_list
+    if _lazy_builtin_encoders:
+        _load_lazy_encoders()
+    return _lookup_mro(_encoders, cls) or _lookup_mro(_builtin_encoders, cls) or _encode_unknown
+
+
+def _encode_by_instance(obj):
+    """ Encode an object whose class resolved to no encoder, checking the instance itself: the protocols
+    can be set on the instance and a proxy can be an instance of a type its class is not a subclass of
+    """
+    if callable(getattr(obj, '_asdict', None)):
+        return _encode_asdict(obj)
+    elif callable(getattr(obj, 'to_dict', None)):
+        return _encode_to_dict(obj)
+    elif callable(getattr(obj, 'to_list', None)):
+        return _encode_to_list(obj)
+    for table in (_encoders, _builtin_encoders):
+        for cls, encoder in table.items():
+            if isinstance(obj, cls):
+                return encoder(obj)
+    return _encode_unknown(obj)
 
 
 def encode_nondefault_object(obj):
     """ Encode an object by make it compatible with default msgpack encoder or using ExtType
 
+    The encoder of each class is resolved once then looked up from a cache, the class is read from ``__class__``
+    so that proxies such as SimpleLazyObject are encoded as the object they wrap.
+
     :param obj: any objet
     :return:
     """
     if obj is None:
         return
-    if hasattr(obj, '_asdict') and callable(obj._asdict):
-        return dict(obj._asdict())
-    elif hasattr(obj, 'to_dict') and callable(obj.to_dict):
-        return dict(obj.to_dict())
-    elif hasattr(obj, 'to_list') and callable(obj.to_list):
-        return list(obj.to_list())
-    elif isinstance(obj, dict):  # handle Box, defaultdict and all variant of dictionary
-        return dict(obj)
-    elif isinstance(obj, (tuple, set, list)):  # tuple,set,list will be treated as list
-        return list(obj)
-    elif isinstance(obj, Enum) and hasattr(obj, 'value'):
-        return obj.value
-    elif isinstance(obj, Constant) and hasattr(obj, '_value_'):
-        return obj._value_
-    elif isinstance(obj, Decimal):
-        return ExtType(ExternalType.DECIMAL, ensure_binary(str(obj)))
-    elif isinstance(obj, datetime):
-        return obj.strftime(DEFAULT_DATETIME_TIMEZONE_STRING_FORMAT)
-    elif isinstance(obj, date):
-        return obj.strftime(DEFAULT_DATE_STRING_FORMAT)
-    elif isinstance(obj, time):
-        return obj.strftime(DEFAULT_TIME_STRING_FORMAT)
-    elif isinstance(obj, timedelta):
-        if 0 <= obj.total_seconds() < 86400:
-            return '+{}'.format(obj)
-        return str(obj)
-    else:
-        if isinstance(obj, Model):
-            return ExtType(ExternalType.ORM_INSTANCE, pickle.dumps(obj, -1))
-        elif isinstance(obj, QuerySet):
-            return ExtType(ExternalType.ORM_QUERYSET, pickle.dumps((obj.model, obj.query), -1))
-    # logger.debug("unknown type obj=%s", obj)
-    return obj
+    cls = obj.__class__
+    try:
+        encoder = _encoder_cache[cls]
+    except KeyError:
+        encoder = _resolve_encoder(cls)
+        if encoder is _encode_unknown:
+            return _encode_by_instance(obj)
+        _encoder_cache[cls] = encoder
+    return encoder(obj)
+
+
+# the sink receiving the serialization metrics, None while they are disabled
+_metrics = None
+
+_DUMPS_LABELS = (('operation', 'dumps'),)
+_LOADS_LABELS = (('operation', 'loads'),)
+_DATETIME_EVALUATION = (('kind', 'datetime'),)
+_ORM_EVALUATION = (('kind', 'orm'),)
+_QUERYSET_EVALUATION = (('kind', 'queryset'),)
+_ext_type_labels = {}
+
+
+def enable_metrics(sink=None):
+    """ Record the latency and payload size of dumps and loads, the ext types encoded and decoded and the strings
+    evaluated into datetime, ORM instance or queryset objects
+
+    While disabled, dumps and loads only pay for a single check.
+
+    :param sink: where the metrics are recorded, see nameko_django.metrics.MetricsRegistry,
+        nameko_django.metrics.registry by default
+    :return: the sink
+    """
+    global _metrics
+    _metrics = metrics.registry if sink is None else sink
+    return _metrics
+
+
+def disable_metrics():
+    global _metrics
+    _metrics = None
+
+
+def _ext_labels(operation, code):
+    try:
+        return _ext_type_labels[operation, code]
+    except KeyError:
+        try:
+            name = ExternalType(code).name
+        except ValueError:
+            name = str(code)
+        labels = _ext_type_labels[operation, code] = (('operation', operation), ('type', name))
+        return labels
+
+
+def _encode_counted(obj):
+    result = encode_nondefault_object(obj)
+    if result.__class__ is ExtType:
+        sink = _metrics
+        if sink is not None:
+            sink.inc(metrics.EXT_TYPES, _ext_labels('dumps', result.code))
+    return result
+
+
+def _count_evaluation(labels):
+    sink = _metrics
+    if sink is not None:
+        sink.inc(metrics.STRING_EVALUATIONS, labels)
+
+
+# the unpickled (model, query) of the querysets received, keyed by their pickled bytes,
+# services send the same few query shapes over and over. A clone of the cached query is used by each queryset.
+decoded_query_cache = LRUCache(max_count=256, max_size=4 << 20)
+# the SELECT of the primary keys matching a raw WHERE clause, keyed by (model, database alias, clause),
+# the querysets sent by RawWhereQuerySet are a few templates whatever their params
+raw_where_cache = LRUCache(max_count=1024, max_size=1 << 20)
+# the instances of the models configured with instance_cache.configure(Model, max_count, ttl) referenced
+# by "<app_label.Model.pk>" strings are served from this cache instead of the database, across messages
+instance_cache = InstanceCache()
 
 
 def django_ext_hook(code, data):
     if code == ExternalType.DECIMAL:
-        return Decimal(ensure_str(data, encoding='utf-8'), context=DEFAULT_DECIMAL_CONTEXT)
+        return Decimal(data.decode('ascii'), context=DEFAULT_DECIMAL_CONTEXT)
+    elif code == ExternalType.DECIMAL_BINARY:
+        return _decode_decimal_binary(data)
     elif code == ExternalType.ORM_INSTANCE:
         return pickle.loads(data)
     elif code == ExternalType.ORM_QUERYSET:
         # untouched queryset case
-        model, query = pickle.loads(data)
-        if isinstance(model, ModelBase) and isinstance(query, Query):
+        cached = decoded_query_cache.get(data)
+        if cached is None:
+            from django.db.models.base import ModelBase
+            from django.db.models.sql.query import Query
+            model, query = pickle.loads(data)
+            if isinstance(model, ModelBase) and isinstance(query, Query):
+                decoded_query_cache.set(data, (model, query), len(data))
+                cached = model, query
+        if cached is not None:
+            model, query = cached
             qs = model.objects.all()
-            qs.query = query
+            qs.query = query.clone()
             return qs
+    elif code == ExternalType.RAW_WHERE_QUERYSET:
+        label, where, params = unpackb(data, ext_hook=django_ext_hook, raw=False, timestamp=3)
+        return raw_where_queryset(_get_model(label), where, params)
+    elif code == ExternalType.ORM_FIELDS:
+        return _decode_orm_fields(data)
+    elif code == ExternalType.NAIVE_DATETIME:
+        return datetime(*_naive_datetime_struct.unpack(data))
+    elif code == ExternalType.DATE:
+        return date.fromordinal(_date_struct.unpack(data)[0])
+    elif code == ExternalType.TIME:
+        return _decode_time_native(data)
+    elif code == ExternalType.TIMEDELTA:
+        return timedelta(*_timedelta_struct.unpack(data))
     # unable to decode external type then return as it is
     return ExtType(code, data)
 
@@ -131,60 +1147,1154 @@ datetime_test_re = re.compile(
 django_orm_re = re.compile(r"<([\w]+\.[\w]+)\.(\d+)>")
 django_orm_queryset_re = re.compile(r"\s*\(([\w]+\.[\w]+):\s*(.+)\)", re.MULTILINE)
 
-from django.apps import apps
+# the exact strings emitted by _encode_datetime, _encode_date, _encode_time and _encode_timedelta
+_emitted_datetime_re = re.compile(r'([0-9]{4})-([0-9]{2})-([0-9]{2}) ([0-9]{2}):([0-9]{2}):([0-9]{2})\.([0-9]{6})'
+                                  r'([-+][0-9]{4})?\Z')
+_emitted_date_re = re.compile(r'([0-9]{4})-([0-9]{2})-([0-9]{2})\Z')
+_emitted_time_re = re.compile(r'([0-9]{2}):([0-9]{2}):([0-9]{2})\.([0-9]{6})\Z')
+_emitted_timedelta_re = re.compile(r'\+([0-9]{1,2}):([0-9]{2}):([0-9]{2})(?:\.([0-9]{6}))?\Z')
+# "+HHMM" utc offset -> the fixed offset timezone dateparse builds for it
+_fixed_timezones = {}
+
+
+def _fixed_timezone(offset):
+    tz = _fixed_timezones.get(offset)
+    if tz is None:
+        from django.utils.timezone import get_fixed_timezone
+        minutes = 60 * int(offset[1:3]) + int(offset[3:])
+        tz = _fixed_timezones[offset] = get_fixed_timezone(-minutes if offset[0] == '-' else minutes)
+    return tz
+
+
+def _parse_emitted_datetime(obj, length):
+    """ Parse a string in one of the formats the encoders emit with a single anchored match picked by its length
+
+    :return: the datetime, date, time or timedelta dateparse would return, None for any other string or an invalid
+        value, both left to dateparse
+    """
+    try:
+        if length == 31 or length == 26:
+            m = _emitted_datetime_re.match(obj)
+            if m:
+                year, month, day, hour, minute, second, microsecond, offset = m.groups()
+                return datetime(int(year), int(month), int(day), int(hour), int(minute), int(second),
+                                int(microsecond), offset and _fixed_timezone(offset))
+        elif obj[:1] == '+':
+            m = _emitted_timedelta_re.match(obj)
+            if m:
+                hours, minutes, seconds, microseconds = m.groups()
+                return timedelta(hours=int(hours), minutes=int(minutes), seconds=int(seconds),
+                                 microseconds=int(microseconds or 0))
+        elif length == 10:
+            m = _emitted_date_re.match(obj)
+            if m:
+                year, month, day = m.groups()
+                return date(int(year), int(month), int(day))
+        elif length == 15:
+            m = _emitted_time_re.match(obj)
+            if m:
+                hour, minute, second, microsecond = m.groups()
+                return time(int(hour), int(minute), int(second), int(microsecond))
+    except ValueError:
+        pass
+
+
+# django.utils.dateparse, imported by the first string looking like a date, time or duration
+_dateparse = None
+
+
+def _import_dateparse():
+    global _dateparse
+    from django.utils import dateparse
+    _dateparse = dateparse
+    return dateparse
+
+
+def _get_model(label):
+    from django.apps import apps
+    return apps.get_model(label)
+
 
+def decode_single_object(obj, references=None):
+    """ Evaluate a string into a datetime, date, time, duration, ORM instance or ORM queryset
 
-def decode_single_object(obj):
+    :param obj: any decoded object, only strings are evaluated
+    :param references: a ReferenceBatch collecting "<app_label.Model.pk>" references to be fetched later in bulk,
+        when None the instance is fetched right away
+    :return:
+    """
     if obj is None:
         return
     if isinstance(obj, string_types):
+        first = obj[:1]
+        if first.isalpha() and first != 'P':  # neither a date, time, duration, ORM reference nor queryset
+            return obj
         datetime_obj = None
         lenobj = len(obj)
-        if lenobj <= 33 and datetime_test_re.match(obj):
-            try:
-                if lenobj == 33:
-                    datetime_obj = dateparse.parse_datetime(obj.replace(' +', '+'))
-                elif 31 <= lenobj <= 32 or 21 <= lenobj <= 26:
-                    datetime_obj = dateparse.parse_datetime(obj)
-                elif lenobj == 10:
-                    datetime_obj = dateparse.parse_date(obj)
-                    if not datetime_obj:  # there is an over lapse case
+        if lenobj <= 33:
+            datetime_obj = _parse_emitted_datetime(obj, lenobj)
+            if datetime_obj is None and datetime_test_re.match(obj):
+                dateparse = _dateparse or _import_dateparse()
+                try:
+                    if lenobj == 33:
+                        datetime_obj = dateparse.parse_datetime(obj.replace(' +', '+'))
+                    elif 31 <= lenobj <= 32 or 21 <= lenobj <= 26:
+                        datetime_obj = dateparse.parse_datetime(obj)
+                    elif lenobj == 10:
+                        datetime_obj = dateparse.parse_date(obj)
+                        if not datetime_obj:  # there is an over lapse case
+                            datetime_obj = dateparse.parse_time(obj)
+                    elif lenobj == 5 or lenobj == 8 or 10 <= lenobj <= 15:
                         datetime_obj = dateparse.parse_time(obj)
-                elif lenobj == 5 or lenobj == 8 or 10 <= lenobj <= 15:
-                    datetime_obj = dateparse.parse_time(obj)
-                if datetime_obj is None:  # a time object is also maybe a valid duration object
-                    datetime_obj = dateparse.parse_duration(re.sub(r'^(\-?)\+?:?(\d)', r'\1\2', obj))
-            except ValueError:
-                # fix a bug where the obj may not be an actual datetime string but mistakenly recognized as one
-                datetime_obj = None
+                    if datetime_obj is None:  # a time object is also maybe a valid duration object
+                        datetime_obj = dateparse.parse_duration(re.sub(r'^(\-?)\+?:?(\d)', r'\1\2', obj))
+                except ValueError:
+                    # fix a bug where the obj may not be an actual datetime string but mistakenly recognized as one
+                    datetime_obj = None
         # if there is a datetime_obj can be decoded from string then return it
         if datetime_obj is not None:
+            _count_evaluation(_DATETIME_EVALUATION)
             return datetime_obj
         # check django orm evaluation from string
         m = django_orm_re.match(obj)
         if m:
-            return apps.get_model(m.group(1)).objects.get(pk=m.group(2))
+            _count_evaluation(_ORM_EVALUATION)
+            if references is not None:
+                return references.add(m.group(1), m.group(2))
+            model = _get_model(m.group(1))
+            pk = model._meta.pk.to_python(m.group(2))
+            instance = instance_cache.get_many(model, (pk,)).get(pk)
+            if instance is None:
+                instance = model.objects.get(pk=pk)
+                instance_cache.set_many(model, {pk: instance})
+            return instance
         m2 = django_orm_queryset_re.match(obj)
         if m2:
-            model = apps.get_model(m2.group(1))
-            raw_id_qs = "SELECT id FROM {} WHERE {}".format(model._meta.db_table, m2.group(2).strip())
-            return model.objects.filter(id__in=[o.id for o in model.objects.raw(raw_id_qs)])
+            _count_evaluation(_QUERYSET_EVALUATION)
+            # the raw WHERE has no params, a literal % (or %% already escaped) must not be taken for a placeholder
+            return raw_where_queryset(_get_model(m2.group(1)), re.sub(r'%%?', '%%', m2.group(2).strip()))
     return obj
 
 
-def dumps(o):
-    return packb(o, strict_types=True, default=encode_nondefault_object, use_bin_type=True)
+def raw_where_queryset(model, where, params=()):
+    """ Build a lazy queryset of the instances of model matching a raw WHERE clause
+
+    The clause is embedded as a subquery on the primary key, nothing is run until the queryset is evaluated.
+    The SQL of each clause is kept in raw_where_cache.
+
+    :param model: the ORM model class
+    :param where: the raw WHERE clause, using %s placeholders for params
+    :param params: the params of the clause
+    :return: QuerySet
+    """
+    from django.db import connections, router
+    from django.db.models.expressions import RawSQL
+    alias = router.db_for_read(model)
+    key = (model, alias, where)
+    sql = raw_where_cache.get(key)
+    if sql is None:
+        quote_name = connections[alias].ops.quote_name
+        sql = "SELECT {} FROM {} WHERE {}".format(
+            quote_name(model._meta.pk.column), quote_name(model._meta.db_table), where)
+        raw_where_cache.set(key, sql, len(sql))
+    return model.objects.filter(pk__in=RawSQL(sql, params))
+
+
+MISSING_REFERENCE_RAISE = 'raise'
+MISSING_REFERENCE_NONE = 'none'
+
+
+class _Reference(object):
+    __slots__ = ('model_label', 'pk')
+
+    def __init__(self, model_label, pk):
+        self.model_label = model_label
+        self.pk = pk
+
+
+class ReferenceBatch(object):
+    """ Collect the "<app_label.Model.pk>" references of a payload then fetch them with one query per model
+
+    Placeholders are returned while decoding and the slots holding them are recorded,
+    resolve() patches the fetched instances into these slots.
+    """
+
+    def __init__(self):
+        self.pks = {}
+        self.slots = []
+
+    def add(self, model_label, pk):
+        self.pks.setdefault(model_label, set()).add(pk)
+        return _Reference(model_label, pk)
+
+    def decode_dict_object(self, dict_obj):
+        """ Evaluate the strings of a dict built by msgpack in place, its other values are already decoded """
+        for key, value in dict_obj.items():
+            if value.__class__ is text_type:
+                evaluated = decode_single_object(value, self)
+                if evaluated is not value:
+                    dict_obj[key] = evaluated
+                    if evaluated.__class__ is _Reference:
+                        self.slots.append((dict_obj, key))
+        return dict_obj
+
+    def decode_list_object(self, list_obj):
+        """ Evaluate the strings of a list built by msgpack in place, its other items are already decoded """
+        for index, value in enumerate(list_obj):
+            if value.__class__ is text_type:
+                evaluated = decode_single_object(value, self)
+                if evaluated is not value:
+                    list_obj[index] = evaluated
+                    if evaluated.__class__ is _Reference:
+                        self.slots.append((list_obj, index))
+        return list_obj
+
+    def decode_root_object(self, obj):
+        root = [decode_single_object(obj, self)]
+        if root[0].__class__ is _Reference:
+            self.slots.append((root, 0))
+        return root
+
+    def fetch(self):
+        """ Fetch the referenced instances, one in_bulk query per model for the instances missing from instance_cache
+
+        :return: {model_label: {pk: instance}}
+        """
+        instances = {}
+        for model_label, pks in self.pks.items():
+            model = _get_model(model_label)
+            to_python = model._meta.pk.to_python
+            keys = dict((pk, to_python(pk)) for pk in pks)
+            fetched = instance_cache.get_many(model, keys.values())
+            if len(fetched) < len(keys):
+                found = model.objects.in_bulk([key for key in keys.values() if key not in fetched])
+                instance_cache.set_many(model, found)
+                fetched.update(found)
+            instances[model_label] = dict((pk, fetched.get(key)) for pk, key in keys.items())
+        return instances
+
+    def resolve(self, missing_references=MISSING_REFERENCE_RAISE):
+        """ Patch the fetched instances in place of the placeholders
+
+        :param missing_references: MISSING_REFERENCE_RAISE to raise Model.DoesNotExist for a pk which does not exist,
+            MISSING_REFERENCE_NONE to replace it with None
+        """
+        if not self.slots:
+            return
+        instances = self.fetch()
+        for container, key in self.slots:
+            ref = container[key]
+            instance = instances[ref.model_label][ref.pk]
+            if instance is None and missing_references != MISSING_REFERENCE_NONE:
+                model = _get_model(ref.model_label)
+                raise model.DoesNotExist("%s matching query does not exist." % model._meta.object_name)
+            container[key] = instance
+        self.pks.clear()
+        del self.slots[:]
+
+
+def dumps(o, record_batch_min_rows=None, dedup=False):
+    """ Encode an object into msgpack
+
+    :param o: the object
+    :param record_batch_min_rows: when set, lists (and tuples) of at least this many dictionaries sharing the same keys
+        or instances of the same model are sent as record batches, see RecordBatch
+    :param dedup: send the objects repeated in the payload once, loads decodes them as a single shared object,
+        see dedup_objects
+    :return: bytes
+    """
+    if _metrics is not None:
+        return _measured_dumps(_metrics, o, record_batch_min_rows, dedup)
+    if OFFLOAD_MIN_ITEMS is not None and _has_many_items(o):
+        data = _tpool_execute(_pack_payload, o, record_batch_min_rows, dedup)
+        if COMPRESSION_THRESHOLD is not None and len(data) > COMPRESSION_THRESHOLD:
+            return _offload_bytes(compress_payload, data, COMPRESSION_CODEC, COMPRESSION_LEVEL)
+        return data
+    if record_batch_min_rows:
+        o = _wrap_record_batches(o, record_batch_min_rows)
+    if dedup:
+        o = dedup_objects(o)
+    data = _pack_default(o)
+    if COMPRESSION_THRESHOLD is not None and len(data) > COMPRESSION_THRESHOLD:
+        return compress_payload(data)
+    return data
+
+
+def _pack_payload(o, record_batch_min_rows, dedup, counting=False):
+    if record_batch_min_rows:
+        o = _wrap_record_batches(o, record_batch_min_rows)
+    if dedup:
+        o = dedup_objects(o)
+    return _pack_default(o, counting)
+
+
+def _measured_dumps(sink, o, record_batch_min_rows, dedup):
+    start = default_timer()
+    offload = OFFLOAD_MIN_ITEMS is not None and _has_many_items(o)
+    if offload:
+        data = _tpool_execute(_pack_payload, o, record_batch_min_rows, dedup, True)
+    else:
+        data = _pack_payload(o, record_batch_min_rows, dedup, True)
+    if COMPRESSION_THRESHOLD is not None and len(data) > COMPRESSION_THRESHOLD:
+        size = len(data)
+        if offload:
+            data = _offload_bytes(compress_payload, data, COMPRESSION_CODEC, COMPRESSION_LEVEL)
+        else:
+            data = compress_payload(data)
+        if len(data) != size:
+            sink.inc(metrics.EXT_TYPES, _ext_labels('dumps', ExternalType.COMPRESSED))
+    sink.observe(metrics.DUMPS_SECONDS, default_timer() - start)
+    sink.observe(metrics.PAYLOAD_BYTES, len(data), _DUMPS_LABELS)
+    return data
+
+
+class EvalPaths(object):
+    """ A compiled set of key paths whose strings are evaluated by loads, e.g. a per-entrypoint schema
+
+    A path is a dotted string of dictionary keys or list indexes, ``*`` matches any key or index,
+    every string below the last segment of a path is evaluated::
+
+        ORDER_SCHEMA = EvalPaths('created_at', 'items.*.product', 'customer')
+        loads(body, eval_strings=ORDER_SCHEMA)
+    """
+
+    def __init__(self, *paths):
+        self.paths = paths
+        self.tree = {}
+        for path in paths:
+            node = self.tree
+            segments = path.split('.')
+            for segment in segments[:-1]:
+                child = node.setdefault(segment, {})
+                if child is True:  # an enclosing path is already evaluated as a whole
+                    break
+                node = child
+            else:
+                node[segments[-1]] = True
+
+    def __repr__(self):
+        return 'EvalPaths({})'.format(', '.join(repr(path) for path in self.paths))
+
+
+def _decode_tree(obj, references):
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            if isinstance(value, (string_types, dict, list)):
+                evaluated = _decode_tree(value, references)
+                if evaluated is not value:
+                    obj[key] = evaluated
+                    if evaluated.__class__ is _Reference:
+                        references.slots.append((obj, key))
+    elif isinstance(obj, list):
+        for index, value in enumerate(obj):
+            if isinstance(value, (string_types, dict, list)):
+                evaluated = _decode_tree(value, references)
+                if evaluated is not value:
+                    obj[index] = evaluated
+                    if evaluated.__class__ is _Reference:
+                        references.slots.append((obj, index))
+    elif isinstance(obj, string_types):
+        return decode_single_object(obj, references)
+    return obj
+
+
+def _decode_paths(obj, node, references):
+    if isinstance(obj, dict):
+        items = obj.items()
+    elif isinstance(obj, list):
+        items = enumerate(obj)
+    elif isinstance(obj, RecordRows):
+        _decode_record_rows_paths(obj, node.get('*'), references)
+        return
+    else:
+        return
+    wildcard = node.get('*')
+    for key, value in items:
+        child = node.get(key if isinstance(key, string_types) else str(key), wildcard)
+        if child is True:
+            evaluated = _decode_tree(value, references)
+            if evaluated is not value:
+                obj[key] = evaluated
+                if evaluated.__class__ is _Reference:
+                    references.slots.append((obj, key))
+        elif child is not None:
+            _decode_paths(value, child, references)
+
+
+def _decode_record_rows_paths(rows, row_node, references):
+    if row_node is None:
+        return
+    wildcard = True if row_node is True else row_node.get('*')
+    for key, column in zip(rows.keys, rows.columns):
+        child = wildcard if row_node is True else row_node.get(
+            key if isinstance(key, string_types) else str(key), wildcard)
+        if child is True:
+            _decode_tree(column, references)
+        elif child is not None:
+            for value in column:
+                _decode_paths(value, child, references)
+
+
+def _child_node(node, key):
+    """ :return: the EvalPaths node of the value at key below node, True to evaluate it all, None to leave it """
+    if node is True or node is None:
+        return node
+    return node.get(key if isinstance(key, string_types) else str(key), node.get('*'))
+
+
+class _LazyView(object):
+    """ A read-only view of a container of a payload decoded with loads(lazy=True), only its span of bytes is known
+
+    The spans of its values are indexed on first access without unpacking them, each value is decoded (ext types,
+    strings evaluation, references) when first read then cached, the nested containers being views as well.
+    """
+    __slots__ = ()
+
+    def __init__(self, decoder, start, end, node):
+        self._decoder = decoder
+        self._start = start
+        self._end = end
+        self._node = node
+        self._spans = None
+        self._cache = {}
+
+    def _value(self, key, span):
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        value = self._cache[key] = self._decoder.lazy_value(span[0], span[1], _child_node(self._node, key))
+        return value
+
+    def materialize(self):
+        """ :return: the whole container decoded as loads would, the references fetched with one query per model """
+        return self._decoder.decode_span(self._start, self._end, self._node)
+
+
+class LazyMapping(_LazyView, Mapping):
+    __doc__ = _LazyView.__doc__
+    __slots__ = ('_decoder', '_start', '_end', '_node', '_spans', '_cache')
+
+    @property
+    def spans(self):
+        if self._spans is None:
+            self._spans = self._decoder.map_spans(self._start, self._end)
+        return self._spans
+
+    def __getitem__(self, key):
+        return self._value(key, self.spans[key])
+
+    def __contains__(self, key):
+        return key in self.spans
+
+    def __iter__(self):
+        return iter(self.spans)
+
+    def __len__(self):
+        return len(self.spans)
+
+    def __repr__(self):
+        return 'LazyMapping({} keys)'.format(len(self))
+
+
+class LazySequence(_LazyView, Sequence):
+    __doc__ = _LazyView.__doc__
+    __slots__ = ('_decoder', '_start', '_end', '_node', '_spans', '_cache')
+
+    @property
+    def spans(self):
+        if self._spans is None:
+            self._spans = self._decoder.array_spans(self._start, self._end)
+        return self._spans
 
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[position] for position in range(*index.indices(len(self)))]
+        spans = self.spans
+        if index < 0:
+            index += len(spans)
+        if not 0 <= index < len(spans):
+            raise IndexError('list index out of range')
+        return self._value(index, spans[index])
 
-def loads(s):
-    if not isinstance(s, string_types):
-        s = bytes(s)
-    r = unpackb(s, ext_hook=django_ext_hook, object_hook=decode_dict_object, list_hook=decode_list_object,
-                raw=False, strict_map_key=False)
-    if isinstance(r, string_types):
-        return decode_single_object(r)
+    def __len__(self):
+        return len(self.spans)
+
+    def __eq__(self, other):
+        return list(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'LazySequence({} items)'.format(len(self))
+
+
+class _Decoder(object):
+    """ The state of one loads call, shared by the hooks of the payload and of its nested ext types """
+
+    def __init__(self, eval_strings=True, lazy_records=False):
+        if isinstance(eval_strings, string_types):
+            eval_strings = EvalPaths(eval_strings)
+        elif eval_strings not in (True, False) and not isinstance(eval_strings, EvalPaths):
+            eval_strings = EvalPaths(*eval_strings)
+        self.eval_strings = eval_strings
+        self.lazy_records = lazy_records
+        self.references = ReferenceBatch()
+        self.definitions = {}
+        self.metrics = _metrics
+        self.options = dict(ext_hook=self.ext_hook if self.metrics is None else self.counted_ext_hook,
+                            raw=False, strict_map_key=False, timestamp=3)
+        if eval_strings is True:
+            self.options.update(object_hook=self.references.decode_dict_object,
+                                list_hook=self.references.decode_list_object)
+        self.missing_references = MISSING_REFERENCE_RAISE
+        self.data = None  # the payload read by the lazy views
+        self.packed_definitions = None  # index -> packed shared object of the payload read by the lazy views
+
+    def ext_hook(self, code, data):
+        if code == ExternalType.BACK_REFERENCE:
+            index = _index_struct.unpack(data)[0]
+            if index not in self.definitions and self.data is not None:  # defined out of the span read by a lazy view
+                if self.packed_definitions is None:
+                    self.load_definitions()
+                if index in self.packed_definitions:
+                    self.definitions[index] = self.unpack(self.packed_definitions[index])
+            return self.definitions[index]
+        elif code == ExternalType.DEFINE:
+            index = _index_struct.unpack_from(data)[0]
+            if self.data is not None and index in self.definitions:  # already decoded by the lazy views
+                return self.definitions[index]
+            obj = self.definitions[index] = self.unpack(memoryview(data)[4:])
+            return obj
+        elif code == ExternalType.COMPRESSED:
+            payload = _decompress(data)
+            return ExtType(code, data) if payload is None else self.unpack(payload)
+        if code == ExternalType.RECORD_BATCH:
+            kind, header, packed_columns = unpackb(data, ext_hook=django_ext_hook, raw=False, strict_map_key=False)
+            if kind == RECORD_BATCH_DICTS:
+                slots = self.references.slots
+                start = len(slots)
+                rows = RecordRows(header, self.unpack(packed_columns))
+                if self.lazy_records:
+                    return rows
+                dicts = list(rows)
+                if len(slots) > start:
+                    # references placeholders were recorded in the columns, move them to the rows
+                    keys = dict((id(column), key) for key, column in zip(rows.keys, rows.columns))
+                    for index in range(start, len(slots)):
+                        container, position = slots[index]
+                        if id(container) in keys:
+                            slots[index] = (dicts[position], keys[id(container)])
+                return dicts
+            elif kind == RECORD_BATCH_MODELS:
+                return _decode_model_record_batch(header, packed_columns)
+            return ExtType(code, data)
+        elif code == ExternalType.EVALUATED_QUERYSET:
+            return self.evaluated_queryset(*_decode_evaluated_queryset(data, self.options['ext_hook']))
+        elif code == ExternalType.EVALUATED_QUERYSET_STREAM:
+            return _QuerySetStream(unpackb(data, raw=False))
+        elif code == ExternalType.EVALUATED_QUERYSET_CHUNK:
+            return _QuerySetChunk(unpackb(data, ext_hook=self.options['ext_hook'], raw=False, strict_map_key=False,
+                                          timestamp=3))
+        return django_ext_hook(code, data)
+
+    def evaluated_queryset(self, header, columns):
+        if header[1] is not None:
+            return _evaluated_queryset_instances(header, columns)
+        if self.eval_strings is True:
+            for column in columns:
+                _decode_tree(column, self.references)
+        return QuerySetRows(header[3], columns)
+
+    def join_queryset_stream(self, stream, read):
+        """ Put the chunks of an EvaluatedQuerySet streamed by iter_dumps back together
+
+        :param stream: the _QuerySetStream starting the payload
+        :param read: a callable returning the next object of the payload
+        """
+        columns = [[] for _ in stream.header[3]]
+        chunk = read()
+        while chunk is not None:
+            if chunk.__class__ is not _QuerySetChunk:
+                raise ValueError('a chunk of the streamed EvaluatedQuerySet was expected, got {!r}'.format(chunk))
+            for column, values in zip(columns, chunk.columns):
+                column.extend(values)
+            chunk = read()
+        return self.evaluated_queryset(stream.header, columns)
+
+    def counted_ext_hook(self, code, data):
+        self.metrics.inc(metrics.EXT_TYPES, _ext_labels('loads', code))
+        return self.ext_hook(code, data)
+
+    def unpack(self, data):
+        return unpackb(data, **self.options)
+
+    def unpack_evaluate(self, data):
+        try:
+            return self.evaluate(self.unpack(data))
+        except ExtraData as e:
+            if e.unpacked.__class__ is not _QuerySetStream:
+                raise
+            unpacker = self.unpacker(max_buffer_size=max(len(e.extra), 1))
+            unpacker.feed(e.extra)
+            return [self.join_queryset_stream(e.unpacked, lambda: _read_more(unpacker.unpack, unpacker, ()))]
+
+    def unpacker(self, **kwargs):
+        kwargs.update(self.options)
+        return Unpacker(**kwargs)
+
+    def evaluate(self, r, node=None):
+        """ Evaluate an unpacked object which is not held by any container, the evaluation of the strings in nested
+        containers are done by the hooks or according to the node of EvalPaths.tree (the whole tree by default)
+
+        :return: a list holding the evaluated object, in which it is replaced when it is a reference
+        """
+        root = [r]
+        if self.eval_strings is True:
+            if isinstance(r, string_types):
+                root = self.references.decode_root_object(r)
+        elif self.eval_strings:
+            if node is None:
+                node = self.eval_strings.tree
+            if node is True:
+                root[0] = _decode_tree(r, self.references)
+                if root[0].__class__ is _Reference:
+                    self.references.slots.append((root, 0))
+            else:
+                _decode_paths(r, node, self.references)
+        return root
+
+    def lazy_value(self, start, end, node):
+        """ :return: the value held by a span of the payload, a view when it is a dict or a list """
+        header = bytearray(self.data[start:start + 1])[0]
+        if 0x80 <= header <= 0x8f or header == 0xde or header == 0xdf:
+            return LazyMapping(self, start, end, node)
+        elif 0x90 <= header <= 0x9f or header == 0xdc or header == 0xdd:
+            return LazySequence(self, start, end, node)
+        return self.decode_span(start, end, node)
+
+    def decode_span(self, start, end, node):
+        root = [self.unpack(self.data[start:end])]
+        if node is not None:
+            root = self.evaluate(root[0], node)
+        self.references.resolve(self.missing_references)
+        return root[0]
+
+    def span_unpacker(self, start, end):
+        unpacker = Unpacker(ext_hook=self.options['ext_hook'], raw=False, strict_map_key=False, timestamp=3,
+                            max_buffer_size=max(end - start, 1))
+        unpacker.feed(self.data[start:end])
+        return unpacker
+
+    def map_spans(self, start, end):
+        """ :return: {key: (start, end)} of the values of a dict, which are skipped rather than unpacked """
+        unpacker = self.span_unpacker(start, end)
+        spans = {}
+        for _ in range(unpacker.read_map_header()):
+            key = unpacker.unpack()
+            position = unpacker.tell()
+            unpacker.skip()
+            spans[key] = (start + position, start + unpacker.tell())
+        return spans
+
+    def array_spans(self, start, end):
+        """ :return: [(start, end)] of the items of a list, which are skipped rather than unpacked """
+        unpacker = self.span_unpacker(start, end)
+        spans = []
+        for _ in range(unpacker.read_array_header()):
+            position = unpacker.tell()
+            unpacker.skip()
+            spans.append((start + position, start + unpacker.tell()))
+        return spans
+
+    def load_definitions(self):
+        """ Find the shared objects of the whole payload read by the lazy views, without evaluating any string
+        nor collecting any reference: each of them is only decoded once a back reference to it is read
+        """
+        self.packed_definitions = {}
+        self.scan_definitions(self.data)
+
+    def scan_definitions(self, data):
+        unpackb(data, ext_hook=self.scan_ext_hook, raw=False, strict_map_key=False)
+
+    def scan_ext_hook(self, code, data):
+        if code == ExternalType.DEFINE:
+            self.packed_definitions.setdefault(_index_struct.unpack_from(data)[0], data[4:])
+            self.scan_definitions(memoryview(data)[4:])
+        elif code == ExternalType.COMPRESSED:
+            payload = _decompress(data)
+            if payload is not None:
+                self.scan_definitions(payload)
+
+    def decode_lazy(self, data, missing_references=MISSING_REFERENCE_RAISE):
+        if _ext_code(data) == ExternalType.EVALUATED_QUERYSET_STREAM:  # no container to be viewed
+            return self.decode(data, missing_references)
+        self.missing_references = missing_references
+        compressed = _top_level_compressed(data)
+        if compressed:
+            if OFFLOAD_THRESHOLD is not None:
+                data = _offload_bytes(_decompress, compressed) or data
+            else:
+                data = _decompress(compressed) or data
+        self.data = memoryview(data)
+        if self.eval_strings is True:
+            node = True
+        else:
+            node = self.eval_strings.tree if self.eval_strings else None
+        return self.lazy_value(0, len(self.data), node)
+
+    def decode(self, data, missing_references=MISSING_REFERENCE_RAISE):
+        if OFFLOAD_THRESHOLD is not None:
+            compressed = _top_level_compressed(data)
+            if compressed:  # its compressed size says little about the work of decoding it, inflate it first
+                data = _offload_bytes(_decompress, compressed) or data
+        if OFFLOAD_THRESHOLD is not None and len(data) > OFFLOAD_THRESHOLD:
+            root = _tpool_execute(self.unpack_evaluate, data)
+        else:
+            root = self.unpack_evaluate(data)
+        self.references.resolve(missing_references)  # the database is only queried from the calling greenthread
+        return root[0]
+
+    def unpack_evaluate_many(self, bodies):
+        roots = []
+        for data in bodies:
+            self.definitions = {}  # the back references of a payload index its own shared objects
+            roots.append(self.unpack_evaluate(data))
+        return roots
+
+    def decode_many(self, bodies, missing_references=MISSING_REFERENCE_RAISE, executor=None):
+        if executor is not None:
+            compressed = [_top_level_compressed(data) for data in bodies]
+            indexes = [index for index, payload in enumerate(compressed) if payload]
+            if indexes:
+                bodies = list(bodies)
+                for index, payload in zip(indexes, executor.map(_decompress, [compressed[i] for i in indexes])):
+                    if payload is not None:
+                        bodies[index] = payload
+        if OFFLOAD_THRESHOLD is not None and sum(len(data) for data in bodies) > OFFLOAD_THRESHOLD:
+            roots = _tpool_execute(self.unpack_evaluate_many, bodies)
+        else:
+            roots = self.unpack_evaluate_many(bodies)
+        self.references.resolve(missing_references)
+        return [root[0] for root in roots]
+
+
+def loads(s, eval_strings=True, missing_references=MISSING_REFERENCE_RAISE, lazy_records=False, lazy=False):
+    """ Decode a msgpack payload produced by dumps
+
+    The "<app_label.Model.pk>" references are collected while decoding then fetched with one query per model.
+
+    :param s: the payload, bytes or any contiguous buffer (bytearray, memoryview...) which is read without a copy
+    :param eval_strings: True to evaluate every string into datetime/ORM objects, False to leave strings
+        untouched, or an EvalPaths (or a key path, or an iterable of them) to evaluate only the strings at those paths.
+        Apart from True, msgpack builds containers without calling back into python.
+    :param missing_references: MISSING_REFERENCE_RAISE to raise Model.DoesNotExist when a referenced pk does not
+        exist, MISSING_REFERENCE_NONE to decode it as None
+    :param lazy_records: decode record batches of dictionaries as RecordRows, which build each row when accessed,
+        instead of lists of dictionaries
+    :param lazy: only unpack the dicts and lists, which are returned as read-only LazyMapping and LazySequence views.
+        Each value is decoded when first read, see LazyMapping.
+    :return:
+    """
+    if _metrics is not None:
+        return _measured_loads(_metrics, s, eval_strings, missing_references, lazy_records, lazy)
+    decoder = _Decoder(eval_strings, lazy_records)
+    if lazy:
+        return decoder.decode_lazy(_as_buffer(s), missing_references)
+    return decoder.decode(_as_buffer(s), missing_references)
+
+
+def _measured_loads(sink, s, eval_strings, missing_references, lazy_records, lazy):
+    start = default_timer()
+    data = _as_buffer(s)
+    decoder = _Decoder(eval_strings, lazy_records)
+    if lazy:
+        result = decoder.decode_lazy(data, missing_references)
     else:
-        return r
+        result = decoder.decode(data, missing_references)
+    sink.observe(metrics.LOADS_SECONDS, default_timer() - start)
+    sink.observe(metrics.PAYLOAD_BYTES, len(data), _LOADS_LABELS)
+    return result
+
+
+def loads_many(bodies, eval_strings=True, missing_references=MISSING_REFERENCE_RAISE, lazy_records=False,
+               executor=None):
+    """ Decode a batch of msgpack payloads produced by dumps, e.g. the messages pulled at once by a consumer
+
+    The payloads share one decoding state: the "<app_label.Model.pk>" references of the whole batch are fetched
+    with one query per model, and a missing one fails the whole batch unless MISSING_REFERENCE_NONE is used.
+
+    :param bodies: the payloads, see loads
+    :param eval_strings: see loads
+    :param missing_references: see loads
+    :param lazy_records: see loads
+    :param executor: a concurrent.futures executor inflating the compressed payloads (see enable_compression),
+        e.g. a ProcessPoolExecutor, while msgpack and Django run in the calling thread
+    :return: the list of the decoded objects, in the order of bodies
+    """
+    bodies = [_as_buffer(s) for s in bodies]
+    decoder = _Decoder(eval_strings, lazy_records)
+    if _metrics is None:
+        return decoder.decode_many(bodies, missing_references, executor)
+    start = default_timer()
+    result = decoder.decode_many(bodies, missing_references, executor)
+    elapsed = (default_timer() - start) / max(len(bodies), 1)
+    for data in bodies:
+        _metrics.observe(metrics.LOADS_SECONDS, elapsed)
+        _metrics.observe(metrics.PAYLOAD_BYTES, len(data), _LOADS_LABELS)
+    return result
+
+
+def dumps_many(objs, record_batch_min_rows=None, dedup=False, executor=None):
+    """ Encode a batch of objects into as many msgpack payloads, each of them decoded on its own by loads
+
+    :param objs: the objects
+    :param record_batch_min_rows: see dumps
+    :param dedup: see dumps, the objects are shared within each payload only
+    :param executor: a concurrent.futures executor compressing the payloads (see enable_compression),
+        e.g. a ProcessPoolExecutor, while the objects are encoded in the calling thread
+    :return: the list of the payloads, in the order of objs
+    """
+    objs = list(objs)
+    sink = _metrics
+    start = default_timer()
+    counting = sink is not None
+    if OFFLOAD_MIN_ITEMS is not None and len(objs) >= OFFLOAD_MIN_ITEMS:
+        payloads = _tpool_execute(_pack_payloads, objs, record_batch_min_rows, dedup, counting)
+    else:
+        payloads = _pack_payloads(objs, record_batch_min_rows, dedup, counting)
+    if COMPRESSION_THRESHOLD is not None:
+        indexes = [index for index, data in enumerate(payloads) if len(data) > COMPRESSION_THRESHOLD]
+        uncompressed = [payloads[index] for index in indexes]
+        if executor is None:
+            compressed = [compress_payload(data) for data in uncompressed]
+        else:
+            compressed = executor.map(compress_payload, uncompressed, repeat(COMPRESSION_CODEC),
+                                      repeat(COMPRESSION_LEVEL))
+        for index, data in zip(indexes, compressed):
+            if counting and len(data) != len(payloads[index]):
+                sink.inc(metrics.EXT_TYPES, _ext_labels('dumps', ExternalType.COMPRESSED))
+            payloads[index] = data
+    if counting:
+        elapsed = (default_timer() - start) / max(len(payloads), 1)
+        for data in payloads:
+            sink.observe(metrics.DUMPS_SECONDS, elapsed)
+            sink.observe(metrics.PAYLOAD_BYTES, len(data), _DUMPS_LABELS)
+    return payloads
+
+
+def _pack_payloads(objs, record_batch_min_rows, dedup, counting=False):
+    return [_pack_payload(o, record_batch_min_rows, dedup, counting) for o in objs]
+
+
+def _array_header(length):
+    return Packer().pack_array_header(length)
+
+
+def iter_dumps(iterable, length=None, chunk_size=65536, record_batch_min_rows=None, dedup=False):
+    """ Encode the items of an iterable as a msgpack array, one item at a time
+
+    The result is the same as dumps(list(iterable)), without holding all the items nor the whole payload in memory.
+    An EvaluatedQuerySet is streamed one chunk of rows at a time instead, without counting them first,
+    loads and iter_loads put its chunks back together.
+
+    :param iterable: the items, e.g. a generator or a QuerySet.iterator(), or an EvaluatedQuerySet
+    :param length: the number of items, required when the iterable has no len()
+    :param chunk_size: the encoded items are yielded in chunks of about this size, the rows of an EvaluatedQuerySet
+        in chunks of its own chunk_size rows
+    :param record_batch_min_rows: see dumps
+    :param dedup: see dumps, the objects are shared within each item only
+    :return: a generator of bytes
+    """
+    if isinstance(iterable, EvaluatedQuerySet):
+        for data in _iter_dumps_evaluated_queryset(iterable):
+            yield data
+        return
+    if length is None:
+        try:
+            length = len(iterable)
+        except TypeError:
+            raise TypeError('length is required to encode an iterable which has no len()')
+    chunk = [_array_header(length)]
+    size = 0
+    count = 0
+    for item in iterable:
+        count += 1
+        if count > length:
+            raise ValueError('the iterable has more than {} items'.format(length))
+        data = dumps(item, record_batch_min_rows, dedup)
+        chunk.append(data)
+        size += len(data)
+        if size >= chunk_size:
+            yield b''.join(chunk)
+            chunk = []
+            size = 0
+    if count < length:
+        raise ValueError('the iterable has {} items instead of {}'.format(count, length))
+    if chunk:
+        yield b''.join(chunk)
+
+
+def _iter_chunks(stream_or_chunks, read_size):
+    read = getattr(stream_or_chunks, 'read', None)
+    if read is None:
+        for chunk in stream_or_chunks:
+            yield chunk
+    else:
+        chunk = read(read_size)
+        while chunk:
+            yield chunk
+            chunk = read(read_size)
+
+
+def _read_more(read, unpacker, chunks):
+    while True:
+        try:
+            return read()
+        except OutOfData:
+            for chunk in chunks:
+                if chunk:
+                    unpacker.feed(chunk)
+                    break
+            else:
+                raise ValueError('the msgpack payload is truncated')
+
+
+def _read_ext_header(chunk, chunks):
+    """ Complete the first chunk of a payload starting with an ext type with the next chunks, up to its code """
+    size = 1 + _ext_header_structs[bytearray(chunk[:1])[0]].size
+    while len(chunk) < size:
+        more = next(chunks, None)
+        if more is None:
+            break
+        chunk = bytes(chunk) + bytes(more)
+    return chunk
+
+
+def _ext_code(data):
+    """ :return: the code of the ext type starting data, None when it does not start with an ext type header """
+    header = _ext_header_structs.get(bytearray(data[:1])[0])
+    if header is None or len(data) < 1 + header.size:
+        return None
+    return header.unpack_from(data, 1)[1]
+
+
+def _inflated_chunks(first_chunk, chunks, read_size):
+    """ Read a payload starting with an ext type whole, inflated when it is a compressed payload (see dumps),
+    and split it again into chunks of read_size bytes
+    """
+    data = b''.join([bytes(first_chunk)] + [bytes(chunk) for chunk in chunks])
+    compressed = _top_level_compressed(data)
+    if compressed:
+        data = _decompress(compressed) or data
+    view = memoryview(data)
+    for start in range(0, len(data), read_size):
+        yield view[start:start + read_size]
+
+
+def iter_loads(stream_or_chunks, eval_strings=True, missing_references=MISSING_REFERENCE_RAISE, lazy_records=False,
+               batch_size=100, read_size=65536):
+    """ Decode a msgpack payload incrementally, yielding the items of its top level array one at a time
+
+    A payload which is not an array is yielded as a single object. Only the items of the current batch
+    and the unconsumed part of the payload are held in memory, except for a compressed payload
+    (see enable_compression): it is read and inflated whole, then its items are decoded one at a time.
+    An EvaluatedQuerySet streamed by iter_dumps is yielded once its chunks are read, as loads decodes it.
+
+    :param stream_or_chunks: a file-like object or an iterable of bytes, e.g. the output of iter_dumps
+    :param eval_strings: see loads, the paths are relative to the top level array (e.g. ``'*.created_at'``)
+    :param missing_references: see loads
+    :param lazy_records: see loads
+    :param batch_size: the "<app_label.Model.pk>" references of this many items are fetched together
+    :param read_size: the size of the reads from a file-like object, and the initial size of the unpacker buffer
+    :return: a generator of the decoded items
+    """
+    decoder = _Decoder(eval_strings, lazy_records)
+    unpacker = decoder.unpacker(read_size=read_size)
+    chunks = _iter_chunks(stream_or_chunks, read_size)
+    for chunk in chunks:
+        if chunk:
+            first_byte = bytearray(chunk[:1])[0]
+            if first_byte in _ext_header_structs:
+                chunk = _read_ext_header(chunk, chunks)
+                if _ext_code(chunk) == ExternalType.COMPRESSED:
+                    chunks = _inflated_chunks(chunk, chunks, read_size)
+                    chunk = next(chunks)
+                    first_byte = bytearray(chunk[:1])[0]
+            unpacker.feed(chunk)
+            break
+    else:
+        return
+    if not (0x90 <= first_byte <= 0x9f or first_byte in (0xdc, 0xdd)):  # not an array header
+        item = _read_more(unpacker.unpack, unpacker, chunks)
+        if item.__class__ is _QuerySetStream:
+            root = [decoder.join_queryset_stream(item, lambda: _read_more(unpacker.unpack, unpacker, chunks))]
+        else:
+            root = decoder.evaluate(item)
+        decoder.references.resolve(missing_references)
+        yield root[0]
+        return
+    length = _read_more(unpacker.read_array_header, unpacker, chunks)
+    tree = decoder.eval_strings.tree if isinstance(decoder.eval_strings, EvalPaths) else None
+    batch = []
+    for index in range(length):
+        decoder.definitions = {}  # the shared objects of each item are numbered from 0, see iter_dumps
+        item = _read_more(unpacker.unpack, unpacker, chunks)
+        if tree is None:
+            batch.append(decoder.evaluate(item))
+        else:
+            node = tree.get(str(index), tree.get('*'))
+            batch.append([item] if node is None else decoder.evaluate(item, node))
+        if len(batch) >= batch_size or index == length - 1:
+            decoder.references.resolve(missing_references)
+            for root in batch:
+                yield root[0]
+            batch = []
+
+
+class _Codec(object):
+
+    def __init__(self, name, code, compress, decompress):
+        self.name = name
+        self.code = code
+        self.compress = compress  # (data, level or None) -> bytes
+        self.decompress = decompress
+
+
+_codecs = {}
+_codecs_by_code = {}
+
+
+def _register_codec(codec):
+    _codecs[codec.name] = _codecs_by_code[codec.code] = codec
+
+
+# the default levels favour speed, higher levels barely shrink msgpack payloads further (see bench_compression)
+_register_codec(_Codec('zlib', 0, lambda data, level: zlib.compress(data, 1 if level is None else level),
+                       zlib.decompress))
+if lzma is not None:
+    _register_codec(_Codec('lzma', 1, lambda data, level: lzma.compress(data, preset=level or 0), lzma.decompress))
+if lz4 is not None:
+    _register_codec(_Codec('lz4', 2, lambda data, level: lz4.frame.compress(data, compression_level=level or 0),
+                           lz4.frame.decompress))
+if zstandard is not None:
+    _register_codec(_Codec('zstd', 3, lambda data, level: zstandard.ZstdCompressor(level=level or 3).compress(data),
+                           lambda data: zstandard.ZstdDecompressor().decompress(data)))
+
+
+def compress_payload(data, codec=None, level=None):
+    """ Wrap a msgpack payload into a compressed ext type, loads inflates it transparently
+
+    :param data: the msgpack payload
+    :param codec: the name of the codec, COMPRESSION_CODEC by default
+    :param level: the compression level of the codec, COMPRESSION_LEVEL by default
+    :return: the compressed payload, or data when compressing does not make it smaller
+    """
+    codec = _codecs[codec or COMPRESSION_CODEC]
+    compressed = codec.compress(data, COMPRESSION_LEVEL if level is None else level)
+    if len(compressed) + 6 >= len(data):  # 1 byte of codec + up to 5 bytes of ext header
+        return data
+    return packb(ExtType(ExternalType.COMPRESSED, struct.pack('B', codec.code) + compressed))
+
+
+def _decompress(data):
+    codec = _codecs_by_code.get(bytearray(data[:1])[0])
+    if codec is None:  # the codec is not installed
+        return None
+    return codec.decompress(memoryview(data)[1:])
+
+
+DEFAULT_COMPRESSION_THRESHOLD = 64 << 10
+
+# dumps compresses the payloads bigger than COMPRESSION_THRESHOLD bytes, None to never compress them
+COMPRESSION_THRESHOLD = None
+COMPRESSION_CODEC = 'zlib'
+COMPRESSION_LEVEL = None
+
+
+def enable_compression(threshold=DEFAULT_COMPRESSION_THRESHOLD, codec='zlib', level=None):
+    """ Compress the payloads encoded by dumps above a size
+
+    loads inflates them whatever the setting, so enable it once all the consumers run a version which decodes it
+    (and which has the codec installed).
+
+    :param threshold: the size in bytes above which a payload is compressed, None to disable the compression
+    :param codec: 'zlib', 'lzma' (python 3), 'lz4' (when lz4 is installed) or 'zstd' (when zstandard is installed)
+    :param level: the compression level of the codec, its default level when None
+    """
+    global COMPRESSION_THRESHOLD, COMPRESSION_CODEC, COMPRESSION_LEVEL
+    if codec not in _codecs:
+        raise ValueError('unknown or not installed compression codec: {}'.format(codec))
+    COMPRESSION_THRESHOLD = threshold
+    COMPRESSION_CODEC = codec
+    COMPRESSION_LEVEL = level
+
+
+# the headers of the ext 8, ext 16 and ext 32 formats: the size of the data and the ext type code
+_ext_header_structs = {0xc7: struct.Struct('>Bb'), 0xc8: struct.Struct('>Hb'), 0xc9: struct.Struct('>Ib')}
+
+
+def _top_level_compressed(data):
+    """ :return: the data of the COMPRESSED ext type when it is the whole payload, None otherwise """
+    header = _ext_header_structs.get(bytearray(data[:1])[0])
+    if header is None:
+        return None
+    size, code = header.unpack_from(data, 1)
+    if code != ExternalType.COMPRESSED:
+        return None
+    return bytes(data[1 + header.size:1 + header.size + size])
+
+
+def _has_many_items(o):
+    cls = type(o)
+    if cls is list or cls is tuple or cls is dict or cls is set:
+        return len(o) >= OFFLOAD_MIN_ITEMS
+    elif cls is RecordBatch:
+        return len(o.rows) >= OFFLOAD_MIN_ITEMS
+    return False
+
+
+def _offload_bytes(fn, *args):
+    """ Run a function of bytes, which needs no Django state, in the process pool when there is one """
+    if _offload_executor is not None:
+        return _offload_executor.submit(fn, *args).result()
+    return _tpool_execute(fn, *args)
+
+
+DEFAULT_OFFLOAD_THRESHOLD = 1 << 20
+DEFAULT_OFFLOAD_MIN_ITEMS = 10000
+
+# loads decodes the payloads bigger than OFFLOAD_THRESHOLD bytes and dumps encodes the lists, tuples, dicts and sets
+# of at least OFFLOAD_MIN_ITEMS items outside of the eventlet hub, None to never offload them
+OFFLOAD_THRESHOLD = None
+OFFLOAD_MIN_ITEMS = None
+_tpool_execute = None
+_offload_executor = None
+
+
+def enable_offload(threshold=DEFAULT_OFFLOAD_THRESHOLD, min_items=DEFAULT_OFFLOAD_MIN_ITEMS, executor=None):
+    """ Encode and decode the big payloads in eventlet.tpool threads, so that the eventlet hub keeps serving
+    the heartbeats and the other workers meanwhile, the small payloads are still handled inline
+
+    The size of a payload is only known once encoded, so dumps offloads the payloads made of many items instead.
+    The "<app_label.Model.pk>" references are still fetched from the calling greenthread.
+
+    :param threshold: the size in bytes above which loads offloads a payload, once inflated: the compressed payloads
+        are always inflated outside of the hub. None to never offload loads
+    :param min_items: the number of items of a list, tuple, dict or set above which dumps offloads it,
+        None to never offload dumps
+    :param executor: a concurrent.futures.ProcessPoolExecutor to compress and inflate the payloads (see
+        enable_compression), the work which needs no Django state, in other processes instead of tpool threads.
+        Give it a 'spawn' or 'forkserver' mp_context: forking once tpool threads are running may deadlock.
+    """
+    global OFFLOAD_THRESHOLD, OFFLOAD_MIN_ITEMS, _tpool_execute, _offload_executor
+    if threshold is not None or min_items is not None:
+        from eventlet import tpool
+        _tpool_execute = tpool.execute
+    OFFLOAD_THRESHOLD = threshold
+    OFFLOAD_MIN_ITEMS = min_items
+    _offload_executor = executor
 
 
 register_args = (dumps, loads, 'application/x-django-msgpackpickle', 'binary')
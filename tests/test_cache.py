@@ -0,0 +1,59 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#  test_cache.py
+#
+#  Copyright (c) 2021 nameko-django. All rights reserved.
+from __future__ import unicode_literals
+
+from nameko_django.cache import LRUCache
+
+
+def test_lru_cache_count_eviction():
+    cache = LRUCache(max_count=3)
+    for key in 'abc':
+        cache.set(key, key.upper())
+    assert cache.get('a') == 'A'  # 'b' becomes the least recently used
+    cache.set('d', 'D')
+    assert 'b' not in cache
+    assert [cache.get(key) for key in 'acd'] == ['A', 'C', 'D']
+    assert cache.get('b') is None
+    assert cache.stats() == dict(count=3, size=3, hits=4, misses=1, evictions=1, hit_rate=0.8)
+
+
+def test_lru_cache_size_eviction():
+    cache = LRUCache(max_count=10, max_size=100)
+    cache.set('a', b'a' * 40, 40)
+    cache.set('b', b'b' * 40, 40)
+    cache.set('c', b'c' * 40, 40)
+    assert 'a' not in cache and len(cache) == 2 and cache.size == 80
+    cache.set('b', b'b', 1)
+    assert cache.size == 41
+    cache.set('huge', b'x' * 200, 200)
+    assert 'huge' not in cache and cache.size == 41
+    cache.configure(max_count=1)
+    assert len(cache) == 1 and cache.get('b') == b'b'
+    assert cache.pop('b') == b'b' and cache.size == 0
+    assert cache.evictions == 2
+
+
+def test_lru_cache_disabled():
+    cache = LRUCache(max_count=0)
+    cache.set('a', 'A')
+    assert len(cache) == 0 and cache.get('a') is None
+    assert cache.hit_rate == 0.0
+
+
+def test_lru_cache_ttl():
+    now = [100.0]
+    cache = LRUCache(max_count=10, ttl=5, clock=lambda: now[0])
+    cache.set('a', 'A')
+    now[0] += 4
+    cache.set('b', 'B')
+    assert cache.get('a') == 'A' and 'a' in cache
+    now[0] += 1
+    assert 'a' not in cache and cache.get('a') is None
+    assert cache.get('b') == 'B'
+    now[0] += 4
+    assert cache.get('b') is None
+    assert len(cache) == 0 and cache.stats() == dict(count=0, size=0, hits=2, misses=2, evictions=2, hit_rate=0.5)
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#  test_dependencies.py
+#
+#  Copyright (c) 2021 nameko-django. All rights reserved.
+from __future__ import unicode_literals
+
+from threading import Event, Thread
+import time
+
+from django.db import connections
+from mock import call, patch
+from nameko.containers import ServiceContainer
+from nameko.testing.utils import get_extension
+import pytest
+
+from nameko_django.dependencies import DjangoDB, ConnectionPoolTimeout
+from nameko_django.metrics import MetricsRegistry
+from .test_serializer import DJANGO_DEFAULT_SETTING  # noqa: F401, configures django
+
+
+def make_provider(**kwargs):
+    class Service(object):
+        name = 'service'
+        db = DjangoDB(**kwargs)
+
+    provider = get_extension(ServiceContainer(Service, {}), DjangoDB)
+    provider.setup()
+    return provider
+
+
+def run_worker(provider, work):
+    worker_ctx = object()
+    provider.worker_setup(worker_ctx)
+    try:
+        return work(provider.get_dependency(worker_ctx))
+    finally:
+        provider.worker_teardown(worker_ctx)
+
+
+def run_in_threads(count, target):
+    threads = [Thread(target=target) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+@pytest.mark.django_db
+def test_django_db_closes_worker_connections():
+    from django.contrib.auth.models import User
+    used = []
+
+    def work(db):
+        User.objects.count()
+        used.append(db['default'])
+
+    provider = make_provider()
+    with patch.object(type(connections['default']), 'close', autospec=True) as close:
+        run_in_threads(1, lambda: run_worker(provider, work))
+    assert call(used[0]) in close.call_args_list
+
+
+@pytest.mark.django_db
+def test_django_db_pool_bounded():
+    from django.contrib.auth.models import User
+    used = set()
+
+    def work(db):
+        User.objects.count()
+        used.add(id(db['default']))
+        time.sleep(0.005)
+
+    provider = make_provider(pool_size=4)
+    run_in_threads(64, lambda: run_worker(provider, work))  # as many workers as max_workers
+    stats = provider.pool.stats()
+    assert len(used) <= 4 and stats['created'] <= 4 and stats['peak_in_use'] <= 4
+    assert stats['in_use'] == 0 and stats['waits'] > 0 and stats['timeouts'] == 0
+    provider.stop()
+
+
+@pytest.mark.django_db
+def test_django_db_pool_timeout():
+    from django.contrib.auth.models import User
+    sink = MetricsRegistry()
+    provider = make_provider(pool_size=1, pool_timeout=0.05, sink=sink)
+    holding, done = Event(), Event()
+    errors = []
+
+    def hold(db):
+        User.objects.count()
+        holding.set()
+        done.wait(5)
+
+    def starved():
+        try:
+            run_worker(provider, lambda db: User.objects.count())
+        except ConnectionPoolTimeout as exc:
+            errors.append(exc)
+
+    thread = Thread(target=lambda: run_worker(provider, hold))
+    thread.start()
+    holding.wait(5)
+    run_in_threads(1, starved)
+    done.set()
+    thread.join()
+    assert len(errors) == 1
+    assert provider.pool.stats()['timeouts'] == 1 and provider.pool.stats()['in_use'] == 0
+    assert sink.counter('nameko_django_db_pool_timeouts_total') == 1
+    assert sink.histogram('nameko_django_db_pool_wait_seconds').count == 2
+    run_in_threads(1, lambda: run_worker(provider, lambda db: User.objects.count()))  # released
+    provider.stop()
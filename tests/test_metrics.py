@@ -0,0 +1,61 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#  test_metrics.py
+#
+#  Copyright (c) 2021 nameko-django. All rights reserved.
+from __future__ import unicode_literals
+
+from nameko.containers import ServiceContainer
+from nameko.testing.utils import get_extension
+
+from nameko_django import serializer
+from nameko_django.dependencies import SerializerMetrics
+from nameko_django.metrics import Histogram, MetricsRegistry, registry
+
+
+def test_histogram_buckets():
+    histogram = Histogram(buckets=(1, 10))
+    for value in (0.5, 1, 5, 20):
+        histogram.observe(value)
+    assert histogram.counts == [2, 1, 1]
+    assert list(histogram.cumulative_counts()) == [2, 3, 4]
+    assert histogram.sum == 26.5 and histogram.count == 4
+
+
+def test_registry_render():
+    metrics = MetricsRegistry(buckets=dict(latency=(0.1, 1)))
+    metrics.inc('calls_total', (('operation', 'dumps'),))
+    metrics.inc('calls_total', (('operation', 'dumps'),), 2)
+    metrics.observe('latency', 0.5)
+    assert metrics.counter('calls_total', operation='dumps') == 3
+    assert metrics.counter('calls_total', operation='loads') == 0
+    assert metrics.histogram('latency').counts == [0, 1, 0]
+    assert metrics.render() == '\n'.join([
+        '# TYPE calls_total counter',
+        'calls_total{operation="dumps"} 3',
+        '# TYPE latency histogram',
+        'latency_bucket{le="0.1"} 0',
+        'latency_bucket{le="1"} 1',
+        'latency_bucket{le="+Inf"} 1',
+        'latency_sum 0.5',
+        'latency_count 1',
+    ]) + '\n'
+    metrics.reset()
+    assert metrics.render() == '\n'
+
+
+class Service(object):
+    name = 'service'
+    serializer_metrics = SerializerMetrics()
+
+
+def test_serializer_metrics_dependency():
+    container = ServiceContainer(Service, {})
+    provider = get_extension(container, SerializerMetrics)
+    try:
+        provider.setup()
+        assert serializer._metrics is registry
+        assert provider.get_dependency(None) is registry
+    finally:
+        serializer.disable_metrics()
@@ -16,11 +16,17 @@ from django.core.exceptions import ImproperlyConfigured
 from django.test.utils import override_settings
 from mock import call, patch
 import pytest
-from nameko_django.serializer import dumps, loads, DEFAULT_DATETIME_TIMEZONE_STRING_FORMAT
+from nameko_django.serializer import dumps, loads, DEFAULT_DATETIME_TIMEZONE_STRING_FORMAT, register_encoder, \
+    unregister_encoder, EvalPaths, MISSING_REFERENCE_NONE, ExternalType, encode_orm_fields, RecordBatch, RecordRows, \
+    enable_native_datetime, encode_decimal_binary, iter_dumps, iter_loads, decoded_query_cache, enable_metrics, \
+    disable_metrics, enable_compression, pack, _codecs, enable_offload, ReferenceBatch, \
+    LazyMapping, LazySequence, django_ext_hook, EvaluatedQuerySet, QuerySetRows, raw_where_cache, loads_many, \
+    dumps_many, ModelSchemaMismatch
 from nameko_django.helper import DjangoORM, DjangoQS
 from datetime import datetime, date, time, timedelta
 from decimal import Decimal
 from aenum import Enum, IntEnum, Constant
+from msgpack import ExtType, Timestamp, packb, unpackb
 from collections import namedtuple, defaultdict, OrderedDict
 
 try:
@@ -33,8 +39,12 @@ except ImportError:
 
 from django.utils import timezone
 from nose import tools
-from django.db.models import ObjectDoesNotExist
+from django.db.models import ObjectDoesNotExist, Q
 from box import Box, BoxList
+from io import BytesIO
+import os
+import subprocess
+import sys
 
 
 def test_simple_list():
@@ -250,6 +260,301 @@ def test_decimal():
     assert sum(test_data) == sum(dec_data)
 
 
+def test_register_encoder():
+    class Money(object):
+        def __init__(self, amount, currency):
+            self.amount = amount
+            self.currency = currency
+
+    class Dollar(Money):
+        pass
+
+    with tools.assert_raises(TypeError):
+        dumps(Money(Decimal('1.5'), 'USD'))
+    register_encoder(Money, lambda m: [m.amount, m.currency])
+    try:
+        dec_data = loads(dumps({'a': Money(Decimal('1.5'), 'USD'), 'b': Dollar(Decimal('2'), 'USD')}))
+        assert dec_data == {'a': [Decimal('1.5'), 'USD'], 'b': [Decimal('2'), 'USD']}
+        # explicit registration take precedence over the built-in encoders
+        register_encoder(Decimal, lambda d: str(d))
+        assert loads(dumps([Decimal('1.5')])) == ['1.5']
+    finally:
+        unregister_encoder(Money)
+        unregister_encoder(Decimal)
+    assert loads(dumps([Decimal('1.5')])) == [Decimal('1.5')]
+    with tools.assert_raises(TypeError):
+        dumps(Dollar(Decimal('2'), 'USD'))
+
+
+def test_encode_proxies_and_instance_protocols():
+    from django.contrib.auth.models import User
+    from django.utils.functional import SimpleLazyObject
+
+    test_user = User(id=1, username="test_user")
+    dec_data = loads(dumps({'user': SimpleLazyObject(lambda: test_user)}))
+    assert isinstance(dec_data['user'], User) and dec_data['user'].username == "test_user"
+    register_encoder(User, encode_orm_fields)
+    try:
+        assert loads(dumps(SimpleLazyObject(lambda: test_user))).username == "test_user"
+    finally:
+        unregister_encoder(User)
+
+    class Item(object):
+        pass
+
+    item = Item()
+    item.to_dict = lambda: {'id': 1}
+    assert loads(dumps([item, item])) == [{'id': 1}, {'id': 1}]
+    with tools.assert_raises(TypeError):
+        dumps(Item())
+
+
+def test_loads_without_string_evaluation():
+    d1 = datetime(2019, 10, 16, 9, 32, 20, 555204, tzinfo=FixedOffset(0, name="UTC"))
+    test_data = {'text': "2019-09-26", 'items': ["09:16:35.881134", {'at': d1, 'price': Decimal('1.5')}]}
+    dec_data = loads(dumps(test_data), eval_strings=False)
+    assert dec_data == {'text': "2019-09-26", 'items': ["09:16:35.881134", {
+        'at': "2019-10-16 09:32:20.555204+0000", 'price': Decimal('1.5')}]}
+
+
+def test_loads_with_eval_paths():
+    test_data = {'note': "2019-09-26", 'created': "2019-09-26",
+                 'items': [{'at': "09:16:35", 'label': "09:16:35"}, {'at': "+:13"}, "13:00"],
+                 'meta': {'a': "2019-09-26", 'b': ["+13:59"]}, 0: "2019-09-26"}
+    schema = EvalPaths('created', 'items.*.at', 'meta', '0')
+    dec_data = loads(dumps(test_data), eval_strings=schema)
+    assert dec_data == {'note': "2019-09-26", 'created': date(2019, 9, 26),
+                        'items': [{'at': time(9, 16, 35), 'label': "09:16:35"}, {'at': timedelta(0, 13)}, "13:00"],
+                        'meta': {'a': date(2019, 9, 26), 'b': [timedelta(0, 839)]}, 0: date(2019, 9, 26)}
+    assert loads(dumps(test_data), eval_strings=['items.1.at']) == dict(
+        test_data, items=[{'at': "09:16:35", 'label': "09:16:35"}, {'at': timedelta(0, 13)}, "13:00"])
+    assert loads(dumps("2019-09-26"), eval_strings=schema) == "2019-09-26"
+    assert loads(dumps(test_data), eval_strings='created') == dict(test_data, created=date(2019, 9, 26))
+
+
+def test_record_batch():
+    rows = [{'id': i, 'name': 'row {}'.format(i), 'price': Decimal(i) / 4, 'day': date(2019, 9, 26)}
+            for i in range(100)]
+    enc_data = dumps({'rows': rows, 'other': [{'a': 1}, {'b': 2}]}, record_batch_min_rows=10)
+    assert len(enc_data) * 10 < len(dumps({'rows': rows})) * 7
+    assert loads(enc_data) == {'rows': rows, 'other': [{'a': 1}, {'b': 2}]}
+    assert loads(dumps(RecordBatch(rows))) == rows
+    assert loads(dumps(RecordBatch(rows[:1] + [{'id': 1}]))) == rows[:1] + [{'id': 1}]
+    assert loads(dumps(RecordBatch([]))) == []
+    lazy_rows = loads(dumps(RecordBatch(rows)), lazy_records=True)
+    assert isinstance(lazy_rows, RecordRows)
+    assert len(lazy_rows) == 100 and lazy_rows[7] == rows[7] and lazy_rows[-2:] == rows[-2:]
+    assert lazy_rows == rows
+    assert loads(dumps(RecordBatch(rows)), eval_strings=False) == [dict(row, day="2019-09-26") for row in rows]
+    assert loads(dumps(RecordBatch(rows)), eval_strings=['*.day'], lazy_records=True) == rows
+    for key in (Decimal('1.5'), date(2019, 9, 26)):  # keys accepted by dumps
+        keyed_rows = [{key: i, 'id': i} for i in range(20)]
+        assert loads(dumps(keyed_rows, record_batch_min_rows=10)) == loads(dumps(keyed_rows))
+        assert loads(dumps(RecordBatch(keyed_rows))) == loads(dumps(keyed_rows))
+    keyed_rows = [{(1, 2): i, 'id': i} for i in range(20)]
+    assert dumps(keyed_rows, record_batch_min_rows=10) == dumps(RecordBatch(keyed_rows)) == dumps(keyed_rows)
+
+
+def test_native_datetime():
+    d0 = datetime(2019, 9, 26, 9, 16, 35, 881134, tzinfo=timezone.get_fixed_timezone(420))
+    d1 = datetime(1919, 10, 16, 9, 32, 20, 555204)
+    t0 = time(9, 16, 35, 881134, tzinfo=timezone.get_fixed_timezone(-90))
+    test_data = [d0, d1, date(2019, 9, 26), time(9, 32, 20), t0, timedelta(-2, 86398, 876987), timedelta(0, 13),
+                 "2019-09-26"]
+    legacy_data = dumps(test_data)
+    enable_native_datetime()
+    try:
+        enc_data = dumps(test_data)
+    finally:
+        enable_native_datetime(False)
+    assert dumps(test_data) == legacy_data
+    assert len(enc_data) * 3 < len(legacy_data) * 2
+    assert [type(e) for e in unpackb(enc_data, raw=False)] == [Timestamp] + [ExtType] * 6 + [type("")]
+    dec_data = loads(enc_data)
+    assert dec_data == test_data[:-1] + [date(2019, 9, 26)]
+    assert dec_data[4].utcoffset() == timedelta(minutes=-90)
+    assert loads(enc_data, eval_strings=False) == test_data
+    legacy_dec_data = loads(legacy_data)
+    assert legacy_dec_data[:4] + legacy_dec_data[5:] == dec_data[:4] + dec_data[5:]
+
+
+def test_decimal_binary():
+    test_data = [Decimal(1.5545), Decimal("1.4555"), Decimal("-1.99"), Decimal(1.0 / 3), Decimal("0.00"),
+                 Decimal("-0.0"), Decimal("1E+5"), Decimal("-12345678901234567890.123456789012345678901234567890"),
+                 Decimal("9223372036854775807"), Decimal("-9223372036854775808"), Decimal("9223372036854775808"),
+                 Decimal("NaN"), Decimal("-Infinity"), 1, 0]
+    legacy_data = dumps(test_data)
+    register_encoder(Decimal, encode_decimal_binary)
+    try:
+        enc_data = dumps(test_data)
+    finally:
+        unregister_encoder(Decimal)
+    assert len(enc_data) < len(legacy_data)
+    for data in (enc_data, legacy_data):
+        dec_data = loads(data)
+        assert [str(d) for d in dec_data] == [str(d) for d in test_data]
+        assert [d.as_tuple() for d in dec_data[:-2]] == [d.as_tuple() for d in test_data[:-2]]
+
+
+def test_loads_buffers():
+    test_data = {'a': [1, 2, "2019-09-26"], 'b': Decimal("1.5")}
+    enc_data = dumps(test_data)
+    expected = {'a': [1, 2, date(2019, 9, 26)], 'b': Decimal("1.5")}
+    assert loads(bytearray(enc_data)) == expected
+    assert loads(memoryview(enc_data)) == expected
+    assert loads(memoryview(b"x" + enc_data)[1:]) == expected
+    strided = bytearray(len(enc_data) * 2)
+    strided[::2] = enc_data
+    assert loads(memoryview(strided)[::2]) == expected
+
+
+def test_loads_memoryview_without_copy():
+    tracemalloc = pytest.importorskip('tracemalloc')
+    blob = b"x" * (8 << 20)
+    enc_data = memoryview(bytearray(dumps([blob])))
+    tracemalloc.start()
+    try:
+        dec_data = loads(enc_data)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert dec_data == [blob]
+    assert peak < len(blob) * 1.5
+
+
+def test_dumps_reentrant_and_failure():
+    class Wrapper(object):
+        def __init__(self, value):
+            self.value = value
+
+    register_encoder(Wrapper, lambda w: dumps(w.value))
+    try:
+        enc_data = dumps([Wrapper([Decimal("1.5"), Wrapper("a")]), 1])
+    finally:
+        unregister_encoder(Wrapper)
+    assert loads(loads(enc_data)[0]) == [Decimal("1.5"), dumps("a")]
+    with tools.assert_raises(TypeError):
+        dumps([1, 2, object()])
+    assert loads(dumps([3, 4])) == [3, 4]
+
+
+def test_iter_dumps_iter_loads():
+    test_data = [{'i': i, 'd': Decimal(i) / 8, 'day': "2019-09-26", 'text': 'x' * (i % 50)} for i in range(1000)]
+    chunks = list(iter_dumps(iter(test_data), length=len(test_data), chunk_size=1024))
+    assert len(chunks) > 10
+    assert b''.join(chunks) == dumps(test_data)
+    expected = [dict(row, day=date(2019, 9, 26)) for row in test_data]
+    assert list(iter_loads(chunks)) == expected
+    body = b''.join(chunks)
+    assert list(iter_loads(body[i:i + 7] for i in range(0, len(body), 7))) == expected
+    assert list(iter_loads(BytesIO(body), read_size=100)) == expected
+    assert list(iter_loads([body], eval_strings=['*.day'])) == expected
+    assert list(iter_loads([body], eval_strings=['3'])) == [
+        row if i == 3 else dict(row, day="2019-09-26") for i, row in enumerate(expected)]
+    assert list(iter_loads([dumps({'a': "2019-09-26"})])) == [{'a': date(2019, 9, 26)}]
+    assert list(iter_loads([dumps("2019-09-26")])) == [date(2019, 9, 26)]
+    assert list(iter_loads([dumps([])])) == []
+    assert list(iter_loads([])) == []
+    assert list(iter_loads([dumps(Decimal('1.5'))])) == [Decimal('1.5')]
+    enable_compression(threshold=1024)
+    try:
+        compressed = dumps(test_data)
+    finally:
+        enable_compression(threshold=None)
+    assert unpackb(compressed).code == ExternalType.COMPRESSED
+    assert list(iter_loads(compressed[i:i + 7] for i in range(0, len(compressed), 7))) == expected
+    assert list(iter_loads(BytesIO(compressed), read_size=100, eval_strings=['*.day'])) == expected
+    with tools.assert_raises(ValueError):
+        list(iter_loads([body[:-3]]))
+    with tools.assert_raises(TypeError):
+        list(iter_dumps(iter(test_data)))
+    with tools.assert_raises(ValueError):
+        list(iter_dumps(iter(test_data), length=10))
+    with tools.assert_raises(ValueError):
+        list(iter_dumps(test_data, length=2000))
+
+
+def test_iter_loads_bounded_memory():
+    tracemalloc = pytest.importorskip('tracemalloc')
+    rows = ({'i': i, 'text': 'x' * 100} for i in range(50000))
+    tracemalloc.start()
+    try:
+        count = 0
+        for row in iter_loads(iter_dumps(rows, length=50000)):
+            count += 1
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert count == 50000
+    assert peak * 5 < len(dumps([{'i': i, 'text': 'x' * 100} for i in range(50000)]))
+
+
+def test_loads_evaluates_strings_in_place():
+    tracemalloc = pytest.importorskip('tracemalloc')
+    deep = {'name': 'leaf'}
+    for level in range(100):
+        deep = {'level': level, 'children': [deep, 'text {}'.format(level)]}
+    payload = {'rows': [{'id': i, 'tags': ['a', 'b'], 'meta': {'name': 'row'}} for i in range(5000)],
+               'index': dict(('key{}'.format(i), i) for i in range(20000)), 'deep': deep}
+    enc_data = dumps(payload)
+    tracemalloc.start()
+    try:
+        dec_data = loads(enc_data)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert dec_data == payload
+    # the containers built by msgpack are kept rather than copied: nothing but the result is allocated
+    assert peak < current * 1.02
+    dict_obj, list_obj = {'day': '2019-09-26', 'id': 1}, ['text', '09:16:35.000000']
+    references = ReferenceBatch()
+    assert references.decode_dict_object(dict_obj) is dict_obj and dict_obj['day'] == date(2019, 9, 26)
+    assert references.decode_list_object(list_obj) is list_obj and list_obj == ['text', time(9, 16, 35)]
+
+
+def test_lazy_loads():
+    shared = {'price': Decimal('1.5')}
+    test_data = {'rows': [{'id': i, 'day': '2019-09-26', 'price': Decimal(i) / 4} for i in range(10)],
+                 'records': RecordBatch([{'id': i, 'day': '2019-09-26'} for i in range(3)]),
+                 'first': shared, 'second': shared, 'day': '2019-09-26', 'nested': [[1, [2, 'text']]]}
+    enc_data = dumps(test_data, dedup=True)
+    eager = loads(enc_data)
+    for eval_strings in (True, False, ['rows.*.day', 'records']):
+        dec_data = loads(enc_data, eval_strings=eval_strings, lazy=True)
+        assert isinstance(dec_data, LazyMapping) and isinstance(dec_data['rows'], LazySequence)
+        assert dec_data == loads(enc_data, eval_strings=eval_strings)
+        assert dec_data.materialize() == loads(enc_data, eval_strings=eval_strings)
+    dec_data = loads(enc_data, lazy=True)
+    with patch('nameko_django.serializer.django_ext_hook', wraps=django_ext_hook) as ext_hook:
+        assert dec_data['rows'][-1]['day'] == date(2019, 9, 26)
+        assert not ext_hook.called  # the decimals are only decoded when read
+        assert dec_data['rows'][-1]['price'] == Decimal('2.25')
+        assert ext_hook.call_count == 1
+        assert dec_data['rows'][-1]['price'] is dec_data['rows'][-1]['price']
+    assert dec_data['second'] is dec_data['first']  # the back reference is read before its definition
+    assert dec_data['second'] is not shared and dec_data['second'] == shared
+    assert dec_data['records'] == eager['records']
+    assert dec_data['nested'][0][1][1] == 'text' and dec_data['nested'][-1][-1] == [2, 'text']
+    assert dec_data['rows'][2:4] == eager['rows'][2:4] and 'day' in dec_data and 'missing' not in dec_data
+    with tools.assert_raises(TypeError):
+        dec_data['day'] = None
+    with tools.assert_raises(IndexError):
+        dec_data['rows'][10]
+    assert loads(dumps(Decimal('1.5')), lazy=True) == Decimal('1.5')
+    assert loads(dumps('2019-09-26'), lazy=True) == date(2019, 9, 26)
+    enable_compression(threshold=64)
+    try:
+        assert loads(dumps(test_data), lazy=True)['rows'][1]['price'] == Decimal('0.25')
+    finally:
+        enable_compression(threshold=None)
+    shared = {'at': '2019-09-26'}
+    dec_data = loads(dumps({'a': [shared], 'b': '<auth.User.999>', 'c': [shared]}, dedup=True), lazy=True)
+    with patch('nameko_django.serializer.ReferenceBatch.fetch') as fetch:
+        assert dec_data['c'][0] == {'at': date(2019, 9, 26)}  # the reference which is not read is not fetched
+        assert dec_data['a'][0] is dec_data['c'][0]
+    assert not fetch.called
+
+
 DJANGO_DEFAULT_SETTING = dict(
     INSTALLED_APPS=('django.contrib.auth', 'django.contrib.contenttypes',),
     DATABASES=dict(default={'ENGINE': 'django.db.backends.sqlite3'}),
@@ -273,6 +578,26 @@ def test_django_timezone():
     assert today == dec_data
 
 
+def test_emitted_datetime_strings_skip_dateparse():
+    emitted = [datetime(2019, 9, 26, 9, 16, 35, 881134, tzinfo=timezone.get_fixed_timezone(330)),
+               datetime(2019, 9, 26, 9, 16, 35, 881134, tzinfo=timezone.get_fixed_timezone(-60)),
+               datetime(2019, 9, 26, 9, 16, 35), date(2019, 9, 26), time(9, 16, 35, 881134),
+               timedelta(0, 50398, 876987), timedelta(0, 839)]
+    enc_data = dumps(emitted)
+    with patch('django.utils.dateparse.parse_datetime') as parse_datetime, \
+            patch('django.utils.dateparse.parse_date') as parse_date, \
+            patch('django.utils.dateparse.parse_time') as parse_time, \
+            patch('django.utils.dateparse.parse_duration') as parse_duration:
+        dec_data = loads(enc_data)
+    assert not (parse_datetime.called or parse_date.called or parse_time.called or parse_duration.called)
+    assert dec_data == emitted
+    assert [value.utcoffset() for value in dec_data[:2]] == [timedelta(minutes=330), timedelta(minutes=-60)]
+    # the other formats and the invalid values are still left to dateparse
+    assert loads(dumps(['1 day, 1:02:03', '2019-09-26T09:16:35.5Z', '2019-02-30', '24:00:00.000000'])) == [
+        timedelta(1, 3723), datetime(2019, 9, 26, 9, 16, 35, 500000, tzinfo=timezone.utc),
+        '2019-02-30', '24:00:00.000000']
+
+
 def test_django_orm():
     from django.contrib.auth.models import User
     test_user = User(username="test_user", email="test_user@gmail.com")
@@ -295,6 +620,20 @@ def test_django_orm_queryset():
     assert str(qs1) == str(qs2)
 
 
+def test_django_orm_queryset_decode_cache():
+    from django.contrib.auth.models import User
+    test_user_qs = User.objects.filter(last_login__isnull=False, id__gt=1000).order_by('-id')
+    enc_data = dumps(test_user_qs)
+    decoded_query_cache.clear()
+    decoded_query_cache.reset_stats()
+    qs1 = loads(enc_data)
+    qs2 = loads(enc_data)
+    assert decoded_query_cache.hits == 1 and decoded_query_cache.misses == 1
+    assert qs1.query is not qs2.query
+    qs1.query.add_q(Q(username='a'))
+    assert str(qs2.query) == str(test_user_qs.query) == str(loads(enc_data).query) != str(qs1.query)
+
+
 @pytest.mark.django_db
 def test_django_orm_with_db(admin_user):
     enc_data = dumps(admin_user)
@@ -351,6 +690,10 @@ def test_django_orm_queryset_eval_with_db(admin_user):
     u = dec_data.first()
     assert u.username == admin_user.username
     assert u.email == admin_user.email
+    # a literal % can be written as it is or escaped as %%
+    assert list(loads(dumps(DjangoQS(User, "username like 'adm%'")))) == [admin_user]
+    assert list(loads(dumps(DjangoQS(User, "username like 'adm%%' and id %% 2 = {}".format(admin_user.id % 2))))) == [
+        admin_user]
 
 
 @pytest.mark.django_db
@@ -377,3 +720,500 @@ def test_django_orm_queryset_with_db_using_helper():
     logger.debug("%s <> %s", qs1, qs2)
     assert qs1.model._meta.db_table == qs2.model._meta.db_table
     assert len(test_user_qs) == len(dec_data)
+
+
+@pytest.mark.django_db
+def test_django_orm_queryset_params_with_db(django_assert_num_queries):
+    from django.contrib.auth.models import User
+    from django.db import connection
+    now = timezone.now()
+    users = [User.objects.create(username="user_{}%".format(i), date_joined=now - timedelta(days=i)) for i in range(10)]
+    where = "username LIKE %s AND date_joined > %s"
+    enc_data = dumps([DjangoQS(User, where, ["user_{}%%".format(i), now - timedelta(days=5)]) for i in range(10)] +
+                     [DjangoQS(User, where, ["' OR 1=1 --", now - timedelta(days=100)])])
+    assert unpackb(enc_data, raw=False)[0].code == ExternalType.RAW_WHERE_QUERYSET
+    raw_where_cache.clear()
+    with django_assert_num_queries(0):
+        dec_data = loads(enc_data)
+    assert len(raw_where_cache) == 1
+    statements = []
+
+    def record(execute, sql, params, many, context):
+        statements.append((sql, params))
+        return execute(sql, params, many, context)
+
+    with django_assert_num_queries(11), connection.execute_wrapper(record):
+        assert [list(qs) for qs in dec_data] == [[u] for u in users[:5]] + [[]] * 6
+    assert len(set(sql for sql, params in statements)) == 1  # one statement prepared and planned once
+    assert len(set(params for sql, params in statements)) == 11
+    with tools.assert_raises(ValueError):
+        DjangoQS(User, "", [1])
+
+
+@pytest.mark.django_db
+def test_django_orm_eval_batched_with_db(django_assert_num_queries):
+    from django.contrib.auth.models import User, Group
+    users = [User.objects.create(username="user_{}".format(i)) for i in range(50)]
+    group = Group.objects.create(name="group")
+    test_data = {'users': [DjangoORM(User, u.id) for u in users],
+                 'owners': [{'user': DjangoORM(User, u.id), 'group': DjangoORM(Group, group.id)} for u in users[:5]]}
+    enc_data = dumps(test_data)
+    with django_assert_num_queries(2):
+        dec_data = loads(enc_data)
+    assert dec_data['users'] == users
+    assert [o['user'] for o in dec_data['owners']] == users[:5]
+    assert all(o['group'] == group for o in dec_data['owners'])
+    with django_assert_num_queries(1):
+        assert loads(enc_data, eval_strings=['owners.*.user']) == dict(
+            test_data, owners=[{'user': u, 'group': DjangoORM(Group, group.id)} for u in users[:5]])
+
+
+@pytest.mark.django_db
+def test_lazy_loads_with_db(django_assert_num_queries):
+    from django.contrib.auth.models import User
+    users = [User.objects.create(username="user_{}".format(i)) for i in range(5)]
+    test_data = {'users': [DjangoORM(User, u.id) for u in users], 'status': 'ok'}
+    enc_data = dumps(test_data)
+    with django_assert_num_queries(0):
+        dec_data = loads(enc_data, lazy=True)
+        assert dec_data['status'] == 'ok'
+    with django_assert_num_queries(1):
+        assert dec_data['users'][2] == users[2]
+    with django_assert_num_queries(0):
+        assert dec_data['users'][2] is dec_data['users'][2]
+    with django_assert_num_queries(1):  # the references of the subtree are fetched together
+        assert dec_data.materialize() == {'users': users, 'status': 'ok'}
+
+
+@pytest.mark.django_db
+def test_django_orm_eval_missing_with_db(admin_user):
+    from django.contrib.auth.models import User
+    enc_data = dumps([DjangoORM(User, admin_user.id), DjangoORM(User, admin_user.id + 1)])
+    with tools.assert_raises(User.DoesNotExist):
+        loads(enc_data)
+    assert loads(enc_data, missing_references=MISSING_REFERENCE_NONE) == [admin_user, None]
+    assert loads(dumps(DjangoORM(User, admin_user.id + 1)), missing_references=MISSING_REFERENCE_NONE) is None
+
+
+@pytest.mark.django_db
+def test_django_orm_fields_with_db(admin_user):
+    from django.db.models import Model
+    from django.contrib.auth.models import User
+    test_user = User(username="test_user", email="test_user@gmail.com", date_joined=timezone.now())
+    pickled = dumps([admin_user, test_user])
+    register_encoder(Model, encode_orm_fields)
+    try:
+        enc_data = dumps([admin_user, test_user])
+        deferred_user = User.objects.only('username').get(pk=admin_user.pk)
+        assert loads(dumps(deferred_user)).username == admin_user.username
+        assert unpackb(dumps(deferred_user), raw=False).code == ExternalType.ORM_INSTANCE
+    finally:
+        unregister_encoder(Model)
+    assert len(enc_data) * 2 < len(pickled)
+    u, u1 = loads(enc_data)
+    for field in User._meta.concrete_fields:
+        assert getattr(u, field.attname) == getattr(admin_user, field.attname)
+        assert getattr(u1, field.attname) == getattr(test_user, field.attname)
+    assert not u._state.adding and u._state.db == 'default'
+    assert u1._state.adding and u1.pk is None
+
+
+def test_django_orm_fields_schema_mismatch():
+    from django.contrib.auth.models import User
+    label, fingerprint, db, values = unpackb(encode_orm_fields(User(username="test_user")).data, raw=False)
+    data = packb([label, fingerprint + 1, db, values], use_bin_type=True)
+    with tools.assert_raises(ModelSchemaMismatch):
+        loads(packb(ExtType(ExternalType.ORM_FIELDS, data)))
+    users = [User(id=i, username="user_{}".format(i), email="user_{}@gmail.com".format(i),
+                  date_joined=timezone.now()) for i in range(1, 4)]
+    kind, header, packed_columns = unpackb(unpackb(dumps(RecordBatch(users))).data, raw=False)
+    label, fingerprint, db, fields = header
+    fields = [['mail' if name == 'email' else name, internal_type] for name, internal_type in fields]
+    data = packb([kind, [label, fingerprint + 1, db, fields], packed_columns], use_bin_type=True)
+    dec_data = loads(packb(ExtType(ExternalType.RECORD_BATCH, data)))
+    assert [u.username for u in dec_data] == [u.username for u in users] and dec_data[0].pk == 1
+    assert dec_data[0].get_deferred_fields() == {'email'}
+
+
+@pytest.mark.django_db
+def test_record_batch_django_orm_with_db(admin_user, django_assert_num_queries):
+    from django.contrib.auth.models import User
+    users = [User.objects.create(username="user_{}".format(i), date_joined=timezone.now()) for i in range(20)]
+    enc_data = dumps(RecordBatch(users))
+    assert len(enc_data) * 3 < len(dumps(users))
+    dec_data = loads(enc_data)
+    assert dec_data == users
+    for u, dec_u in zip(users, dec_data):
+        for field in User._meta.concrete_fields:
+            assert getattr(u, field.attname) == getattr(dec_u, field.attname)
+    rows = [{'user': DjangoORM(User, u.id), 'rank': i} for i, u in enumerate(users)]
+    enc_data = dumps(RecordBatch(rows))
+    with django_assert_num_queries(1):
+        assert loads(enc_data) == [{'user': u, 'rank': i} for i, u in enumerate(users)]
+    with django_assert_num_queries(1):
+        assert list(loads(enc_data, lazy_records=True)) == [{'user': u, 'rank': i} for i, u in enumerate(users)]
+
+
+@pytest.mark.django_db
+def test_evaluated_queryset_with_db(django_assert_num_queries):
+    from django.contrib.auth.models import User
+    users = [User.objects.create(username="user_{}".format(i), date_joined=timezone.now()) for i in range(25)]
+    queryset = User.objects.order_by('id')
+    with django_assert_num_queries(1):
+        enc_data = dumps({'users': EvaluatedQuerySet(queryset, fields=['id', 'username', 'date_joined'], chunk_size=10)})
+    assert unpackb(enc_data, raw=False)['users'].code == ExternalType.EVALUATED_QUERYSET
+    with django_assert_num_queries(0):
+        rows = loads(enc_data)['users']
+    assert isinstance(rows, QuerySetRows) and len(rows) == 25
+    assert rows == [(u.id, u.username, u.date_joined) for u in users]
+    assert rows[3].username == 'user_3' and rows[-1].date_joined == users[-1].date_joined
+    assert not isinstance(loads(enc_data, eval_strings=False)['users'][0].date_joined, datetime)
+    assert loads(enc_data, eval_strings=EvalPaths('users.*.date_joined'))['users'][0] == rows[0]
+
+    with django_assert_num_queries(1):
+        enc_data = dumps(EvaluatedQuerySet(queryset, chunk_size=7, instances=True))
+    with django_assert_num_queries(0):
+        dec_data = loads(enc_data)
+    assert dec_data == users
+    for u, dec_u in zip(users, dec_data):
+        for field in User._meta.concrete_fields:
+            assert getattr(u, field.attname) == getattr(dec_u, field.attname)
+        assert not dec_u._state.adding and dec_u._state.db == 'default'
+    dec_user = loads(dumps(EvaluatedQuerySet(queryset, fields=['id', 'username'], instances=True)))[0]
+    assert dec_user.username == users[0].username and dec_user.get_deferred_fields()
+    with tools.assert_raises(ValueError):
+        dumps(EvaluatedQuerySet(queryset, fields=['groups__name'], instances=True))
+    assert loads(dumps(EvaluatedQuerySet(User.objects.none(), fields=['id']))) == []
+    from msgpack import Unpacker
+    unpacker = Unpacker(raw=False)
+    unpacker.feed(unpackb(dumps(EvaluatedQuerySet(queryset, fields=['id', 'username', 'email'], instances=True))).data)
+    label, fingerprint, db, fields, types = unpacker.unpack()
+    data = packb([label, fingerprint + 1, db, fields, types[:2] + ['TextField']], use_bin_type=True) + \
+        b''.join(packb(chunk, use_bin_type=True) for chunk in unpacker)
+    dec_data = loads(packb(ExtType(ExternalType.EVALUATED_QUERYSET, data)))  # the sender's email is another type
+    assert [(u.pk, u.username) for u in dec_data] == [(u.pk, u.username) for u in users]
+    assert 'email' in dec_data[0].get_deferred_fields()
+
+
+@pytest.mark.django_db
+def test_iter_dumps_evaluated_queryset_with_db(django_assert_num_queries):
+    from django.contrib.auth.models import User
+    users = [User.objects.create(username="user_{}".format(i), date_joined=timezone.now()) for i in range(25)]
+    evaluated = EvaluatedQuerySet(User.objects.order_by('id'), fields=['id', 'username', 'date_joined'], chunk_size=10)
+    with django_assert_num_queries(1):
+        chunks = list(iter_dumps(evaluated))
+    assert len(chunks) == 5  # the header, a chunk per 10 rows and the end
+    assert [unpackb(chunk).code for chunk in chunks[:4]] == [ExternalType.EVALUATED_QUERYSET_STREAM] + [
+        ExternalType.EVALUATED_QUERYSET_CHUNK] * 3
+    rows = loads(dumps(evaluated))
+    assert loads(b''.join(chunks)) == rows and isinstance(loads(b''.join(chunks)), QuerySetRows)
+    dec_data, = iter_loads(chunks)
+    assert isinstance(dec_data, QuerySetRows) and dec_data == rows and dec_data[3].username == 'user_3'
+    payload = b''.join(chunks)
+    assert list(iter_loads(payload[i:i + 7] for i in range(0, len(payload), 7))) == [rows]
+    assert list(iter_loads(BytesIO(payload), read_size=16)) == [rows]
+    with tools.assert_raises(ValueError):
+        list(iter_loads(chunks[:-1]))
+    with tools.assert_raises(ValueError):
+        loads(b''.join(chunks[:-1]))
+
+    evaluated = EvaluatedQuerySet(User.objects.order_by('id'), chunk_size=7, instances=True)
+    with django_assert_num_queries(0):
+        parts = iter_dumps(evaluated)
+        header = next(parts)  # sent before the rows are read
+    with django_assert_num_queries(1):
+        payload = header + b''.join(parts)
+    with django_assert_num_queries(0):
+        assert list(iter_loads(BytesIO(payload))) == [users]
+        assert loads(payload) == users
+        assert loads(payload, lazy=True) == users
+    assert loads(b''.join(iter_dumps(EvaluatedQuerySet(User.objects.none(), fields=['id'])))) == []
+
+
+@pytest.mark.django_db
+def test_iter_loads_references_with_db(django_assert_num_queries):
+    from django.contrib.auth.models import User
+    users = [User.objects.create(username="user_{}".format(i)) for i in range(10)]
+    chunks = list(iter_dumps([DjangoORM(User, u.id) for u in users]))
+    with django_assert_num_queries(3):
+        assert list(iter_loads(chunks, batch_size=4)) == users
+
+
+@pytest.mark.django_db
+def test_loads_many_with_db(django_assert_num_queries):
+    from concurrent.futures import ThreadPoolExecutor
+    from django.contrib.auth.models import User, Group
+    users = [User.objects.create(username="user_{}".format(i)) for i in range(10)]
+    group = Group.objects.create(name='staff')
+    shared = {'tag': 'shared'}
+    objs = [{'user': DjangoORM(User, u.id), 'group': DjangoORM(Group, group.id), 'tags': [shared, shared],
+             'at': datetime(2019, 9, 26, 9, 16, 35, i)} for i, u in enumerate(users)]
+    bodies = dumps_many(objs, dedup=True)
+    assert bodies == [dumps(o, dedup=True) for o in objs]
+    expected = [{'user': u, 'group': group, 'tags': [shared, shared], 'at': datetime(2019, 9, 26, 9, 16, 35, i)}
+                for i, u in enumerate(users)]
+    with django_assert_num_queries(2):  # one query per model for the whole batch
+        dec_data = loads_many(bodies)
+    assert dec_data == expected
+    assert dec_data[3]['tags'][0] is dec_data[3]['tags'][1]
+    assert loads_many([]) == []
+    enable_compression(threshold=64)
+    try:
+        with ThreadPoolExecutor(2) as executor:
+            bodies = dumps_many(objs, executor=executor)
+            assert all(unpackb(body).code == ExternalType.COMPRESSED for body in bodies)
+            with django_assert_num_queries(2):
+                assert loads_many([bytearray(body) for body in bodies], executor=executor) == expected
+    finally:
+        enable_compression(threshold=None)
+    User.objects.filter(pk=users[0].pk).delete()
+    with tools.assert_raises(User.DoesNotExist):
+        loads_many(bodies)
+    dec_data = loads_many(bodies, missing_references=MISSING_REFERENCE_NONE)
+    assert dec_data[0]['user'] is None and dec_data[1:] == expected[1:]
+
+
+@pytest.mark.django_db
+def test_django_orm_queryset_eval_lazy_with_db(django_assert_num_queries):
+    tracemalloc = pytest.importorskip('tracemalloc')
+    from django.contrib.auth.models import User
+    User.objects.bulk_create([User(username="user_{}".format(i)) for i in range(2000)])
+    enc_data = dumps([DjangoQS(User, "username LIKE 'user_1%' AND is_active"), DjangoQS(User, "id > 0")])
+    tracemalloc.start()
+    try:
+        with django_assert_num_queries(0):
+            dec_data = loads(enc_data)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < 200 << 10
+    assert len(str(dec_data[1].query)) < 1000
+    with django_assert_num_queries(1):
+        assert dec_data[0].count() == 1111
+    with django_assert_num_queries(1):
+        assert len(list(dec_data[1])) == 2000
+
+
+@pytest.mark.django_db
+def test_serializer_metrics_with_db(admin_user):
+    from nameko_django.metrics import MetricsRegistry
+    from django.contrib.auth.models import User
+    metrics = enable_metrics(MetricsRegistry())
+    try:
+        enc_data = dumps({'price': Decimal('1.5'), 'user': admin_user, 'at': '2019-09-26 09:16:35.123456+00:00',
+                          'ref': DjangoORM(User, admin_user.id), 'qs': DjangoQS(User, 'id > 0')})
+        loads(enc_data)
+    finally:
+        disable_metrics()
+    loads(enc_data)  # not recorded
+    assert metrics.counter('nameko_django_ext_types_total', operation='dumps', type='DECIMAL') == 1
+    assert metrics.counter('nameko_django_ext_types_total', operation='dumps', type='ORM_INSTANCE') == 1
+    assert metrics.counter('nameko_django_ext_types_total', operation='loads', type='DECIMAL') == 1
+    assert metrics.counter('nameko_django_ext_types_total', operation='loads', type='ORM_INSTANCE') == 1
+    assert metrics.counter('nameko_django_string_evaluations_total', kind='datetime') == 1
+    assert metrics.counter('nameko_django_string_evaluations_total', kind='orm') == 1
+    assert metrics.counter('nameko_django_string_evaluations_total', kind='queryset') == 1
+    assert metrics.histogram('nameko_django_dumps_seconds').count == 1
+    assert metrics.histogram('nameko_django_loads_seconds').count == 1
+    assert metrics.histogram('nameko_django_payload_bytes', operation='dumps').sum == len(enc_data)
+    assert metrics.histogram('nameko_django_payload_bytes', operation='loads').sum == len(enc_data)
+
+
+def test_compression():
+    payload = [{'name': 'customer {}'.format(i), 'balance': Decimal(i) / 4} for i in range(1000)]
+    small = {'name': 'customer'}
+    plain = dumps(payload)
+    enable_compression(threshold=1024)
+    try:
+        assert dumps(small) == pack(small)  # under the threshold
+        enc_data = dumps(payload)
+        assert len(enc_data) < len(plain) / 4
+        assert unpackb(enc_data).code == ExternalType.COMPRESSED
+        assert loads(enc_data) == payload
+        enable_compression(threshold=1024, codec='lzma' if 'lzma' in _codecs else 'zlib', level=1)
+        assert loads(dumps(payload)) == payload
+        random_bytes = os.urandom(4096)
+        assert dumps(random_bytes) == pack(random_bytes)  # not smaller once compressed
+        with pytest.raises(ValueError):
+            enable_compression(codec='rar')
+    finally:
+        enable_compression(threshold=None)
+    assert dumps(payload) == plain
+    assert loads(enc_data) == payload  # inflated whatever the setting
+
+
+def test_dedup_shared_objects():
+    from django.contrib.auth.models import User
+    customer = User(id=7, username='customer')
+    address = {'city': 'Hanoi', 'lines': ['1 Trang Tien', 'Hoan Kiem']}
+    price = Decimal('12.50')
+    rows = [{'id': i, 'customer': customer, 'address': address, 'price': price, 'tags': []} for i in range(50)]
+    enc_data = dumps(rows, dedup=True)
+    assert len(enc_data) < len(dumps(rows)) / 5
+    dec_data = loads(enc_data)
+    assert dec_data == rows
+    assert dec_data[0]['customer'].username == 'customer'
+    assert all(row['customer'] is dec_data[0]['customer'] for row in dec_data)
+    assert all(row['address'] is dec_data[0]['address'] for row in dec_data)
+    assert all(row['price'] is dec_data[0]['price'] for row in dec_data)
+    assert dec_data[0]['tags'] is not dec_data[1]['tags']
+    assert loads(enc_data, eval_strings=False) == rows
+    assert dumps(['a', 1, {'b': 2.5}], dedup=True) == dumps(['a', 1, {'b': 2.5}])  # nothing repeated
+    assert dumps(rows, dedup=True, record_batch_min_rows=100) == enc_data  # no batch formed
+    payload = {'rows': rows, 'again': rows}
+    dec_data = loads(dumps(payload, dedup=True, record_batch_min_rows=10))
+    assert dec_data == {'rows': rows, 'again': rows} and dec_data['rows'] is dec_data['again']
+
+
+def test_dedup_nested_shared_objects():
+    inner = {'value': Decimal('1.5')}
+    outer = {'inner': inner, 'again': inner}
+    payload = [outer, outer, inner, (inner, outer)]
+    dec_data = loads(dumps(payload, dedup=True))
+    assert dec_data == [outer, outer, inner, [inner, outer]]
+    assert dec_data[0] is dec_data[1] is dec_data[3][1]
+    assert dec_data[0]['inner'] is dec_data[0]['again'] is dec_data[2] is dec_data[3][0]
+    assert list(iter_loads(iter_dumps(payload, dedup=True))) == dec_data
+    a, b = {'x': 1}, {'y': 2}
+    dec_data = list(iter_loads([b''.join(iter_dumps([[a, a], [b, b]], dedup=True))]))
+    assert dec_data == [[a, a], [b, b]]
+    assert dec_data[0][0] is dec_data[0][1] and dec_data[1][0] is dec_data[1][1]
+
+
+@pytest.mark.django_db
+def test_dedup_with_eval_paths_with_db(admin_user):
+    shared = {'user': DjangoORM(type(admin_user), admin_user.pk)}
+    enc_data = dumps({'rows': [shared, shared]}, dedup=True)
+    dec_data = loads(enc_data, eval_strings='rows.*.user')
+    assert dec_data == {'rows': [{'user': admin_user}, {'user': admin_user}]}
+    assert dec_data['rows'][0] is dec_data['rows'][1]
+    assert loads_many([enc_data], eval_strings=EvalPaths('rows.*.user')) == [dec_data]
+
+
+@pytest.mark.django_db
+def test_instance_cache_with_db(django_assert_num_queries):
+    from django.contrib.auth.models import User
+    from nameko_django.serializer import instance_cache
+    users = [User.objects.create(username="user_{}".format(i)) for i in range(5)]
+    enc_data = dumps([DjangoORM(User, u.id) for u in users])
+    instance_cache.configure(User, max_count=10, ttl=60)
+    try:
+        with django_assert_num_queries(1):
+            assert loads(enc_data) == users
+        with django_assert_num_queries(0):
+            dec_data = loads(enc_data)
+            assert dec_data == users and dec_data[4] is not loads(enc_data)[4]
+        with django_assert_num_queries(0):
+            assert loads(dumps(DjangoORM(User, users[4].id))).username == 'user_4'
+        User.objects.filter(pk=users[4].pk).update(username='stale')  # no signal, served until the ttl
+        assert loads(dumps(DjangoORM(User, users[4].id))).username == 'user_4'
+        users[4].username = 'renamed'
+        users[4].save()
+        with django_assert_num_queries(1):
+            assert loads(dumps(DjangoORM(User, users[4].id))).username == 'renamed'
+        deleted = DjangoORM(User, users[4].id)
+        users[4].delete()
+        with pytest.raises(User.DoesNotExist):
+            loads(dumps(deleted))
+        assert instance_cache.stats()['auth.User']['count'] == 4
+    finally:
+        instance_cache.remove(User)
+
+
+@pytest.mark.django_db
+def test_instance_cache_of_proxy_model_with_db():
+    from django.apps import apps
+    from django.contrib.auth.models import User
+    from nameko_django.serializer import instance_cache
+    try:
+        Staff = apps.get_model('auth', 'Staff')
+    except LookupError:
+        class Staff(User):
+            class Meta:
+                proxy = True
+                app_label = 'auth'
+    user = User.objects.create(username="staff")
+    enc_data = dumps(DjangoORM(Staff, user.id))
+    instance_cache.configure(Staff, max_count=10, ttl=60)
+    try:
+        assert loads(enc_data).username == 'staff'
+        user.username = 'renamed'
+        user.save()  # saved through the concrete model
+        assert loads(enc_data).username == 'renamed'
+        instance_cache.configure(User, max_count=10, ttl=60)
+        assert loads(dumps([DjangoORM(User, user.id), DjangoORM(Staff, user.id)])) == [user, user]
+        staff = Staff.objects.get(pk=user.id)
+        staff.username = 'proxied'
+        staff.save()  # saved through the proxy
+        assert [u.username for u in loads(dumps([DjangoORM(User, user.id), DjangoORM(Staff, user.id)]))] == [
+            'proxied', 'proxied']
+    finally:
+        instance_cache.remove(Staff)
+        instance_cache.remove(User)
+
+
+@pytest.mark.django_db
+def test_offload_with_db(admin_user):
+    from eventlet import tpool
+    rows = [{'id': i, 'price': Decimal(i) / 4, 'user': DjangoORM(admin_user.__class__, admin_user.id)}
+            for i in range(100)]
+    small = {'id': 1}
+    with patch('eventlet.tpool.execute', wraps=tpool.execute) as execute:
+        enable_offload(threshold=1024, min_items=50)
+        try:
+            enc_data = dumps(rows)
+            assert execute.call_count == 1
+            dec_data = loads(enc_data)
+            assert execute.call_count == 2
+            assert [row['user'] for row in dec_data] == [admin_user] * 100
+            assert loads(dumps(small)) == small
+            assert execute.call_count == 2
+        finally:
+            enable_offload(threshold=None, min_items=None)
+    assert dumps(rows) == enc_data
+
+
+def test_offload_compression_to_process_pool():
+    from concurrent.futures import ProcessPoolExecutor
+    rows = [{'id': i, 'name': 'customer {}'.format(i)} for i in range(1000)]
+    executor = ProcessPoolExecutor(1)
+    enable_compression(threshold=1024)
+    enable_offload(threshold=1024, min_items=50, executor=executor)
+    try:
+        with patch.object(executor, 'submit', wraps=executor.submit) as submit:
+            enc_data = dumps(rows)
+            assert unpackb(enc_data).code == ExternalType.COMPRESSED
+            assert loads(enc_data) == rows
+            assert submit.call_count == 2  # compressed then inflated in the process
+    finally:
+        enable_offload(threshold=None, min_items=None)
+        enable_compression(threshold=None)
+        executor.shutdown()
+
+
+IMPORT_CHECK = """
+from decimal import Decimal
+from nameko_django.serializer import dumps, loads
+loads(dumps([1, 'text', Decimal('1.5'), {'a': b'bytes'}]))
+assert loads(dumps('2019-09-26 09:16:35.000000+00:00')).year == 2019
+"""
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason="-X importtime needs python 3.7")
+def test_import_does_not_load_django_orm():
+    env = dict(os.environ)
+    env.pop('DJANGO_SETTINGS_MODULE', None)  # no configured settings are needed either
+    process = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', IMPORT_CHECK], env=env,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    _, importtime = process.communicate()
+    assert process.returncode == 0, importtime
+    imported = {}
+    for line in importtime.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, name = line.split('|')
+            if cumulative.strip().isdigit():  # not the header
+                imported[name.strip()] = int(cumulative)
+    logger.info("nameko_django.serializer imported in %s us", imported['nameko_django.serializer'])
+    assert 'django.utils.dateparse' in imported  # by the date string only
+    for module in ('django.db', 'django.db.models', 'django.apps', 'aenum'):
+        assert module not in imported